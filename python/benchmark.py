@@ -0,0 +1,327 @@
+# Benchmarks of the analysis functions on synthetic events
+#
+# The events are generated with the branch layout of the podio files (taus with their neutrinos
+# and decay products, tau jets with constituents, fake jets, muons) so no Delphes file is needed.
+# Results are appended to a JSON file to follow the speed of the analyses over time.
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+import awkward as ak
+import histograms
+import numpy as np
+import uproot
+from reader import COLLECTIONS, EventReader, leaf_name
+
+# Mean number of objects per event
+MULTIPLICITIES = {
+    'taus': 2,  # generator taus (status 2)
+    'particles': 20,  # other stable generator particles
+    'extra_particles': 40,  # particles only in genParticles
+    'fake_jets': 2,  # jets without a generator tau
+    'constituents': 5,  # particles per jet
+    'muons': 2,  # muons besides the Z decays
+}
+
+# Fraction of generator taus with a reconstructed jet, and of events with a Z -> mumu decay
+TAU_JET_EFFICIENCY = 0.7
+Z_FRACTION = 0.5
+
+DTYPES = {
+    'pdgId': np.int32,
+    'status': np.int32,
+    'charge': np.int32,
+    'particles_begin': np.uint32,
+    'particles_end': np.uint32,
+    'start_vertex': np.int32,
+    'end_vertex': np.int32,
+}
+
+ANALYSES = ['tau_deltaR', 'tau_cone', 'rec_efficiency', 'comparison_Htautau', 'testing_Htautau',
+            'testing_Zmumu', 'testing_lorentzvector']
+
+# Benchmarks making ROOT objects besides the histograms (TLorentzVector), skipped with --numpy
+ROOT_BENCHMARKS = ['loop:testing_lorentzvector']
+
+
+def random_momenta(rng, n, pt_low, pt_high, eta_max=2.5):
+    # Momenta with uniform pT, eta and phi
+    pt = rng.uniform(pt_low, pt_high, n)
+    eta = rng.uniform(-eta_max, eta_max, n)
+    phi = rng.uniform(-np.pi, np.pi, n)
+    return pt * np.cos(phi), pt * np.sin(phi), pt * np.sinh(eta)
+
+
+def jagged(events, fields):
+    # Sort flat fields of objects by event, keeping the order within each event
+    order = np.argsort(events, kind='stable')
+    return events[order], {name: values[order] for name, values in fields.items()}
+
+
+def generate(path, n_events, multiplicities=None, seed=1):
+    # Write n_events synthetic events to path
+    multiplicities = dict(MULTIPLICITIES, **(multiplicities or {}))
+    rng = np.random.default_rng(seed)
+    branches = {}
+
+    def add(collection, events, fields):
+        # add a collection from flat fields and the event of every object
+        events, fields = jagged(events, fields)
+        counts = np.bincount(events, minlength=n_events)
+        for field in COLLECTIONS[collection]:
+            values = fields.get(field, np.zeros(len(events)))
+            values = values.astype(DTYPES.get(field, np.float32))
+            branches[leaf_name(collection, field)] = ak.unflatten(values, counts)
+
+    # generator taus decaying to a tau neutrino and a pion at their own vertex, and other stable particles
+    # coming from the primary vertex 0
+    tau_events = np.repeat(np.arange(n_events), rng.poisson(multiplicities['taus'], n_events))
+    n_taus = len(tau_events)
+    tau_vertices = 1 + np.arange(n_taus) - np.searchsorted(tau_events, tau_events)
+    tau_p = np.array(random_momenta(rng, n_taus, 5, 60))
+    tau_sign = rng.choice([-1, 1], n_taus)
+    neutrino_p = tau_p * rng.uniform(0.1, 0.5, n_taus)
+    visible_p = tau_p - neutrino_p
+    other_events = np.repeat(np.arange(n_events), rng.poisson(multiplicities['particles'], n_events))
+    other_p = np.array(random_momenta(rng, len(other_events), 0.5, 20))
+    other_pdg_ids = rng.choice([211, -211, 22, 130, 11, -11, 12, -14], len(other_events))
+
+    particles = {
+        'px': np.r_[tau_p[0], neutrino_p[0], visible_p[0], other_p[0]],
+        'py': np.r_[tau_p[1], neutrino_p[1], visible_p[1], other_p[1]],
+        'pz': np.r_[tau_p[2], neutrino_p[2], visible_p[2], other_p[2]],
+        'mass': np.r_[np.full(n_taus, 1.777), np.zeros(n_taus), np.full(n_taus + len(other_events), 0.1396)],
+        'pdgId': np.r_[15 * tau_sign, 16 * tau_sign, -211 * tau_sign, other_pdg_ids],
+        'status': np.r_[np.full(n_taus, 2), np.ones(2 * n_taus + len(other_events))],
+        'charge': np.r_[-tau_sign, np.zeros(n_taus), -tau_sign,
+                        np.sign(other_pdg_ids) * np.isin(other_pdg_ids, [211, -211])],
+        'start_vertex': np.r_[np.zeros(n_taus), tau_vertices, tau_vertices, np.zeros(len(other_events))],
+        'end_vertex': np.r_[tau_vertices, np.full(2 * n_taus + len(other_events), -1)],
+    }
+    particle_events = np.r_[tau_events, tau_events, tau_events, other_events]
+    add('skimmedGenParticles', particle_events, particles)
+    extra_events = np.repeat(np.arange(n_events), rng.poisson(multiplicities['extra_particles'], n_events))
+    extra_p = random_momenta(rng, len(extra_events), 0.1, 5)
+    extra = {
+        'px': extra_p[0], 'py': extra_p[1], 'pz': extra_p[2],
+        'mass': np.full(len(extra_events), 0.1396),
+        'pdgId': rng.choice([211, -211, 22, 2112], len(extra_events)),
+        'status': np.ones(len(extra_events)),
+        'end_vertex': np.full(len(extra_events), -1),
+    }
+    add('genParticles', np.r_[particle_events, extra_events],
+        {name: np.r_[particles[name], extra.get(name, np.zeros(len(extra_events)))] for name in particles})
+
+    # jets of the visible taus with a small smearing, followed by fake jets
+    has_jet = rng.uniform(size=n_taus) < TAU_JET_EFFICIENCY
+    tau_jet_p = visible_p[:, has_jet] * rng.normal(1, 0.02, has_jet.sum())
+    fake_events = np.repeat(np.arange(n_events), rng.poisson(multiplicities['fake_jets'], n_events))
+    fake_p = np.array(random_momenta(rng, len(fake_events), 5, 50))
+    jet_events, jets = jagged(np.r_[tau_events[has_jet], fake_events], {
+        'px': np.r_[tau_jet_p[0], fake_p[0]],
+        'py': np.r_[tau_jet_p[1], fake_p[1]],
+        'pz': np.r_[tau_jet_p[2], fake_p[2]],
+        'mass': rng.uniform(0.5, 2, has_jet.sum() + len(fake_events)),
+        'charge': rng.choice([-1, 0, 1], has_jet.sum() + len(fake_events)),
+        'tag': np.r_[rng.uniform(0.3, 1, has_jet.sum()), rng.uniform(0, 0.6, len(fake_events))],
+    })
+
+    # jet constituents sharing the jet momentum, with event-local particles_begin/end
+    n_parts = 1 + rng.poisson(multiplicities['constituents'] - 1, len(jet_events))
+    parts_end = np.cumsum(n_parts)
+    parts_begin = parts_end - n_parts
+    first_jet = np.searchsorted(jet_events, np.arange(n_events))
+    event_start = np.r_[parts_begin, parts_end[-1:] if len(parts_end) else [0]][first_jet]
+    jets['particles_begin'] = parts_begin - event_start[jet_events]
+    jets['particles_end'] = parts_end - event_start[jet_events]
+    part_jets = np.repeat(np.arange(len(jet_events)), n_parts)
+    share = rng.uniform(0.5, 1.5, len(part_jets))
+    share /= np.bincount(part_jets, share)[part_jets]
+    part_pdg_ids = rng.choice([211, -211, 22, 130], len(part_jets))
+    add('jets', jet_events, jets)
+    add('tauTags', jet_events, {'tag': jets['tag']})
+    add('jetParts', jet_events[part_jets], {
+        'px': jets['px'][part_jets] * share,
+        'py': jets['py'][part_jets] * share,
+        'pz': jets['pz'][part_jets] * share,
+        'mass': np.full(len(part_jets), 0.1396),
+        'pdgId': part_pdg_ids,
+        'charge': np.sign(part_pdg_ids) * np.isin(part_pdg_ids, [211, -211]),
+    })
+
+    # Z -> mumu decays as back-to-back muons, and other muons
+    z_events = np.flatnonzero(rng.uniform(size=n_events) < Z_FRACTION)
+    z_p = np.array(random_momenta(rng, len(z_events), 10, 45))
+    z_p *= 45.6 / np.sqrt((z_p ** 2).sum(axis=0))
+    other_events = np.repeat(np.arange(n_events), rng.poisson(multiplicities['muons'], n_events))
+    other_p = np.array(random_momenta(rng, len(other_events), 2, 50))
+    muon_events, muons = jagged(np.r_[z_events, z_events, other_events], {
+        'px': np.r_[z_p[0], -z_p[0], other_p[0]],
+        'py': np.r_[z_p[1], -z_p[1], other_p[1]],
+        'pz': np.r_[z_p[2], -z_p[2], other_p[2]],
+        'mass': np.full(2 * len(z_events) + len(other_events), 0.1057),
+        'charge': np.r_[np.ones(len(z_events)), -np.ones(len(z_events)), rng.choice([-1, 1], len(other_events))],
+        'tag': np.r_[rng.uniform(0, 0.3, 2 * len(z_events)), rng.uniform(0, 1, len(other_events))],
+    })
+    add('muons', muon_events, muons)
+    add('muonITags', muon_events, {'tag': muons['tag']})
+
+    with uproot.recreate(path) as outf:
+        outf.mktree('events', {name: array.type.content for name, array in branches.items()})
+        outf['events'].extend(branches)
+
+
+def load_chunk(path, collections):
+    # Read all events of a file into one chunk with every field in memory
+    reader = EventReader(path, collections, chunk_size=len(EventReader(path, collections)))
+    chunk = next(reader.chunks())
+    for name in collections:
+        for field in COLLECTIONS[name]:
+            chunk[name][field]
+    return chunk
+
+
+def each_event(function):
+    # Benchmark calling function(event) for every event of a chunk
+    def run(chunk):
+        for event in chunk.events():
+            function(event)
+    return run
+
+
+def cone_profile(chunk):
+    # ConeProfile.fill for the taus of every event, as in tau_cone.process
+    import tau_cone
+    from isolation import ConeProfile
+    from particle_index import get_index
+    from vectors import LorentzArray
+    profile = ConeProfile(tau_cone.cone_sizes, [{} for cone_size in tau_cone.cone_sizes])
+    particles = chunk['genParticles']
+    vectors = LorentzArray.from_collection(particles)
+    index = get_index(particles)
+    for event in range(chunk.n_events):
+        taus = tau_cone.get_gen_taus(vectors, index, event)
+        if len(taus):
+            profile.fill(taus, *tau_cone.get_stable_particles(vectors, particles['pdgId'], index, event))
+
+
+def function_benchmarks():
+    # Per-event functions of the analyses and the collections they read
+    import comparison_Htautau
+    import dilepton
+    import rec_efficiency
+    import testing_Htautau
+    return {
+        'muon_pairs': (['muons', 'muonITags'], dilepton.muon_pairs),
+        'cone_profile': (['genParticles'], cone_profile),
+        'TauCandidates': (rec_efficiency.COLLECTIONS, rec_efficiency.get_candidates),
+        'get_tau_collection': (comparison_Htautau.COLLECTIONS, each_event(comparison_Htautau.get_tau_collection)),
+        'matched_jets': (testing_Htautau.COLLECTIONS, testing_Htautau.matched_jets),
+    }
+
+
+def time_call(function, repeat):
+    # Best time of repeat calls, with the printout of the analyses suppressed
+    times = []
+    for i in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_benchmarks(path, names=None, repeat=3, root=True):
+    # Time the per-event functions on events in memory and the full analysis loops reading the file
+    # root: also run the benchmarks of ROOT_BENCHMARKS, which need ROOT
+    import importlib
+    n_events = len(EventReader(path, []))
+    results = {}
+
+    def selected(name):
+        return (not names or name in names) and (root or name not in ROOT_BENCHMARKS)
+
+    def add(name, seconds):
+        results[name] = {'seconds': seconds, 'events_per_second': n_events / seconds}
+        print('{:30} {:12.1f} events/s'.format(name, n_events / seconds))
+
+    for name, (collections, function) in function_benchmarks().items():
+        if not selected(name):
+            continue
+        chunk = load_chunk(path, collections)
+        add(name, time_call(lambda: function(chunk), repeat))
+
+    for analysis in ANALYSES:
+        name = 'loop:' + analysis
+        if not selected(name):
+            continue
+        module = importlib.import_module(analysis)
+
+        def loop():
+            outputs = module.create_outputs()
+            for chunk in EventReader(path, module.COLLECTIONS).chunks():
+                module.process(chunk, outputs)
+        add(name, time_call(loop, repeat))
+    return results
+
+
+def git_commit():
+    # Current commit of the repository, if known
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path, results, settings):
+    # Append the results of a run to the JSON file of all runs
+    runs = []
+    if os.path.exists(path):
+        with open(path) as results_file:
+            runs = json.load(results_file)
+    runs.append({
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'settings': settings,
+        'results': results,
+    })
+    with open(path, 'w') as results_file:
+        json.dump(runs, results_file, indent=1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the analyses on synthetic events')
+    parser.add_argument('-n', '--events', type=int, default=2000, help='number of synthetic events')
+    parser.add_argument('-m', '--multiplicity', nargs=2, action='append', default=[], metavar=('NAME', 'MEAN'),
+                        help='mean number of objects per event, e.g. -m taus 4 ({})'.format(', '.join(MULTIPLICITIES)))
+    parser.add_argument('-b', '--benchmarks', nargs='+', help='benchmarks to run, e.g. muon_pairs loop:tau_cone')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='repetitions, the best time is kept')
+    parser.add_argument('-s', '--seed', type=int, default=1, help='random seed of the events')
+    parser.add_argument('-i', '--input', default='data/benchmark_events.root', help='file of the synthetic events')
+    parser.add_argument('-o', '--output', default='data/benchmarks.json', help='JSON file collecting the results')
+    parser.add_argument('--numpy', action='store_true',
+                        help='fill NumPy histograms and skip the benchmarks needing ROOT, to run without ROOT')
+    args = parser.parse_args(argv)
+    histograms.NUMPY = args.numpy
+
+    multiplicities = {name: float(mean) for name, mean in args.multiplicity}
+    for name in multiplicities:
+        if name not in MULTIPLICITIES:
+            parser.error('unknown multiplicity: {}'.format(name))
+    generate(args.input, args.events, multiplicities, args.seed)
+    results = run_benchmarks(args.input, args.benchmarks, args.repeat, root=not args.numpy)
+    settings = {'events': args.events, 'multiplicities': dict(MULTIPLICITIES, **multiplicities), 'seed': args.seed,
+                'repeat': args.repeat, 'numpy': args.numpy}
+    save_results(args.output, results, settings)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,19 @@
 # Comparing tau energies from generator level and reconstruction level results
-from ROOT import TFile, TH1D
-import utils
+from histograms import new_histogram
+from jet_constituents import constituent_sums
+from match_cache import MatchCache, event_fields
+from vectors import LorentzArray
+import decay_tree
+import entry
+import event_dump
+import matching
+import numpy as np
+import skim
+import sys
+
+COLLECTIONS = ['jets', 'tauTags', 'skimmedGenParticles', 'jetParts']
+INPUT = 'data/p8_ee_ZH.root'
+OUTPUT = 'data/histo_comparison.root'
 
 
 def get_gen_tau_masses(collection):
@@ -26,237 +39,236 @@ def get_gen_tau_masses(collection):
     return masses
 
 
-def get_tau_collection(tree):
+def find_tau_matches(chunk):
+    # Match the tau-tagged jets of a chunk to the first generator tau inside the cone
+    # Returns jagged fields of event-local indices for match_cache: the tau-tagged jets (jet)
+    # and the generator tau of each of them in skimmedGenParticles (gen, -1 if none)
+    particles = chunk['skimmedGenParticles']
+    is_tau = np.abs(particles['pdgId']) == 15
+    taus, tau_offsets = skim.local_indices(is_tau, particles.offsets)
+
+    jets = chunk['jets']
+    tagged = ~(chunk['tauTags']['tag'] < skim.TAG_THRESHOLD)
+    tagged_jets, jet_offsets = skim.local_indices(tagged, jets.offsets)
+    jet_matches, _ = matching.match_chunk(
+        LorentzArray.from_collection(jets)[tagged], jet_offsets,
+        LorentzArray.from_collection(particles)[is_tau], tau_offsets, matching.CONE_SIZE, 'first'
+    )
+    gen = np.full(len(jet_matches), -1, dtype=np.int64)
+    gen[jet_matches >= 0] = taus[jet_matches[jet_matches >= 0]]
+    return {'jet': (tagged_jets, jet_offsets), 'gen': (gen, jet_offsets)}
+
+
+def get_tau_collection(tree, matches=None):
+    # matches: results of find_tau_matches for this event if already known
     # get data from tree
     jets = tree.jets
     tau_tags = tree.tauTags
     gen_particles = tree.skimmedGenParticles
     tau_collection = []
 
-    # loop through reconstructed jets
-    for i in range(len(jets)):
-        curr_set = {}
-
-        # select only tau-tagged jets
-        if tau_tags[i].tag < 0.5:
-            continue
+    if matches is not None:
+        tau_jets = [jets[i] for i in matches['jet']]
+        gen_taus = list(gen_particles)
+        indices = matches['gen']
+    else:
+        # select only tau-tagged jets and generator taus
+        tau_jets = [jet for i, jet in enumerate(jets) if not tau_tags[i].tag < 0.5]
+        gen_taus = gen_particles.select(15)
 
-        # get lorentz vector of selected jet
-        vector = utils.get_lorentz_vector(jets[i])
+        # find the first generator tau particle with small delta R for each reconstructed jet
+        jet_vectors = LorentzArray.from_particles(tau_jets)
+        gen_vectors = LorentzArray.from_particles(gen_taus)
+        indices, _ = matching.match_vectors(jet_vectors, gen_vectors, method='first')
 
-        # find a matching generator tau particle for reconstructed jet
-        for particle in gen_particles:
-
-            # select only taus
-            pdg = particle.core.pdgId
-            if abs(pdg) == 15:
-
-                # find delta R of tau jet w.r.t generated tau
-                deltaR = vector.DeltaR(utils.get_lorentz_vector(particle))
+    # loop through reconstructed jets
+    for i, jet in enumerate(tau_jets):
+        curr_set = {}
 
-                # select generated tau with small delta R
-                if deltaR < 0.05:
-                    curr_set = {
-                        'gen': particle,
-                        'rec': jets[i],
-                        'rec_vector': vector
-                    }
-                    break
+        if indices[i] >= 0:
+            curr_set = {
+                'gen': gen_taus[indices[i]],
+                'rec': jet
+            }
 
         # find corresponding neutrino for gen tau
         if curr_set:
-            for particle in gen_particles:
+            # neutrino from the decay of the tau, None without the decay tree
+            neutrino = decay_tree.tau_neutrino(curr_set['gen'])
+            if neutrino:
+                curr_set.update({'gen_neutrino': neutrino})
 
-                # select only tau neutrinos
-                pdg = particle.core.pdgId
-                if abs(pdg) == 16:
+        if curr_set and 'gen_neutrino' not in curr_set:
+            # select only tau neutrinos, also for taus whose decay is not in the decay tree
+            for particle in gen_particles.select(16):
 
-                    # check if charges match
-                    if pdg * curr_set['gen'].core.pdgId > 0:
-                        curr_set.update({'gen_neutrino': particle})
+                # check if charges match
+                if particle.core.pdgId * curr_set['gen'].core.pdgId > 0:
+                    curr_set.update({'gen_neutrino': particle})
 
-            # add found set into collection
+        # add found set into collection, taus without a neutrino have no generator energy
+        if curr_set and 'gen_neutrino' in curr_set:
             tau_collection.append(curr_set)
 
-        else:
-            print('Reconstructed tau jet found with no matching generator tau particle')
-
     return tau_collection
 
 
-def get_gen_tau_mass(tau_set):
-    tau_vector = utils.get_lorentz_vector(tau_set['gen'])
-    neutrino_vector = utils.get_lorentz_vector(tau_set['gen_neutrino'])
-    jet_vector = tau_vector - neutrino_vector
-    mass = jet_vector.M()
-    return mass
-
+def get_tau_vectors(chunk, collection):
+    # Visible generator tau and reconstructed jet of the tau sets of a chunk, as LorentzArrays
+    # The visible taus are those of the tau candidates (skim.visible_taus): without all neutrinos of the
+    # decay if the input has the decay tree, the tau minus its neutrino otherwise
+    def indices(key):
+        return np.array([tau_set[key].index for tau_set in collection], dtype=np.int64)
 
-def get_rec_tau_mass(tau_set):
-    vector = tau_set['rec_vector']
-    mass = vector.M()
-    return mass
+    particles = chunk['skimmedGenParticles']
+    gen_vectors = skim.visible_taus(particles, indices('gen'), indices('gen_neutrino'),
+                                    LorentzArray.from_collection(particles))
+    rec_vectors = LorentzArray.from_collection(chunk['jets'])[indices('rec')]
+    return gen_vectors, rec_vectors
 
 
-def get_tau_masses(collection):
-    masses = {
-        'gen': [],
-        'rec': []
+def get_tau_masses(chunk, collection):
+    gen_vectors, rec_vectors = get_tau_vectors(chunk, collection)
+    return {
+        'gen': gen_vectors.m(),
+        'rec': rec_vectors.m()
     }
 
-    for tau_set in collection:
-        masses['gen'].append(get_gen_tau_mass(tau_set))
-        masses['rec'].append(get_rec_tau_mass(tau_set))
-
-    return masses
 
-
-def get_gen_tau_energy(tau_set):
-    tau_vector = utils.get_lorentz_vector(tau_set['gen'])
-    neutrino_vector = utils.get_lorentz_vector(tau_set['gen_neutrino'])
-    jet_vector = tau_vector - neutrino_vector
-    energy = jet_vector.E()
-    return energy
-
-
-def get_rec_tau_energy(tau_set):
-    vector = tau_set['rec_vector']
-    energy = vector.E()
-    return energy
-
-
-def get_tau_energies(collection):
-    energies = {
-        'gen': [],
-        'rec': []
+def get_tau_energies(chunk, collection):
+    gen_vectors, rec_vectors = get_tau_vectors(chunk, collection)
+    return {
+        'gen': gen_vectors.energy(),
+        'rec': rec_vectors.energy()
     }
 
-    for tau_set in collection:
-        energies['gen'].append(get_gen_tau_energy(tau_set))
-        energies['rec'].append(get_rec_tau_energy(tau_set))
-
-    return energies
-
 
 def compare_tau_energies(tau_energies):
-    relative = []
-    absolute = []
-
     gen_energies = tau_energies['gen']
     rec_energies = tau_energies['rec']
-
-    for i, gen_energy in enumerate(gen_energies):
-        relative.append(rec_energies[i] / gen_energy)
-        absolute.append(rec_energies[i] - gen_energy)
-
+    relative = rec_energies / gen_energies
+    absolute = rec_energies - gen_energies
     return relative, absolute
 
 
 def compare_parts_energies(tau_energies, parts_energies):
-    relative = []
-    absolute = []
-
     gen_energies = tau_energies['gen']
-
-    for i, parts_energy in enumerate(parts_energies):
-        relative.append(parts_energy / gen_energies[i])
-        absolute.append(parts_energy - gen_energies[i])
-
+    relative = parts_energies / gen_energies
+    absolute = parts_energies - gen_energies
     return relative, absolute
 
 
-def get_jetparts(tree, jet):
-    vectors = []
-    jetparts = tree.jetParts
-    begin = jet.particles_begin
-    end = jet.particles_end
-
-    for jetpart in jetparts[begin:end]:
-        vectors.append(utils.get_lorentz_vector(jetpart))
-
-    return vectors
-
-
-# files
-inf = TFile('data/p8_ee_ZH.root')
-outf = TFile('data/histo_comparison.root', 'RECREATE')
-
-relative_hist1 = TH1D('relative_rec_gen', 'Erec/Egen', 10, 0.75, 1.25)
-relative_hist2 = TH1D('relative_parts_gen', 'Eparts/Egen', 10, 0.75, 1.25)
-absolute_hist1 = TH1D('absolute_rec_gen', 'Erec - Egen', 20, -5, 10)
-absolute_hist2 = TH1D('absolute_parts_gen', 'Eparts - Egen', 20, -5, 10)
-
-# read events
-tree = inf.Get('events')
-n_tot = tree.GetEntries()
-for event in range(n_tot):
-
-    print('===============================')
-    print('===============================')
-
-    tree.GetEntry(event)
-
-    print('Event ', event + 1)
-
-    tau_collection = get_tau_collection(tree)
-
-    if not tau_collection:
-        print('No matches found / No reconstructed tau jets found')
-        continue
+def create_outputs():
+    return {
+        'relative_hist1': new_histogram('relative_rec_gen', 'Erec/Egen', 10, 0.75, 1.25),
+        'relative_hist2': new_histogram('relative_parts_gen', 'Eparts/Egen', 10, 0.75, 1.25),
+        'absolute_hist1': new_histogram('absolute_rec_gen', 'Erec - Egen', 20, -5, 10),
+        'absolute_hist2': new_histogram('absolute_parts_gen', 'Eparts - Egen', 20, -5, 10)
+    }
 
-    print('Chosen generator tau particles:')
-    for tau_set in tau_collection:
-        print('ID ', tau_set['gen'].core.pdgId)
 
-    print('-------------------------------')
+def event_record(chunk, event, tau_collection, tau_energies, constituents, matches):
+    # Dump of an event: the chosen generator taus with the energies of their jets and jet constituents
+    # tau_energies: energies of the tau sets of the event, see get_tau_energies
+    # matches: results of find_tau_matches for this event
+    taus = []
+    for i, tau_set in enumerate(tau_collection):
+        jet = tau_set['rec'].index
+        taus.append({
+            'gen_pdgId': tau_set['gen'].core.pdgId,
+            'gen_energy': tau_energies['gen'][i],
+            'rec_energy': tau_energies['rec'][i],
+            'parts_energies': constituents['parts_energy'][constituents['begin'][jet]:constituents['end'][jet]],
+            'parts_energy': constituents['energy'][jet],
+            'leading_fraction': constituents['leading_fraction'][jet],
+        })
+    return {
+        'file': chunk.path,
+        'entry': event.entry,
+        'taus': taus,
+        # tau-tagged jets without a matching generator tau
+        'unmatched_jets': int(np.sum(matches['gen'] < 0)),
+    }
 
-    tau_energies = get_tau_energies(tau_collection)
 
-    print('Generated tau jet energies:')
-    for energy in tau_energies['gen']:
-        print(energy)
+def process(chunk, outputs, match_cache=None, dump=None):
+    # match_cache: MatchCache reused between runs
+    # dump: event_dump.EventDump of the events to dump
+    # jet matching of the whole chunk
+    if match_cache:
+        parameters = {'tag_threshold': skim.TAG_THRESHOLD, 'cone': matching.CONE_SIZE}
+        matches = match_cache.get(chunk, 'comparison_matches', parameters, find_tau_matches)
+    else:
+        matches = find_tau_matches(chunk)
+    # constituent energies and their sums for all jets of the chunk
+    constituents = constituent_sums(chunk)
+    tau_collections = [get_tau_collection(event, event_fields(matches, event.index)) for event in chunk.events()]
+
+    # energies of the tau sets of all events at once
+    collection = [tau_set for tau_collection in tau_collections for tau_set in tau_collection]
+    tau_energies = get_tau_energies(chunk, collection)
+
+    if dump is not None:
+        start = 0
+        for event, tau_collection in zip(chunk.events(), tau_collections):
+            stop = start + len(tau_collection)
+            if dump.selected(chunk.path, event.entry):
+                event_energies = {key: energies[start:stop] for key, energies in tau_energies.items()}
+                dump.write(event_record(chunk, event, tau_collection, event_energies, constituents,
+                                        event_fields(matches, event.index)))
+            start = stop
 
-    print('-------------------------------')
+    relative, absolute = compare_tau_energies(tau_energies)
 
-    print('Reconstructed tau jet energies:')
-    for energy in tau_energies['rec']:
-        print(energy)
+    outputs['relative_hist1'].fill(relative)
 
-    relative, absolute = compare_tau_energies(tau_energies)
+    outputs['absolute_hist1'].fill(absolute)
 
-    for value in relative:
-        relative_hist1.Fill(value)
+    # energy sums of the constituents of the reconstructed jets
+    jets = np.array([tau_set['rec'].index for tau_set in collection], dtype=np.int64)
+    parts_energies = constituents['energy'][jets]
+    relative2, absolute2 = compare_parts_energies(tau_energies, parts_energies)
 
-    for value in absolute:
-        absolute_hist1.Fill(value)
+    outputs['relative_hist2'].fill(relative2)
 
-    print('-------------------------------')
+    outputs['absolute_hist2'].fill(absolute2)
 
-    parts_energies = []
 
-    for tau_set in tau_collection:
-        jetpart_vectors = get_jetparts(tree, tau_set['rec'])
-        print('Reconstructed jet constituents\' energies:')
+class Analysis:
+    def __init__(self, match_cache=None, dump=None):
+        # This analysis with the options of main, passed to the workers with its process method, see process
+        self.__name__ = __name__
+        self.COLLECTIONS = COLLECTIONS
+        self.INPUT = INPUT
+        self.OUTPUT = OUTPUT
+        self.match_cache = match_cache
+        self.dump = dump
 
-        energy_sum = 0
+    def create_outputs(self):
+        return create_outputs()
 
-        for jetpart in jetpart_vectors:
-            energy = jetpart.E()
-            print(energy)
-            energy_sum += energy
+    def process(self, chunk, outputs):
+        process(chunk, outputs, self.match_cache, self.dump)
 
-        print('Sum of constituents\' energy:')
-        print(energy_sum)
+    def finish(self, outputs):
+        if self.dump is not None:
+            self.dump.close()
 
-        parts_energies.append(energy_sum)
 
-    relative2, absolute2 = compare_parts_energies(tau_energies, parts_energies)
+def main(argv=None):
+    module = sys.modules[__name__]
+    parser = entry.parser(module, 'Compare generator and reconstructed tau energies')
+    parser.add_argument('--match-cache', help='directory caching the jet matching between runs')
+    parser.add_argument('--match-cache-size', type=float, default=1000, help='size limit of the match cache in MB')
+    event_dump.add_arguments(parser)
+    args = parser.parse_args(argv)
+    match_cache = MatchCache(args.match_cache, args.match_cache_size) if args.match_cache else None
+    dump = event_dump.from_arguments(args)
 
-    for value in relative2:
-        relative_hist2.Fill(value)
+    # events are dumped from one process, in the order of the input, the workers take whole blocks of the match cache
+    entry.run(Analysis(match_cache, dump), args, n_workers=1 if dump else None,
+              unit_size=match_cache.block_size if match_cache else None)
 
-    for value in absolute2:
-        absolute_hist2.Fill(value)
 
-# write to file
-outf.Write()
+if __name__ == '__main__':
+    main()
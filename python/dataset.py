@@ -0,0 +1,138 @@
+# Datasets made of many input files given by glob patterns or file-list manifests
+import glob
+import json
+import os
+import uproot
+from reader import EventReader
+
+# Name of the sidecar file caching the number of entries of the files in a directory
+INDEX_NAME = '.entries_index.json'
+
+
+class Dataset:
+    def __init__(self, inputs, tree_name='events'):
+        # inputs: a file path, glob pattern or manifest (.txt, one path or pattern per line), or a list of them
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        self.tree_name = tree_name
+        self.files = []
+        for pattern in inputs:
+            for path in expand(pattern):
+                if path not in self.files:
+                    self.files.append(path)
+        if not self.files:
+            raise FileNotFoundError('No input files found for {}'.format(inputs))
+        self.entries = count_entries(self.files, tree_name)
+
+    def __len__(self):
+        # Return the total number of events in the dataset
+        return sum(self.entries)
+
+    def work_units(self, max_entries=None):
+        # Split the dataset into (path, entry_start, entry_stop) units of at most max_entries events,
+        # units never span several files so a worker only needs to open one file for each
+        units = []
+        for path, n_entries in zip(self.files, self.entries):
+            step = max_entries if max_entries else max(n_entries, 1)
+            for entry_start in range(0, n_entries, step):
+                units.append((path, entry_start, min(entry_start + step, n_entries)))
+        return units
+
+    def readers(self, collections, chunk_size=10000, memory_mb=None):
+        # Iterate over an EventReader for each file, see EventReader for memory_mb
+        for path in self.files:
+            reader = EventReader(path, collections, self.tree_name, chunk_size, memory_mb)
+            yield reader
+            reader.close()
+
+    def chunks(self, collections, chunk_size=10000, memory_mb=None):
+        # Iterate over the chunks of all files in order
+        for reader in self.readers(collections, chunk_size, memory_mb):
+            yield from reader.chunks()
+
+    def events(self, collections, chunk_size=10000, memory_mb=None):
+        # Iterate over the events of all files in order
+        for reader in self.readers(collections, chunk_size, memory_mb):
+            yield from reader.events()
+
+    def chain(self):
+        # Return a TChain of all files for analyses reading with PyROOT
+        from ROOT import TChain
+        chain = TChain(self.tree_name)
+        for path in self.files:
+            chain.Add(path)
+        return chain
+
+    def write_manifest(self, path):
+        # Save the list of files, e.g. for batch jobs
+        with open(path, 'w') as manifest:
+            for file_path in self.files:
+                manifest.write(file_path + '\n')
+
+
+def expand(pattern):
+    # Return the sorted file paths of a glob pattern or the paths listed in a manifest
+    if pattern.endswith('.txt'):
+        return read_manifest(pattern)
+    return sorted(glob.glob(os.path.expanduser(pattern)))
+
+
+def read_manifest(path):
+    # Read a manifest, relative paths are relative to the manifest, '#' starts a comment
+    directory = os.path.dirname(path)
+    files = []
+    with open(path) as manifest:
+        for line in manifest:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            for file_path in expand(os.path.join(directory, line)):
+                files.append(file_path)
+    return files
+
+
+def count_entries(files, tree_name):
+    # Get the number of entries of each file, using the sidecar index where it is up to date
+    indices = {}
+    entries = []
+    for path in files:
+        directory = os.path.dirname(os.path.abspath(path))
+        if directory not in indices:
+            indices[directory] = [load_index(directory), False]
+        index, changed = indices[directory]
+
+        stat = os.stat(path)
+        key = '{}:{}'.format(os.path.basename(path), tree_name)
+        cached = index.get(key)
+        if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+            entries.append(cached['entries'])
+            continue
+
+        with uproot.open(path) as root_file:
+            n_entries = root_file[tree_name].num_entries
+        index[key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'entries': n_entries}
+        indices[directory][1] = True
+        entries.append(n_entries)
+
+    for directory, (index, changed) in indices.items():
+        if changed:
+            save_index(directory, index)
+    return entries
+
+
+def load_index(directory):
+    # Read the sidecar index of a directory
+    try:
+        with open(os.path.join(directory, INDEX_NAME)) as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(directory, index):
+    # Write the sidecar index of a directory, read-only input directories are left without one
+    try:
+        with open(os.path.join(directory, INDEX_NAME), 'w') as index_file:
+            json.dump(index, index_file, indent=1, sort_keys=True)
+    except OSError:
+        pass
@@ -0,0 +1,167 @@
+# Mother-daughter links of generator particles from their start and end vertices
+#
+# The daughters of a particle are the particles starting at its end vertex. They are kept as ranges of
+# one array of particle indices sorted by start vertex, so the daughters of any particle are found in
+# constant time, and quantities over daughters (the tau neutrino, the visible tau) for many particles of
+# a chunk with a few array operations.
+import numpy as np
+from reader import Element, leaf_name
+from vectors import LorentzArray, range_sum
+
+TAU = 15
+TAU_NEUTRINO = 16
+
+# Neutrinos left out of the visible taus, including those of leptonic tau decays
+NEUTRINOS = [12, 14, 16]
+
+# Decay products counted in the decay modes of taus
+ELECTRON = 11
+MUON = 13
+NEUTRAL_PION = 111
+CHARGED_HADRONS = [211, 321]
+
+# Decay modes of leptonic decays and of taus without known decay products, hadronic decays have
+# 5 * (charged hadrons - 1) + neutral pions, e.g. 0 for one charged pion, 1 for rho -> pi pi0, 10 for three prongs
+ELECTRON_MODE = -1
+MUON_MODE = -2
+UNKNOWN_MODE = -3
+
+
+class DecayTree:
+    def __init__(self, pdg_ids, start_vertices, end_vertices, offsets):
+        # start_vertices, end_vertices: event-local vertex index of every particle, negative if it has none
+        # offsets: start of each event in the flat arrays of the particles, followed by their number
+        self.pdg_ids = np.asarray(pdg_ids)
+        events = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        start_vertices = np.asarray(start_vertices, dtype=np.int64)
+        end_vertices = np.asarray(end_vertices, dtype=np.int64)
+
+        # vertex keys unique over the chunk, particles without a vertex get keys that never match
+        n_vertices = max(start_vertices.max(initial=0), end_vertices.max(initial=0)) + 1
+        start_keys = np.where(start_vertices >= 0, events * n_vertices + start_vertices, -1)
+        end_keys = np.where(end_vertices >= 0, events * n_vertices + end_vertices, -2)
+
+        # daughters of particle i are daughters[begin[i]:end[i]]
+        self.daughters = np.argsort(start_keys, kind='stable')
+        sorted_keys = start_keys[self.daughters]
+        self.begin = np.searchsorted(sorted_keys, end_keys, side='left')
+        self.end = np.searchsorted(sorted_keys, end_keys, side='right')
+
+        # mothers of particle i are mothers[mother_begin[i]:mother_end[i]]
+        self.mothers = np.argsort(end_keys, kind='stable')
+        sorted_keys = end_keys[self.mothers]
+        self.mother_begin = np.searchsorted(sorted_keys, start_keys, side='left')
+        self.mother_end = np.searchsorted(sorted_keys, start_keys, side='right')
+
+        # particles with a mother of the same pdgId are copies of it (e.g. after radiation)
+        has_mother = self.mother_end > self.mother_begin
+        mother = np.full(len(start_keys), -1, dtype=np.int64)
+        mother[has_mother] = self.mothers[self.mother_begin[has_mother]]
+        self.is_copy = has_mother & (self.pdg_ids == self.pdg_ids[np.maximum(mother, 0)])
+
+        # tau neutrino of every tau, filled on first use by tau_neutrino
+        self.neutrinos = None
+
+    @classmethod
+    def from_collection(cls, collection):
+        # Decay tree of a reader.Collection of particles
+        return cls(collection['pdgId'], collection['start_vertex'], collection['end_vertex'], collection.offsets)
+
+    def get_daughters(self, particle):
+        # Flat indices of the daughters of a particle
+        return self.daughters[self.begin[particle]:self.end[particle]]
+
+    def get_mothers(self, particle):
+        # Flat indices of the mothers of a particle
+        return self.mothers[self.mother_begin[particle]:self.mother_end[particle]]
+
+    def first_daughter(self, particles, mask):
+        # First daughter passing a mask over all particles for each of the given particles, -1 if none
+        particles = np.asarray(particles, dtype=np.int64)
+        positions = np.flatnonzero(mask[self.daughters])
+        result = np.full(len(particles), -1, dtype=np.int64)
+        if not len(positions):
+            return result
+        found = np.minimum(np.searchsorted(positions, self.begin[particles]), len(positions) - 1)
+        inside = (positions[found] >= self.begin[particles]) & (positions[found] < self.end[particles])
+        result[inside] = self.daughters[positions[found[inside]]]
+        return result
+
+    def last_copies(self, particles):
+        # Follow each particle through its copies to the last one, which decays
+        copies = np.array(particles, dtype=np.int64)
+        active = np.arange(len(copies))
+        while len(active):
+            next_copies = self.first_daughter(copies[active], self.is_copy)
+            moved = next_copies >= 0
+            copies[active[moved]] = next_copies[moved]
+            active = active[moved]
+        return copies
+
+    def tau_neutrinos(self, taus):
+        # Tau neutrino from the decay of each tau (flat indices), -1 if none
+        last = self.last_copies(taus)
+        is_neutrino = np.abs(self.pdg_ids) == TAU_NEUTRINO
+        positive = self.first_daughter(last, is_neutrino & (self.pdg_ids > 0))
+        negative = self.first_daughter(last, is_neutrino & (self.pdg_ids < 0))
+        return np.where(self.pdg_ids[last] > 0, positive, negative)
+
+    def visible_taus(self, taus, vectors):
+        # Visible vector of each tau: the sum over the decay products of its last copy without the neutrinos,
+        # the tau itself if its decay is not known
+        taus = np.asarray(taus, dtype=np.int64)
+        last = self.last_copies(taus)
+        keep = ~np.isin(np.abs(self.pdg_ids), NEUTRINOS)[self.daughters]
+        products = vectors[self.daughters]
+        visible = LorentzArray(*(
+            range_sum(np.where(keep, component, 0), self.begin[last], self.end[last])
+            for component in (products.px, products.py, products.pz, products.e)
+        ))
+        unknown = self.end[last] == self.begin[last]
+        visible[unknown] = vectors[taus[unknown]]
+        return visible
+
+    def decay_modes(self, taus):
+        # Decay mode of each tau from the decay products of its last copy, see ELECTRON_MODE
+        last = self.last_copies(taus)
+        products = np.abs(self.pdg_ids[self.daughters])
+        begin, end = self.begin[last], self.end[last]
+
+        def count(mask):
+            return range_sum(mask, begin, end).astype(np.int64)
+
+        charged = count(np.isin(products, CHARGED_HADRONS))
+        modes = 5 * (charged - 1) + count(products == NEUTRAL_PION)
+        modes[charged == 0] = UNKNOWN_MODE
+        modes[count(products == MUON) > 0] = MUON_MODE
+        modes[count(products == ELECTRON) > 0] = ELECTRON_MODE
+        return modes
+
+
+def has_vertices(chunk, name):
+    # Check whether the input has the vertex links of a particle collection
+    return all(leaf_name(name, field) in chunk.tree for field in ('start_vertex', 'end_vertex'))
+
+
+def get_tree(collection):
+    # Decay tree of a reader.Collection of particles, built once per chunk, None without vertex links
+    if collection.decay_tree is None:
+        has_tree = has_vertices(collection.chunk, collection.name)
+        collection.decay_tree = DecayTree.from_collection(collection) if has_tree else False
+    return collection.decay_tree or None
+
+
+def tau_neutrino(tau):
+    # Tau neutrino from the decay of a tau (reader.Element), None if it is not known or the input has no
+    # vertex links
+    tree = get_tree(tau.collection)
+    if tree is None:
+        return None
+    if tree.neutrinos is None:
+        taus = np.flatnonzero(np.abs(tree.pdg_ids) == TAU)
+        tree.neutrinos = np.full(len(tree.pdg_ids), -1, dtype=np.int64)
+        tree.neutrinos[taus] = tree.tau_neutrinos(taus)
+    index = tree.neutrinos[tau.index]
+    if index < 0:
+        return None
+    return Element(tau.collection, index)
@@ -0,0 +1,104 @@
+# Selection of opposite-charge lepton pairs in chunks of events
+import numpy as np
+from vectors import LorentzArray
+import matching
+
+Z_MASS = 91.1876
+
+# Choice of the pair when an event has several opposite-charge pairs
+# last:   the pair a double loop over i < j keeps last, the original selection of testing_Zmumu.py
+# z_mass: the pair with the invariant mass closest to the Z mass
+# pt_sum: the pair with the highest scalar pT sum
+POLICIES = ['last', 'z_mass', 'pt_sum']
+
+
+def first_per_event(values, events, n_events):
+    # First value of every event from values sorted by event, -1 for events without one
+    position = np.searchsorted(events, np.arange(n_events))
+    found = position < len(events)
+    found[found] = events[position[found]] == np.flatnonzero(found)
+    result = np.full(n_events, -1, dtype=np.int64)
+    result[found] = values[position[found]]
+    return result
+
+
+def last_per_event(values, events, n_events):
+    # Last value of every event from values sorted by event, -1 for events without one
+    position = np.searchsorted(events, np.arange(n_events), side='right') - 1
+    found = position >= 0
+    found[found] = events[position[found]] == np.flatnonzero(found)
+    result = np.full(n_events, -1, dtype=np.int64)
+    result[found] = values[position[found]]
+    return result
+
+
+def find_pairs(vectors, charges, offsets, selected=None, policy='last'):
+    # Choose one opposite-charge pair per event among the selected objects of a chunk
+    # Returns the flat indices of both objects in the order of the collection (-1 if there is no pair)
+    # and the invariant mass of the pair (NaN if there is none)
+    n_events = len(offsets) - 1
+    events = np.repeat(np.arange(n_events), np.diff(offsets))
+    candidates = np.flatnonzero(charges != 0 if selected is None else selected & (charges != 0))
+    positive = candidates[charges[candidates] > 0]
+    negative = candidates[charges[candidates] < 0]
+    index1 = np.full(n_events, -1, dtype=np.int64)
+    index2 = np.full(n_events, -1, dtype=np.int64)
+
+    if policy == 'last':
+        # the last object of the opposite charge is the partner found last by the inner loop,
+        # the outer loop keeps the last object that is followed by such a partner
+        last_positive = last_per_event(positive, events[positive], n_events)
+        last_negative = last_per_event(negative, events[negative], n_events)
+        candidate_events = events[candidates]
+        partners = np.where(charges[candidates] > 0, last_negative[candidate_events], last_positive[candidate_events])
+        followed = partners > candidates
+        index1 = last_per_event(candidates[followed], candidate_events[followed], n_events)
+        index2 = last_per_event(partners[followed], candidate_events[followed], n_events)
+    elif policy == 'pt_sum':
+        # the highest pT object of each charge
+        pt = vectors.pt()
+        best = []
+        for objects in (positive, negative):
+            objects = objects[np.lexsort((-pt[objects], events[objects]))]
+            best.append(first_per_event(objects, events[objects], n_events))
+        has_pair = (best[0] >= 0) & (best[1] >= 0)
+        index1[has_pair] = np.minimum(best[0], best[1])[has_pair]
+        index2[has_pair] = np.maximum(best[0], best[1])[has_pair]
+    elif policy == 'z_mass':
+        # all pairs of a positive and a negative object, the number of pairs only grows with the
+        # product of the selected objects of each charge in an event
+        positive_offsets = np.searchsorted(events[positive], np.arange(n_events + 1))
+        negative_offsets = np.searchsorted(events[negative], np.arange(n_events + 1))
+        pairs1, pairs2, _ = matching.pair_indices(positive_offsets, negative_offsets)
+        pairs1 = positive[pairs1]
+        pairs2 = negative[pairs2]
+        distance = np.abs((vectors[pairs1] + vectors[pairs2]).m() - Z_MASS)
+        pair_events = events[pairs1]
+        order = np.lexsort((distance, pair_events))
+        best = first_per_event(order, pair_events[order], n_events)
+        has_pair = best >= 0
+        best = best[has_pair]
+        index1[has_pair] = np.minimum(pairs1[best], pairs2[best])
+        index2[has_pair] = np.maximum(pairs1[best], pairs2[best])
+    else:
+        raise ValueError('Unknown pair policy: {}'.format(policy))
+
+    masses = np.full(n_events, np.nan)
+    has_pair = index1 >= 0
+    masses[has_pair] = (vectors[index1[has_pair]] + vectors[index2[has_pair]]).m()
+    return index1, index2, masses
+
+
+def select_muons(vectors, isolation_tags, pt_min=15, isolation_max=0.4):
+    # Muons with pT above pt_min and an isolation tag below isolation_max
+    return (vectors.pt() > pt_min) & (isolation_tags < isolation_max)
+
+
+def muon_pairs(chunk, policy='last', pt_min=15, isolation_max=0.4, apply_cuts=True):
+    # Opposite-charge muon pair of every event of a chunk, see find_pairs
+    muons = chunk['muons']
+    vectors = LorentzArray.from_collection(muons)
+    selected = None
+    if apply_cuts:
+        selected = select_muons(vectors, chunk['muonITags']['tag'], pt_min, isolation_max)
+    return find_pairs(vectors, muons['charge'], muons.offsets, selected, policy)
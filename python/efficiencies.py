@@ -0,0 +1,76 @@
+# Efficiencies and fake rates binned in many variables, filled in one pass over the candidates
+#
+# An analysis declares the binned variables of a set of efficiencies once, each as one or two
+# (column, edges) pairs, e.g. the efficiency in eta and in pT x eta:
+#   create('efficiency', 'efficiency', {
+#       'eta': [('eta', uniform(20, -3, 3))],
+#       'pt_eta': [('pt', [0, 20, 40, 130]), ('eta', [-3, 0, 3])],
+#   })
+# and fills all of them from the same arrays of decisions and columns of values with fill. The bins of each
+# column are looked up once per fill for all efficiencies using the same edges, and counted with bincount.
+# The efficiencies are histograms.BinnedEfficiency objects: added up across worker processes, saved to .npz
+# files with --numpy and written as TEfficiency otherwise. table gives their Clopper-Pearson intervals
+# directly from the counts.
+import numpy as np
+from histograms import BinnedEfficiency, ONE_SIGMA, find_bins
+
+
+def uniform(n_bins, low, high):
+    # Edges of n_bins bins of equal width between low and high
+    return np.linspace(low, high, n_bins + 1)
+
+
+def integers(low, high):
+    # Edges of a bin for every integer from low to high, e.g. decay modes or numbers of constituents
+    return np.arange(low, high + 2) - 0.5
+
+
+def create(name, title, declarations):
+    # Dictionary of BinnedEfficiency objects named name_key, for each key of declarations with its
+    # list of one or two (column, edges) pairs
+    efficiencies = {}
+    for key, axes in declarations.items():
+        variables = [variable for variable, edges in axes]
+        title_key = '{} ({})'.format(title, ' x '.join(variables))
+        efficiencies[key] = BinnedEfficiency('{}_{}'.format(name, key), title_key, variables,
+                                             [edges for variable, edges in axes])
+    return efficiencies
+
+
+def fill(efficiencies, passed, columns):
+    # Fill a dictionary of efficiencies from an array of decisions and a dictionary of columns of values
+    bins = {}
+    for efficiency in efficiencies.values():
+        axis_bins = []
+        for variable, edges in zip(efficiency.variables, efficiency.edges):
+            key = (variable, edges.tobytes())
+            if key not in bins:
+                values = np.asarray(columns[variable], dtype=np.float64)
+                bins[key] = find_bins(values, len(edges) - 1, edges[0], edges[-1], edges)
+            axis_bins.append(bins[key])
+        efficiency.fill(passed, columns, axis_bins)
+
+
+def table(efficiency, level=ONE_SIGMA):
+    # Rows of a one-dimensional efficiency with its Clopper-Pearson interval: low and high edge of the bin,
+    # passed and total counts, efficiency, lower and upper bound, for the bins inside the axis range
+    edges = efficiency.edges[0]
+    lower, upper = efficiency.interval(level)
+    values = efficiency.efficiency()
+    rows = []
+    for i in range(1, len(edges)):
+        rows.append((edges[i - 1], edges[i], int(efficiency.passed[i]), int(efficiency.total[i]), values[i],
+                     lower[i], upper[i]))
+    return rows
+
+
+def print_tables(efficiencies, level=ONE_SIGMA):
+    # Print the one-dimensional efficiencies of a dictionary with their intervals, skipping empty bins
+    for efficiency in efficiencies.values():
+        if len(efficiency.variables) != 1:
+            continue
+        print('{} ({:.3g}% CL, Clopper-Pearson):'.format(efficiency.name, 100 * level))
+        for low, high, passed, total, value, lower, upper in table(efficiency, level):
+            if total:
+                print('  [{:g}, {:g}): {}/{} = {:.4f} [{:.4f}, {:.4f}]'.format(
+                    low, high, passed, total, value, lower, upper))
@@ -0,0 +1,116 @@
+# Command line entry points of the analysis scripts
+#
+# Every analysis script has a main(argv=None) running it with the arguments made by parser. ROOT is only
+# imported when the first ROOT object is made, so --help, --numpy runs and importing a script from
+# another module do not pay for the PyROOT startup. --startup-time prints where the time before the
+# first processed event goes and stops there.
+import argparse
+import contextlib
+import io
+import os
+import time
+from dataset import Dataset
+from scheduler import Scheduler
+import histograms
+import profiling
+import reader
+
+
+def parser(module, description):
+    # Argument parser with the options common to all analysis scripts
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('inputs', nargs='*', default=[module.INPUT],
+                        help='input files, glob patterns or manifests ({} by default)'.format(module.INPUT))
+    parser.add_argument('-o', '--output', default=module.OUTPUT, help='output file')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='number of worker processes (1 by default)')
+    parser.add_argument('--numpy', action='store_true',
+                        help='fill NumPy histograms and save them next to the output as .npz, see histograms.py')
+    parser.add_argument('--startup-time', action='store_true',
+                        help='print the time spent before the first processed event and exit')
+    parser.add_argument('--memory', type=float,
+                        help='size the chunks of events to take about this many MB in memory')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='read the next chunk while the current one is processed')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='print the peak resident memory of every chunk')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time spent in the stages of the analysis at the end')
+    parser.add_argument('--profile-dump', metavar='FILE',
+                        help='profile the run with cProfile and write the statistics to FILE')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only process the inputs not yet in the output and add them, see incremental.py')
+    parser.add_argument('--checkpoint-interval', type=float,
+                        help='seconds between the checkpoints of an incremental run')
+    return parser
+
+
+def run(module, args, n_workers=None, unit_size=None):
+    # Run an analysis module with the parsed arguments, returns its outputs
+    # unit_size: see parallel.run, e.g. the block size of a match cache
+    histograms.NUMPY = args.numpy
+    reader.PREFETCH = args.prefetch
+    reader.MEMORY_REPORT = args.memory_report
+    if args.startup_time:
+        print_startup_time(module, args.inputs, root=not args.numpy)
+        return None
+    profiling.ENABLED = args.profile
+    profiling.PROFILE = args.profile_dump
+    profiling.start()
+    scheduler = Scheduler()
+    scheduler.register(module, args.output)
+    outputs = scheduler.run(args.inputs, n_workers or args.workers, memory_mb=args.memory,
+                            incremental_run=args.incremental,
+                            checkpoint_interval=args.checkpoint_interval, unit_size=unit_size)[module.__name__]
+    profiling.finish()
+    return outputs
+
+
+def process_age():
+    # Seconds since the start of the current process, None where /proc is not available
+    try:
+        with open('/proc/self/stat') as stat_file:
+            # the fields after the command name, which is in parentheses and can contain spaces
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def print_startup_time(module, inputs, root=True):
+    # Time the steps of an analysis up to its first processed event
+    steps = [('interpreter, imports and arguments', process_age())]
+    start = time.perf_counter()
+
+    def step(name):
+        nonlocal start
+        now = time.perf_counter()
+        steps.append((name, now - start))
+        start = now
+
+    if root:
+        try:
+            import ROOT
+            # the first access to a ROOT class starts the interpreter of ROOT
+            ROOT.TFile
+            step('ROOT import')
+        except ImportError:
+            # the rest of the startup is timed as with --numpy
+            print('ROOT is not available, timing the startup with NumPy histograms as with --numpy')
+            histograms.NUMPY = True
+            start = time.perf_counter()
+    outputs = module.create_outputs()
+    step('create outputs')
+    dataset = Dataset(inputs)
+    step('open inputs')
+    chunk = next(dataset.chunks(module.COLLECTIONS, chunk_size=1))
+    step('read first event')
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.process(chunk, outputs)
+    step('process first event')
+
+    for name, seconds in steps:
+        print('{:40} {}'.format(name, 'unknown' if seconds is None else '{:8.3f} s'.format(seconds)))
+    total = sum(seconds for name, seconds in steps if seconds is not None)
+    print('{:40} {:8.3f} s'.format('total', total))
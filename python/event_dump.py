@@ -0,0 +1,69 @@
+# Dumps of selected events to a JSON lines file, for debugging the analyses
+#
+# An analysis checks EventDump.selected for each event and only builds the record of the selected
+# ones, a dictionary written as one line of JSON. Events are selected by their entry in the input file:
+# every Nth entry, a random fraction (the same entries in every run with the same seed) and/or a list
+# of entries, and all events if none of these is given. Nothing is dumped without --dump:
+#   python python/comparison_Htautau.py --dump data/comparison_dump.jsonl --dump-every 1000
+#   python python/comparison_Htautau.py --dump data/comparison_dump.jsonl --dump-events 17 42
+import json
+import zlib
+
+# Size of the write buffer of the dump file in bytes
+BUFFER_SIZE = 1 << 20
+
+
+class EventDump:
+    def __init__(self, path, every=None, fraction=None, events=None, seed=0):
+        # Dump file at path, selecting every Nth entry, a random fraction of the entries or the given entries
+        self.path = path
+        self.every = every
+        self.fraction = fraction
+        self.events = set(events) if events else None
+        self.seed = seed
+        self.n_records = 0
+        self.file = open(path, 'w', buffering=BUFFER_SIZE)
+
+    def selected(self, input_path, entry):
+        # Whether the event at entry of an input file is dumped
+        if self.events is not None and entry not in self.events:
+            return False
+        if self.every is not None and entry % self.every:
+            return False
+        if self.fraction is not None:
+            # a hash of the event instead of a random generator, so the selection does not depend on the chunks
+            key = '{}:{}:{}'.format(self.seed, input_path, entry).encode()
+            return zlib.crc32(key) < self.fraction * 2 ** 32
+        return True
+
+    def write(self, record):
+        # Add the record of a selected event
+        self.file.write(json.dumps(record, default=plain) + '\n')
+        self.n_records += 1
+
+    def close(self):
+        self.file.close()
+        print('{} events dumped to {}'.format(self.n_records, self.path))
+
+
+def plain(value):
+    # JSON value of a NumPy number or array
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError('Cannot dump {!r}'.format(value))
+
+
+def add_arguments(parser):
+    # Add the options of the event dump to the argument parser of an analysis
+    parser.add_argument('--dump', metavar='FILE', help='write selected events to FILE as JSON lines')
+    parser.add_argument('--dump-every', type=int, metavar='N', help='dump every Nth entry of the input files')
+    parser.add_argument('--dump-fraction', type=float, help='dump a random fraction of the events')
+    parser.add_argument('--dump-events', type=int, nargs='+', metavar='ENTRY', help='dump the events at these entries')
+    parser.add_argument('--dump-seed', type=int, default=0, help='seed of the random selection of --dump-fraction')
+
+
+def from_arguments(args):
+    # EventDump of the parsed arguments, None without --dump
+    if not args.dump:
+        return None
+    return EventDump(args.dump, args.dump_every, args.dump_fraction, args.dump_events, args.dump_seed)
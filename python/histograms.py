@@ -0,0 +1,612 @@
+# Buffered filling of ROOT histograms and efficiencies, and NumPy histograms exported to ROOT
+#
+# Values are collected in NumPy buffers and handed to ROOT in one call per flush instead of one Fill
+# call per value. Flushing with TH1::FillN goes through the same bin lookup and statistics as Fill,
+# so the histograms are identical to filling them value by value.
+#
+# With NUMPY set, new_histogram and new_efficiency make Histogram and Efficiency accumulators instead,
+# which do not need ROOT. Their fills in worker processes are replayed in order (see parallel.py), they are
+# saved to a .npz file, added up across files and converted to TH1D and TEfficiency objects afterwards:
+#   python python/histograms.py data/histo_deltaR.npz
+#
+# BinnedEfficiency counts an efficiency in one or two variables with any bins in NumPy arrays in both modes,
+# it is written as TEfficiency at the end (see efficiencies.py).
+import argparse
+import os
+import numpy as np
+
+# Number of buffered values after which a buffer is flushed
+BUFFER_SIZE = 1000000
+
+# Make NumPy accumulators instead of ROOT histograms in new_histogram and new_efficiency
+NUMPY = False
+
+# Confidence level of the efficiency intervals, the default of TEfficiency
+ONE_SIGMA = 0.682689492137
+
+
+class Buffer:
+    def __init__(self, n_columns):
+        # Columns of buffered values, single values are collected in lists until arrays are added
+        self.n_columns = n_columns
+        self.arrays = []
+        self.values = []
+        self.size = 0
+
+    def append(self, row):
+        self.values.append(row)
+        self.size += 1
+
+    def extend(self, columns):
+        self.close_values()
+        columns = [np.asarray(column, dtype=np.float64).ravel() for column in columns]
+        self.arrays.append(columns)
+        self.size += len(columns[0])
+
+    def close_values(self):
+        # move the single values into an array, keeping the order of all values
+        if self.values:
+            self.arrays.append([np.array(column, dtype=np.float64) for column in zip(*self.values)])
+            self.values = []
+
+    def take(self):
+        # Return the buffered columns and empty the buffer
+        self.close_values()
+        if self.arrays:
+            columns = [np.concatenate([arrays[i] for arrays in self.arrays]) for i in range(self.n_columns)]
+        else:
+            columns = [np.empty(0) for i in range(self.n_columns)]
+        self.arrays = []
+        self.size = 0
+        return columns
+
+
+class BufferedHistogram:
+    def __init__(self, histogram, buffer_size=BUFFER_SIZE, method='filln'):
+        # Wrap a one-dimensional ROOT histogram
+        # method: 'filln' flushes with TH1::FillN, 'numpy' bins the values with NumPy and adds the bin contents
+        # (same contents, the statistics are summed in a different order)
+        self.histogram = histogram
+        self.buffer_size = buffer_size
+        self.method = method
+        self.buffer = Buffer(2)
+        self.weighted = False
+
+    def Fill(self, value, weight=None):
+        # Buffer a single value, as TH1::Fill
+        if weight is not None:
+            self.weighted = True
+        self.buffer.append((value, 1.0 if weight is None else weight))
+        if self.buffer.size >= self.buffer_size:
+            self.flush()
+
+    def fill(self, values, weights=None):
+        # Buffer an array of values
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if weights is None:
+            weights = np.ones(len(values))
+        else:
+            self.weighted = True
+        self.buffer.extend([values, weights])
+        if self.buffer.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        # Fill the buffered values into the histogram
+        if not self.buffer.size:
+            return
+        values, weights = self.buffer.take()
+        if self.method == 'numpy':
+            add_bin_contents(self.histogram, values, weights if self.weighted else None)
+        else:
+            from ROOT import nullptr
+            self.histogram.FillN(len(values), values, weights if self.weighted else nullptr)
+
+    def __getattr__(self, name):
+        # Other methods are those of the histogram, with all values filled
+        if name.startswith('__') or name in ('buffer', 'histogram'):
+            raise AttributeError(name)
+        self.flush()
+        return getattr(self.histogram, name)
+
+
+class BufferedEfficiency:
+    def __init__(self, efficiency, buffer_size=BUFFER_SIZE):
+        # Wrap a one-dimensional TEfficiency
+        self.efficiency = efficiency
+        self.buffer_size = buffer_size
+        self.buffer = Buffer(2)
+
+    def Fill(self, passed, value):
+        # Buffer a single event, as TEfficiency::Fill
+        self.buffer.append((bool(passed), value))
+        if self.buffer.size >= self.buffer_size:
+            self.flush()
+
+    def fill(self, passed, values):
+        # Buffer arrays of decisions and values
+        self.buffer.extend([np.asarray(passed, dtype=bool), values])
+        if self.buffer.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        # Fill the buffered events into the total and passed histograms of the efficiency
+        if not self.buffer.size:
+            return
+        from ROOT import nullptr
+        passed, values = self.buffer.take()
+        passed_values = np.ascontiguousarray(values[passed != 0])
+        # the histograms of the efficiency are filled in place, as TEfficiency::Fill does, without copies
+        self.efficiency.GetTotalHistogram().FillN(len(values), values, nullptr)
+        self.efficiency.GetPassedHistogram().FillN(len(passed_values), passed_values, nullptr)
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in ('buffer', 'efficiency'):
+            raise AttributeError(name)
+        self.flush()
+        return getattr(self.efficiency, name)
+
+
+class Histogram:
+    def __init__(self, name, title, n_bins, low, high):
+        # One-dimensional histogram with fixed bins as TH1D, bin 0 is the underflow and n_bins + 1 the overflow
+        self.name = name
+        self.title = title
+        self.n_bins = n_bins
+        self.low = low
+        self.high = high
+        self.contents = np.zeros(n_bins + 2)
+        self.sumw2 = np.zeros(n_bins + 2)
+        # sum of weights, of squared weights, of weight * x and of weight * x^2 inside the axis range
+        self.stats = np.zeros(4)
+        self.entries = 0
+        self.weighted = False
+        self.buffer = Buffer(2)
+
+    def Fill(self, value, weight=None):
+        # Buffer a single value, as TH1::Fill
+        if weight is not None:
+            self.weighted = True
+        self.buffer.append((value, 1.0 if weight is None else weight))
+        if self.buffer.size >= BUFFER_SIZE:
+            self.flush()
+
+    def fill(self, values, weights=None):
+        # Add an array of values
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if weights is None:
+            weights = np.ones(len(values))
+        else:
+            self.weighted = True
+        self.buffer.extend([values, weights])
+        if self.buffer.size >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        # Add the buffered values to the bins
+        if not self.buffer.size:
+            return
+        values, weights = self.buffer.take()
+        bins = find_bins(values, self.n_bins, self.low, self.high)
+        self.contents += np.bincount(bins, weights, minlength=self.n_bins + 2)
+        self.sumw2 += np.bincount(bins, weights ** 2, minlength=self.n_bins + 2)
+        self.stats += bin_stats(values, weights, bins, self.n_bins)
+        self.entries += len(values)
+
+    def empty(self):
+        # Histogram with the same binning and no entries
+        return Histogram(self.name, self.title, self.n_bins, self.low, self.high)
+
+    def add(self, other):
+        # Add a histogram with the same binning to this one
+        self.flush()
+        other.flush()
+        if (self.n_bins, self.low, self.high) != (other.n_bins, other.low, other.high):
+            raise ValueError('Histograms with different binning: {}, {}'.format(self.name, other.name))
+        self.contents = self.contents + other.contents
+        self.sumw2 = self.sumw2 + other.sumw2
+        self.stats = self.stats + other.stats
+        self.entries = self.entries + other.entries
+        self.weighted = self.weighted or other.weighted
+
+    def __add__(self, other):
+        # Sum of two histograms with the same binning
+        result = self.empty()
+        result.add(self)
+        result.add(other)
+        return result
+
+    def arrays(self):
+        # Contents of the histogram as arrays, see save
+        self.flush()
+        return {
+            'binning': np.array([self.n_bins, self.low, self.high]),
+            'contents': self.contents,
+            'sumw2': self.sumw2,
+            'stats': self.stats,
+            'entries': np.array([self.entries, self.weighted]),
+        }
+
+    @classmethod
+    def from_arrays(cls, name, title, arrays):
+        n_bins, low, high = arrays['binning']
+        histogram = cls(name, title, int(n_bins), low, high)
+        histogram.contents = arrays['contents']
+        histogram.sumw2 = arrays['sumw2']
+        histogram.stats = arrays['stats']
+        histogram.entries = int(arrays['entries'][0])
+        histogram.weighted = bool(arrays['entries'][1])
+        return histogram
+
+    def to_root(self):
+        # TH1D with the same contents, created in the current ROOT directory
+        from ROOT import TH1D
+        self.flush()
+        histogram = TH1D(self.name, self.title, self.n_bins, self.low, self.high)
+        if self.weighted:
+            histogram.Sumw2()
+        for i in range(self.n_bins + 2):
+            histogram.SetBinContent(i, self.contents[i])
+            if self.weighted:
+                histogram.SetBinError(i, np.sqrt(self.sumw2[i]))
+        # setting the contents resets the statistics
+        histogram.PutStats(np.array(self.stats))
+        histogram.SetEntries(self.entries)
+        return histogram
+
+
+class Efficiency:
+    def __init__(self, name, title, n_bins, low, high):
+        # Efficiency as TEfficiency, from the histograms of all and of the passed events
+        self.name = name
+        self.title = title
+        self.total = Histogram(name + '_total', title, n_bins, low, high)
+        self.passed = Histogram(name + '_passed', title, n_bins, low, high)
+        self.buffer = Buffer(2)
+
+    def Fill(self, passed, value):
+        # Buffer a single event, as TEfficiency::Fill
+        self.buffer.append((bool(passed), value))
+        if self.buffer.size >= BUFFER_SIZE:
+            self.flush()
+
+    def fill(self, passed, values):
+        # Add arrays of decisions and values
+        self.buffer.extend([np.asarray(passed, dtype=bool), values])
+        if self.buffer.size >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer.size:
+            return
+        passed, values = self.buffer.take()
+        self.total.fill(values)
+        self.passed.fill(values[passed != 0])
+        self.total.flush()
+        self.passed.flush()
+
+    def empty(self):
+        return Efficiency(self.name, self.title, self.total.n_bins, self.total.low, self.total.high)
+
+    def add(self, other):
+        self.flush()
+        other.flush()
+        self.total.add(other.total)
+        self.passed.add(other.passed)
+
+    def __add__(self, other):
+        result = self.empty()
+        result.add(self)
+        result.add(other)
+        return result
+
+    def arrays(self):
+        self.flush()
+        arrays = {}
+        for prefix, histogram in (('total_', self.total), ('passed_', self.passed)):
+            for key, array in histogram.arrays().items():
+                arrays[prefix + key] = array
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, name, title, arrays):
+        efficiency = cls(name, title, 1, 0, 1)
+        for prefix in ('total_', 'passed_'):
+            part = {key[len(prefix):]: array for key, array in arrays.items() if key.startswith(prefix)}
+            histogram = Histogram.from_arrays(name + '_' + prefix[:-1], title, part)
+            setattr(efficiency, prefix[:-1], histogram)
+        return efficiency
+
+    def to_root(self):
+        # TEfficiency with the same contents, created in the current ROOT directory
+        from ROOT import TEfficiency, nullptr
+        self.flush()
+        efficiency = TEfficiency(self.name, self.title, self.total.n_bins, self.total.low, self.total.high)
+        total = self.total.to_root()
+        passed = self.passed.to_root()
+        total.SetDirectory(nullptr)
+        passed.SetDirectory(nullptr)
+        efficiency.SetTotalHistogram(total, 'f')
+        efficiency.SetPassedHistogram(passed, 'f')
+        return efficiency
+
+
+class BinnedEfficiency:
+    def __init__(self, name, title, variables, edges):
+        # Efficiency in one or two variables with any bin edges, counted in integer arrays with or without ROOT
+        # variables: names of the columns the efficiency is filled from, edges: bin edges of each of them
+        # The counts are kept for the global bins of ROOT, with the underflow and overflow bins of every axis
+        self.name = name
+        self.title = title
+        self.variables = list(variables)
+        self.edges = [np.asarray(axis_edges, dtype=np.float64) for axis_edges in edges]
+        self.shape = [len(axis_edges) + 1 for axis_edges in self.edges]
+        self.total = np.zeros(int(np.prod(self.shape)), dtype=np.int64)
+        self.passed = np.zeros(int(np.prod(self.shape)), dtype=np.int64)
+
+    def find_bins(self, columns):
+        # Bin numbers on each axis of the values of a dictionary of columns
+        return [find_bins(np.asarray(columns[variable], dtype=np.float64), len(axis_edges) - 1, axis_edges[0],
+                          axis_edges[-1], axis_edges) for variable, axis_edges in zip(self.variables, self.edges)]
+
+    def fill(self, passed, columns, bins=None):
+        # Add arrays of decisions and the values of the variables in a dictionary of columns
+        # bins: bin numbers on each axis if already known, see find_bins
+        if bins is None:
+            bins = self.find_bins(columns)
+        global_bins = bins[0]
+        if len(bins) > 1:
+            global_bins = global_bins + self.shape[0] * bins[1]
+        passed = np.asarray(passed, dtype=bool)
+        self.total += np.bincount(global_bins, minlength=len(self.total))
+        self.passed += np.bincount(global_bins[passed], minlength=len(self.passed))
+
+    def empty(self):
+        return BinnedEfficiency(self.name, self.title, self.variables, self.edges)
+
+    def add(self, other):
+        if self.variables != other.variables or not all(
+                np.array_equal(a, b) for a, b in zip(self.edges, other.edges)):
+            raise ValueError('Efficiencies with different binning: {}, {}'.format(self.name, other.name))
+        self.total = self.total + other.total
+        self.passed = self.passed + other.passed
+
+    def __add__(self, other):
+        result = self.empty()
+        result.add(self)
+        result.add(other)
+        return result
+
+    def efficiency(self):
+        # Efficiency in every global bin, 0 in bins without entries
+        return np.where(self.total > 0, self.passed / np.maximum(self.total, 1), 0)
+
+    def interval(self, level=ONE_SIGMA):
+        # Lower and upper bounds of the Clopper-Pearson interval in every global bin
+        return clopper_pearson(self.passed, self.total, level)
+
+    def arrays(self):
+        arrays = {'variables': np.array(self.variables, dtype=str), 'total': self.total, 'passed': self.passed}
+        for i, axis_edges in enumerate(self.edges):
+            arrays['edges_{}'.format(i)] = axis_edges
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, name, title, arrays):
+        variables = [str(variable) for variable in arrays['variables']]
+        edges = [arrays['edges_{}'.format(i)] for i in range(len(variables))]
+        efficiency = cls(name, title, variables, edges)
+        efficiency.total = arrays['total']
+        efficiency.passed = arrays['passed']
+        return efficiency
+
+    def to_root(self):
+        # TEfficiency with the same contents, created in the current ROOT directory
+        from ROOT import TEfficiency
+        edges = [np.ascontiguousarray(axis_edges) for axis_edges in self.edges]
+        if len(edges) == 1:
+            efficiency = TEfficiency(self.name, self.title, len(edges[0]) - 1, edges[0])
+        else:
+            efficiency = TEfficiency(self.name, self.title, len(edges[0]) - 1, edges[0], len(edges[1]) - 1, edges[1])
+        # the histograms of the efficiency are set in place
+        total = efficiency.GetTotalHistogram()
+        passed = efficiency.GetPassedHistogram()
+        for i in np.flatnonzero(self.total):
+            total.SetBinContent(int(i), float(self.total[i]))
+            passed.SetBinContent(int(i), float(self.passed[i]))
+        total.SetEntries(float(self.total.sum()))
+        passed.SetEntries(float(self.passed.sum()))
+        return efficiency
+
+    def add_root(self, efficiency):
+        # Add the counts of a TEfficiency with the same binning, e.g. one written by to_root
+        total = efficiency.GetTotalHistogram()
+        passed = efficiency.GetPassedHistogram()
+        if total.GetNcells() != len(self.total):
+            raise ValueError('Efficiencies with different binning: {}, {}'.format(self.name, efficiency.GetName()))
+        self.total = self.total + np.array([total.GetBinContent(i) for i in range(len(self.total))], dtype=np.int64)
+        self.passed = self.passed + np.array([passed.GetBinContent(i) for i in range(len(self.passed))],
+                                             dtype=np.int64)
+
+
+def clopper_pearson(passed, total, level=ONE_SIGMA):
+    # Clopper-Pearson interval of the efficiencies passed / total for arrays of counts, as
+    # TEfficiency::ClopperPearson: (0, 1) without entries
+    from scipy.stats import beta
+    passed = np.asarray(passed, dtype=np.float64)
+    total = np.asarray(total, dtype=np.float64)
+    alpha = (1 - level) / 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lower = np.where(passed > 0, beta.ppf(alpha, passed, total - passed + 1), 0)
+        upper = np.where(passed < total, beta.ppf(1 - alpha, passed + 1, total - passed), 1)
+    return lower, upper
+
+
+def new_histogram(name, title, n_bins, low, high):
+    # Histogram for the outputs of an analysis, a buffered TH1D or a NumPy Histogram if NUMPY is set
+    if NUMPY:
+        return Histogram(name, title, n_bins, low, high)
+    from ROOT import TH1D
+    return BufferedHistogram(TH1D(name, title, n_bins, low, high))
+
+
+def new_efficiency(name, title, n_bins, low, high):
+    # Efficiency for the outputs of an analysis, a buffered TEfficiency or a NumPy Efficiency if NUMPY is set
+    if NUMPY:
+        return Efficiency(name, title, n_bins, low, high)
+    from ROOT import TEfficiency
+    return BufferedEfficiency(TEfficiency(name, title, n_bins, low, high))
+
+
+def find_bins(values, n_bins, low, high, edges=None):
+    # Bin numbers of values in the same way as TAxis::FindFixBin, 0 is the underflow and n + 1 the overflow
+    # NaN is not below the upper edge, so it goes to the overflow as in ROOT
+    if edges is not None:
+        bins = np.searchsorted(edges, values, side='right')
+    else:
+        inside = (values >= low) & (values < high)
+        bins = np.zeros(len(values), dtype=np.int64)
+        bins[inside] = 1 + (n_bins * (values[inside] - low) / (high - low)).astype(np.int64)
+    bins = np.where(values < low, 0, np.where(~(values < high), n_bins + 1, bins))
+    return bins
+
+
+def bin_stats(values, weights, bins, n_bins):
+    # Sums of the statistics of TH1 over the values inside the axis range
+    inside = (bins > 0) & (bins <= n_bins)
+    w = weights[inside]
+    x = values[inside]
+    return np.array([w.sum(), (w ** 2).sum(), (w * x).sum(), (w * x * x).sum()])
+
+
+def add_bin_contents(histogram, values, weights=None):
+    # Add values to a histogram by bin counts, updating the statistics and errors as TH1::Fill does
+    axis = histogram.GetXaxis()
+    n_bins = axis.GetNbins()
+    edges = None
+    if axis.GetXbins().GetSize():
+        edges = np.array([axis.GetXbins().At(i) for i in range(n_bins + 1)])
+    bins = find_bins(values, n_bins, axis.GetXmin(), axis.GetXmax(), edges)
+    if weights is None:
+        weights = np.ones(len(values))
+    if (weights != 1).any() and histogram.GetSumw2N() == 0:
+        histogram.Sumw2()
+    contents = np.bincount(bins, weights, minlength=n_bins + 2)
+    squares = np.bincount(bins, weights ** 2, minlength=n_bins + 2)
+    sumw2 = histogram.GetSumw2()
+    for i in np.flatnonzero(contents != 0):
+        histogram.AddBinContent(int(i), contents[i])
+        if histogram.GetSumw2N():
+            sumw2[int(i)] += squares[i]
+
+    # statistics use the values inside the axis range
+    import ctypes
+    stats = (ctypes.c_double * 4)()
+    histogram.GetStats(stats)
+    for i, value in enumerate(bin_stats(values, weights, bins, n_bins)):
+        stats[i] += value
+    entries = histogram.GetEntries() + len(values)
+    histogram.PutStats(stats)
+    histogram.SetEntries(entries)
+
+
+def flush(outputs):
+    # Flush all buffered histograms and efficiencies of an output structure
+    if hasattr(outputs, 'buffer') and hasattr(outputs, 'flush'):
+        outputs.flush()
+    elif isinstance(outputs, list):
+        for obj in outputs:
+            flush(obj)
+    elif isinstance(outputs, dict):
+        for obj in outputs.values():
+            flush(obj)
+
+
+def accumulators(outputs):
+    # All Histogram, Efficiency and BinnedEfficiency objects of an output structure
+    if isinstance(outputs, (Histogram, Efficiency, BinnedEfficiency)):
+        return [outputs]
+    objects = []
+    if isinstance(outputs, dict):
+        outputs = list(outputs.values())
+    if isinstance(outputs, list):
+        for obj in outputs:
+            objects += accumulators(obj)
+    return objects
+
+
+def numpy_path(output):
+    # File of the NumPy accumulators of an analysis writing to output
+    return os.path.splitext(output)[0] + '.npz'
+
+
+def root_objects(outputs):
+    # All ROOT histograms and efficiencies of an output structure, with the buffered values filled
+    if isinstance(outputs, (BufferedHistogram, BufferedEfficiency)):
+        outputs.flush()
+        return [outputs.histogram if isinstance(outputs, BufferedHistogram) else outputs.efficiency]
+    if hasattr(outputs, 'Fill') and hasattr(outputs, 'GetName'):
+        return [outputs]
+    objects = []
+    if isinstance(outputs, dict):
+        outputs = list(outputs.values())
+    if isinstance(outputs, list):
+        for obj in outputs:
+            objects += root_objects(obj)
+    return objects
+
+
+def save(outputs, path, extra=None):
+    # Write the accumulators of an output structure to a .npz file, with extra arrays by name if given
+    arrays = dict(extra or {})
+    kinds = []
+    names = []
+    titles = []
+    for i, obj in enumerate(accumulators(outputs)):
+        kinds.append(type(obj).__name__)
+        names.append(obj.name)
+        titles.append(obj.title)
+        for key, array in obj.arrays().items():
+            arrays['{}_{}'.format(i, key)] = array
+    temporary = '{}.{}.tmp.npz'.format(path[:-len('.npz')], os.getpid())
+    np.savez(temporary, kinds=np.array(kinds, dtype=str), names=np.array(names, dtype=str),
+             titles=np.array(titles, dtype=str), **arrays)
+    os.replace(temporary, path)
+
+
+def load(path):
+    # Read the accumulators of a .npz file written by save
+    objects = []
+    with np.load(path) as data:
+        for i, (kind, name, title) in enumerate(zip(data['kinds'], data['names'], data['titles'])):
+            prefix = '{}_'.format(i)
+            arrays = {key[len(prefix):]: data[key] for key in data.files if key.startswith(prefix)}
+            cls = {'Histogram': Histogram, 'Efficiency': Efficiency, 'BinnedEfficiency': BinnedEfficiency}[kind]
+            objects.append(cls.from_arrays(str(name), str(title), arrays))
+    return objects
+
+
+def export(paths, output):
+    # Add up the accumulators of .npz files by name and write them as ROOT objects to output
+    merged = {}
+    for path in paths:
+        for obj in load(path):
+            merged[obj.name] = merged[obj.name] + obj if obj.name in merged else obj
+
+    from ROOT import TFile
+    outf = TFile(output, 'RECREATE')
+    for obj in merged.values():
+        obj.to_root().Write()
+    outf.Close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert NumPy histograms of the analyses to a ROOT file')
+    parser.add_argument('inputs', nargs='+', help='.npz files, histograms of the same name are added up')
+    parser.add_argument('-o', '--output', help='ROOT file (the first input with .root by default)')
+    args = parser.parse_args(argv)
+    export(args.inputs, args.output or os.path.splitext(args.inputs[0])[0] + '.root')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+# Incremental runs adding new input files to existing outputs
+#
+# The files and entry ranges processed into the output of an analysis are kept in a checkpoint next to
+# it (<output>.checkpoint.json), with the counters of the outputs, which are not in the output file.
+# An incremental run only processes the entry ranges of the inputs missing from the checkpoint, adds
+# the histograms of the existing output to the new ones and the saved counters to the new counters:
+#   python python/scheduler.py data/*.root -a tau_cone tau_deltaR --incremental
+# The output and its checkpoint are written every CHECKPOINT_INTERVAL seconds, so an interrupted run
+# goes on from the last checkpoint when it is started again. Input files changed after they were
+# processed are an error, their outputs have to be made again without --incremental.
+import json
+import os
+import time
+import numpy as np
+from dataset import Dataset
+import histograms
+import parallel
+
+# Seconds between two checkpoints of a run
+CHECKPOINT_INTERVAL = 60
+
+# Largest entry range processed between two checkpoints
+UNIT_ENTRIES = 100000
+
+
+class Checkpoint:
+    def __init__(self, output):
+        # Processed entry ranges and saved counters of the output file of an analysis
+        # The output is tagged with the generation of its checkpoint, which goes up with every commit
+        self.output = output
+        self.path = output + '.checkpoint.json'
+        self.generation = 0
+        self.files = {}
+        self.counters = None
+        self.load()
+
+    def state(self):
+        return {'generation': self.generation, 'files': self.files, 'counters': self.counters}
+
+    def set_state(self, state):
+        self.generation = state['generation']
+        self.files = state['files']
+        self.counters = state['counters']
+
+    def load(self):
+        # Read the checkpoint matching the output, the pending one if a commit was interrupted after
+        # the output was written
+        generation = output_generation(self.output)
+        if not os.path.exists(self.path):
+            if generation != 0:
+                raise ValueError('{} was not made by an incremental run, remove it or run without --incremental'
+                                 .format(self.output))
+            return
+        with open(self.path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        pending = checkpoint.get('pending')
+        if pending is not None and pending['generation'] == generation:
+            self.set_state(pending)
+        elif checkpoint['committed']['generation'] == generation:
+            self.set_state(checkpoint['committed'])
+        else:
+            raise ValueError('{} does not match its checkpoint {}'.format(self.output, self.path))
+
+    def save(self, checkpoint):
+        temporary = '{}.tmp'.format(self.path)
+        with open(temporary, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file, indent=1)
+        os.replace(temporary, self.path)
+
+    def commit(self, outputs, files, counters):
+        # Write the outputs and record the processed files and the counters with them
+        # The new state is saved as pending first, so the checkpoint always matches the output on disk
+        pending = {'generation': self.generation + 1, 'files': files, 'counters': counters}
+        self.save({'committed': self.state(), 'pending': pending})
+        write_output(outputs, self.output, pending['generation'])
+        self.set_state(pending)
+        self.save({'committed': self.state()})
+
+
+def output_path(output):
+    # File written for an analysis with the output file output
+    return histograms.numpy_path(output) if histograms.NUMPY else output
+
+
+def output_generation(path):
+    # Checkpoint generation of an output file, 0 if there is none and None if it has no checkpoint tag
+    if not os.path.exists(path):
+        return 0
+    if histograms.NUMPY:
+        with np.load(path) as data:
+            return int(data['checkpoint']) if 'checkpoint' in data.files else None
+    from ROOT import TFile
+    root_file = TFile(path)
+    tag = root_file.Get('checkpoint')
+    generation = int(tag.GetTitle()) if tag else None
+    root_file.Close()
+    return generation
+
+
+def write_output(outputs, path, generation):
+    # Write the histograms of an analysis to a new file replacing path, tagged with the checkpoint generation
+    if histograms.NUMPY:
+        histograms.save(outputs, path, extra={'checkpoint': np.array(generation)})
+        return
+    from ROOT import TFile, TNamed, gROOT
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    root_file = TFile(temporary, 'RECREATE')
+    for obj in histograms.root_objects(outputs):
+        obj.Write()
+    for obj in histograms.accumulators(outputs):
+        obj.to_root().Write()
+    TNamed('checkpoint', str(generation)).Write()
+    root_file.Close()
+    # new histograms stay in memory
+    gROOT.cd()
+    os.replace(temporary, path)
+
+
+def add_output(outputs, path):
+    # Add the histograms of an existing output file to those of the same name in an output structure
+    if not os.path.exists(path):
+        return
+    if histograms.NUMPY:
+        saved = {obj.name: obj for obj in histograms.load(path)}
+        for obj in histograms.accumulators(outputs):
+            if obj.name not in saved:
+                raise ValueError('No histogram {} in {}'.format(obj.name, path))
+            obj.add(saved[obj.name])
+        return
+    from ROOT import TFile, gROOT
+    root_file = TFile(path)
+    for obj in histograms.root_objects(outputs):
+        saved = root_file.Get(obj.GetName())
+        if not saved:
+            raise ValueError('No histogram {} in {}'.format(obj.GetName(), path))
+        obj.Add(saved)
+    for obj in histograms.accumulators(outputs):
+        saved = root_file.Get(obj.name)
+        if not saved:
+            raise ValueError('No histogram {} in {}'.format(obj.name, path))
+        obj.add_root(saved)
+    root_file.Close()
+    gROOT.cd()
+
+
+def counters(outputs):
+    # Counters and numbers of an output structure, in a structure of the same shape with None elsewhere
+    if parallel.is_counter(outputs):
+        return dict(outputs)
+    if isinstance(outputs, (int, float, np.number)):
+        return outputs
+    if isinstance(outputs, list):
+        return [counters(obj) for obj in outputs]
+    if isinstance(outputs, dict):
+        return {name: counters(obj) for name, obj in outputs.items()}
+    return None
+
+
+def add_counters(outputs, saved):
+    # Add saved counters (see counters) to the counters and numbers of an output structure, returns the structure
+    if saved is None:
+        return outputs
+    if isinstance(saved, list):
+        return [add_counters(obj, saved_obj) for obj, saved_obj in zip(outputs, saved)]
+    if isinstance(saved, dict) and parallel.is_counter(outputs):
+        # the saved keys go first, in the order of a run over all inputs
+        total = dict(saved)
+        for key, value in outputs.items():
+            total[key] = total.get(key, 0) + value
+        outputs.clear()
+        outputs.update(total)
+        return outputs
+    if isinstance(saved, dict):
+        for name in outputs:
+            outputs[name] = add_counters(outputs[name], saved.get(name))
+        return outputs
+    return outputs + saved
+
+
+def plain(value):
+    # Python number of a NumPy number, e.g. a pdgId read from the events
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def encode(saved):
+    # JSON form of saved counters, counters become [key, value] pairs to keep keys which are not strings
+    if isinstance(saved, list):
+        return {'list': [encode(obj) for obj in saved]}
+    if isinstance(saved, dict) and parallel.is_counter(saved):
+        return {'counter': [[plain(key), plain(value)] for key, value in saved.items()]}
+    if isinstance(saved, dict):
+        return {'dict': {name: encode(obj) for name, obj in saved.items()}}
+    return plain(saved)
+
+
+def decode(encoded):
+    if isinstance(encoded, dict) and 'list' in encoded:
+        return [decode(obj) for obj in encoded['list']]
+    if isinstance(encoded, dict) and 'counter' in encoded:
+        return {tuple(key) if isinstance(key, list) else key: value for key, value in encoded['counter']}
+    if isinstance(encoded, dict):
+        return {name: decode(obj) for name, obj in encoded['dict'].items()}
+    return encoded
+
+
+def add_range(ranges, entry_start, entry_stop):
+    # Add an entry range to a list of [start, stop] ranges, merging the ones which overlap or touch
+    merged = []
+    for start, stop in sorted(ranges + [[entry_start, entry_stop]]):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+
+def missing_ranges(ranges, n_entries):
+    # Entry ranges of a file with n_entries entries which are not in ranges
+    missing = []
+    position = 0
+    for start, stop in ranges:
+        if start > position:
+            missing.append((position, start))
+        position = max(position, stop)
+    if position < n_entries:
+        missing.append((position, n_entries))
+    return missing
+
+
+def signature(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def processed_files(checkpoints):
+    # Processed files of the checkpoints, which have to be the same for all analyses run together
+    files = None
+    for checkpoint in checkpoints.values():
+        if files is not None and checkpoint.files != files:
+            raise ValueError('The checkpoints of the analyses differ, bring them to the same inputs by running '
+                             'them separately: {}'.format(
+                ', '.join(checkpoint.path for checkpoint in checkpoints.values())))
+        files = checkpoint.files
+    return json.loads(json.dumps(files or {}))
+
+
+def new_units(dataset, files):
+    # (path, entry_start, entry_stop) units of the dataset not in the processed files, adding the
+    # signatures of the new files to files
+    units = []
+    for path, n_entries in zip(dataset.files, dataset.entries):
+        key = os.path.abspath(path)
+        if key in files:
+            if {name: files[key][name] for name in ('size', 'mtime')} != signature(path):
+                raise ValueError('{} changed after it was processed, run without --incremental'.format(path))
+        else:
+            files[key] = dict(signature(path), ranges=[])
+        for entry_start, entry_stop in missing_ranges(files[key]['ranges'], n_entries):
+            units.append((path, entry_start, entry_stop))
+    return parallel.split_units(units, UNIT_ENTRIES)
+
+
+def run(analyses, inputs, collections, process, n_workers=None, chunk_size=10000, memory_mb=None, interval=None,
+        unit_size=None):
+    # Run process on the entry ranges of the inputs missing from the checkpoints of the analyses
+    # {name: (module, output)} and add the outputs to the existing ones, see Scheduler.run
+    # unit_size: see parallel.run
+    interval = CHECKPOINT_INTERVAL if interval is None else interval
+    dataset = inputs if isinstance(inputs, Dataset) else Dataset(inputs)
+    checkpoints = {name: Checkpoint(output_path(output)) for name, (module, output) in analyses.items()}
+    files = processed_files(checkpoints)
+    units = new_units(dataset, files)
+    saved = {name: decode(checkpoint.counters) for name, checkpoint in checkpoints.items()}
+    print('Incremental run: {} new entries in {} ranges'.format(
+        sum(entry_stop - entry_start for path, entry_start, entry_stop in units), len(units)))
+
+    def create_outputs():
+        if not histograms.NUMPY:
+            from ROOT import gROOT
+            # histograms are kept in memory, the output files are written anew at every checkpoint
+            gROOT.cd()
+        outputs = {}
+        for name, (module, output) in analyses.items():
+            outputs[name] = module.create_outputs()
+            add_output(outputs[name], checkpoints[name].output)
+        return outputs
+
+    def commit(outputs):
+        for name, checkpoint in checkpoints.items():
+            total = add_counters(counters(outputs[name]), saved[name])
+            checkpoint.commit(outputs[name], json.loads(json.dumps(files)), encode(total))
+
+    last_commit = time.monotonic()
+    uncommitted = not all(os.path.exists(checkpoint.path) for checkpoint in checkpoints.values())
+
+    def on_unit(unit, outputs):
+        nonlocal last_commit, uncommitted
+        path, entry_start, entry_stop = unit
+        key = os.path.abspath(path)
+        files[key]['ranges'] = add_range(files[key]['ranges'], entry_start, entry_stop)
+        uncommitted = True
+        if time.monotonic() - last_commit >= interval:
+            commit(outputs)
+            last_commit = time.monotonic()
+            uncommitted = False
+
+    outputs = parallel.run(dataset, collections, create_outputs, process, n_workers, chunk_size,
+                           memory_mb=memory_mb, units=units, on_unit=on_unit, unit_size=unit_size)
+    if uncommitted:
+        commit(outputs)
+    # the saved counters are added last, the worker processes start from copies of the new counters
+    for name in analyses:
+        outputs[name] = add_counters(outputs[name], saved[name])
+    return outputs
@@ -0,0 +1,82 @@
+# Particle content of several cones around a direction, found in a single pass
+import numpy as np
+from vectors import delta_r_eta_phi
+
+
+class EtaPhiGrid:
+    def __init__(self, eta, phi, cell_size):
+        # Spatial index of particles in (eta, phi) cells at least cell_size wide
+        self.cell_size = cell_size
+        self.n_phi = max(int(2 * np.pi / cell_size), 1)
+        self.phi_width = 2 * np.pi / self.n_phi
+        keys = self.keys(*self.cells(eta, phi))
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+    def cells(self, eta, phi):
+        # Cell coordinates of the given directions
+        cell_eta = np.floor(np.asarray(eta) / self.cell_size).astype(np.int64)
+        cell_phi = np.floor((np.asarray(phi) + np.pi) / self.phi_width).astype(np.int64)
+        return cell_eta, cell_phi
+
+    def keys(self, cell_eta, cell_phi):
+        # Unique key of each cell, the phi coordinate wraps around
+        return cell_eta * self.n_phi + cell_phi % self.n_phi
+
+    def neighbours(self, eta, phi):
+        # Indices of the particles in the cell of (eta, phi) and the cells next to it, in their original order
+        cell_eta, cell_phi = self.cells(eta, phi)
+        shifts = np.arange(-1, 2)
+        keys = np.unique(self.keys(cell_eta + shifts[:, np.newaxis], cell_phi + shifts[np.newaxis, :]))
+        starts = np.searchsorted(self.sorted_keys, keys, side='left')
+        stops = np.searchsorted(self.sorted_keys, keys, side='right')
+        indices = [self.order[start:stop] for start, stop in zip(starts, stops)]
+        return np.sort(np.concatenate(indices))
+
+
+class ConeProfile:
+    def __init__(self, cone_sizes, statistics=None):
+        # Energy sums and pdgId counts for each cone size, the cones are cumulative rings in delta R
+        # Counts are added to the given statistics dictionaries (one per cone) if there are any
+        self.cone_sizes = list(cone_sizes)
+        self.radii = np.unique(self.cone_sizes)
+        self.rings = np.searchsorted(self.radii, self.cone_sizes)
+        if statistics is None:
+            statistics = [{} for cone_size in self.cone_sizes]
+        self.statistics = statistics
+
+    def fill(self, centres, particles, pdg_ids):
+        # Find the particles in every cone around each centre vector
+        # Returns the energy inside each cone minus the energy of the centre, shape (centres, cones)
+        eta = particles.eta()
+        phi = particles.phi()
+        energy = particles.energy()
+        grid = EtaPhiGrid(eta, phi, self.radii[-1])
+
+        centre_eta = centres.eta()
+        centre_phi = centres.phi()
+        centre_energy = centres.energy()
+        energy_diffs = np.zeros((len(centres), len(self.cone_sizes)))
+
+        for i in range(len(centres)):
+            # delta R is only computed once for particles close to the centre
+            candidates = grid.neighbours(centre_eta[i], centre_phi[i])
+            delta_r = delta_r_eta_phi(centre_eta[i], centre_phi[i], eta[candidates], phi[candidates])
+            ring = np.searchsorted(self.radii, delta_r, side='right')
+
+            for j, cone_ring in enumerate(self.rings):
+                inside = ring <= cone_ring
+                # sum the energies in the original particle order
+                energies = np.where(inside, energy[candidates], 0.0)
+                energy_sum = np.cumsum(energies)[-1] if len(energies) else 0
+                energy_diffs[i, j] = energy_sum - centre_energy[i]
+                self.__count(pdg_ids[candidates][inside], self.statistics[j])
+
+        return energy_diffs
+
+    def __count(self, pdg_ids, statistics):
+        # Count particles by pdgId, new pdgIds are added in the order they are found
+        values, first, counts = np.unique(pdg_ids, return_index=True, return_counts=True)
+        for k in np.argsort(first):
+            pdg = values[k].item()
+            statistics[pdg] = statistics.get(pdg, 0) + counts[k].item()
@@ -0,0 +1,47 @@
+# Sums over the constituents of the jets of a chunk
+#
+# The constituents of a jet are the entries particles_begin to particles_end of jetParts in its event,
+# which are offsets into the flat jetParts arrays once the start of the event is added. All jets are
+# summed at once with reductions over these ranges, without a loop over the jets or constituents.
+import numpy as np
+from vectors import LorentzArray, range_max
+
+
+def constituent_ranges(chunk, jets=None):
+    # Ranges [begin, end) in the flat jetParts arrays of the constituents of the jets with the
+    # given flat indices (all jets of the chunk by default)
+    jet_collection = chunk['jets']
+    if jets is None:
+        jets = np.arange(jet_collection.offsets[-1])
+    parts_offsets = chunk['jetParts'].offsets[jet_collection.event_index()[jets]]
+    begin = parts_offsets + jet_collection['particles_begin'][jets]
+    end = parts_offsets + jet_collection['particles_end'][jets]
+    return begin, end
+
+
+def constituent_sums(chunk, jets=None):
+    # Sums over the constituents of the jets with the given flat indices (all jets by default):
+    # begin, end:       ranges of the constituents in the flat jetParts arrays
+    # n:                number of constituents
+    # p4:               sum of the constituent four-momenta (LorentzArray)
+    # energy:           sum of the constituent energies
+    # leading_energy:   energy of the most energetic constituent, 0 without constituents
+    # leading_fraction: leading_energy / energy, 0 without constituents
+    # parts_energy:     energy of every constituent in the flat jetParts arrays
+    begin, end = constituent_ranges(chunk, jets)
+    parts_vectors = LorentzArray.from_collection(chunk['jetParts'])
+    p4 = parts_vectors.sum_ranges(begin, end)
+    energy = p4.energy()
+    leading_energy = range_max(parts_vectors.energy(), begin, end)
+    leading_fraction = np.zeros(len(energy))
+    np.divide(leading_energy, energy, out=leading_fraction, where=energy > 0)
+    return {
+        'begin': begin,
+        'end': end,
+        'n': end - begin,
+        'p4': p4,
+        'energy': energy,
+        'leading_energy': leading_energy,
+        'leading_fraction': leading_fraction,
+        'parts_energy': parts_vectors.energy(),
+    }
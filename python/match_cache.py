@@ -0,0 +1,151 @@
+# On-disk cache of per-event matching results
+#
+# Results are stored in blocks of events of an input file. The key of a block contains the content
+# hash of the file, the name and parameters of the matching and the block range, so changing any of
+# them leads to new entries, and old ones are removed once the cache is over its size limit (least
+# recently used first). A chunk covering part of a block computes the whole block, so parallel runs give
+# each worker whole blocks (unit_size of parallel.run), and blocks are written atomically.
+import hashlib
+import json
+import os
+import numpy as np
+from reader import Chunk
+
+DEFAULT_DIRECTORY = 'data/.match_cache'
+HASHES_NAME = 'hashes.json'
+
+
+class MatchCache:
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_size_mb=1000, block_size=10000):
+        # Cache in the given directory, holding at most max_size_mb of results
+        self.directory = directory
+        self.max_size = max_size_mb * 1024 ** 2
+        self.block_size = block_size
+        self.hashes = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, chunk, name, parameters, compute):
+        # Return compute(chunk), reading the blocks covering the chunk from the cache where possible
+        # compute returns a dictionary of jagged fields as (flat values, offsets per event)
+        n_entries = chunk.tree.num_entries
+        file_hash = self.file_hash(chunk.path)
+        parts = []
+        first_block = chunk.entry_start // self.block_size
+        last_block = (chunk.entry_stop - 1) // self.block_size
+        for block in range(first_block, last_block + 1):
+            block_start = block * self.block_size
+            block_stop = min(block_start + self.block_size, n_entries)
+            key = block_key(file_hash, name, parameters, block_start, block_stop)
+            fields = self.load(key)
+            if fields is None:
+                if (block_start, block_stop) == (chunk.entry_start, chunk.entry_stop):
+                    block_chunk = chunk
+                else:
+                    block_chunk = Chunk(chunk.tree, chunk.collections, block_start, block_stop, chunk.path)
+                fields = compute(block_chunk)
+                self.save(key, fields)
+            start = max(chunk.entry_start, block_start) - block_start
+            stop = min(chunk.entry_stop, block_stop) - block_start
+            parts.append({field: slice_events(values, offsets, start, stop) for field, (values, offsets) in fields.items()})
+        return {field: concatenate_events([part[field] for part in parts]) for field in parts[0]}
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        # Read a block, marking it as recently used
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            fields = {}
+            for field in data.files:
+                if field.endswith('.values'):
+                    name = field[:-len('.values')]
+                    fields[name] = (data[field], data[name + '.offsets'])
+        os.utime(path)
+        return fields
+
+    def save(self, key, fields):
+        # Write a block atomically and evict old blocks if the cache is too large
+        arrays = {}
+        for name, (values, offsets) in fields.items():
+            arrays[name + '.values'] = values
+            arrays[name + '.offsets'] = offsets
+        path = self.path(key)
+        temporary = '{}.{}.tmp.npz'.format(path[:-len('.npz')], os.getpid())
+        np.savez(temporary, **arrays)
+        os.replace(temporary, path)
+        self.evict()
+
+    def evict(self):
+        # Remove least recently used blocks until the cache fits in its size limit
+        blocks = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith('.npz') and not file_name.endswith('.tmp.npz'):
+                stat = os.stat(os.path.join(self.directory, file_name))
+                blocks.append((stat.st_mtime, stat.st_size, file_name))
+        total = sum(size for mtime, size, file_name in blocks)
+        for mtime, size, file_name in sorted(blocks):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def file_hash(self, path):
+        # Content hash of an input file, remembered for as long as its size and modification time stay the same
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime]
+        path = os.path.abspath(path)
+        if path not in self.hashes:
+            self.hashes = self.load_hashes()
+        cached = self.hashes.get(path)
+        if cached and cached['signature'] == signature:
+            return cached['hash']
+
+        digest = hashlib.sha1()
+        with open(path, 'rb') as input_file:
+            for block in iter(lambda: input_file.read(1024 ** 2), b''):
+                digest.update(block)
+        self.hashes = self.load_hashes()
+        self.hashes[path] = {'signature': signature, 'hash': digest.hexdigest()}
+        temporary = '{}.{}.tmp'.format(os.path.join(self.directory, HASHES_NAME), os.getpid())
+        with open(temporary, 'w') as hashes_file:
+            json.dump(self.hashes, hashes_file, indent=1)
+        os.replace(temporary, os.path.join(self.directory, HASHES_NAME))
+        return self.hashes[path]['hash']
+
+    def load_hashes(self):
+        try:
+            with open(os.path.join(self.directory, HASHES_NAME)) as hashes_file:
+                return json.load(hashes_file)
+        except (OSError, ValueError):
+            return {}
+
+
+def block_key(file_hash, name, parameters, block_start, block_stop):
+    # Cache key of a block of events
+    description = json.dumps([file_hash, name, parameters, block_start, block_stop], sort_keys=True)
+    return '{}_{}'.format(name, hashlib.sha1(description.encode()).hexdigest())
+
+
+def slice_events(values, offsets, start, stop):
+    # Jagged field of the events [start, stop)
+    return values[offsets[start]:offsets[stop]], offsets[start:stop + 1] - offsets[start]
+
+
+def concatenate_events(parts):
+    # Join jagged fields of consecutive event ranges
+    values = np.concatenate([part[0] for part in parts])
+    offsets = [parts[0][1]]
+    for part in parts[1:]:
+        offsets.append(part[1][1:] + offsets[-1][-1])
+    return values, np.concatenate(offsets)
+
+
+def event_fields(fields, i):
+    # Values of the jagged fields in the i-th event
+    return {name: values[offsets[i]:offsets[i + 1]] for name, (values, offsets) in fields.items()}
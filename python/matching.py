@@ -0,0 +1,152 @@
+# DeltaR matching of reconstructed objects to generator particles
+import numpy as np
+from vectors import delta_r_matrix
+
+# Default matching cone used by the analyses
+CONE_SIZE = 0.05
+
+METHODS = ['first', 'greedy', 'closest', 'hungarian']
+
+
+def match(delta_r, cone=CONE_SIZE, method='greedy'):
+    # Match the rows of a DeltaR matrix (e.g. jets) to its columns (e.g. generator taus)
+    # first:     each row takes the first column inside the cone, columns can be reused
+    # greedy:    rows in order take the first column inside the cone not used yet
+    # closest:   pairs are accepted from the smallest DeltaR up, each row and column once
+    # hungarian: one-to-one assignment minimising the sum of DeltaR inside the cone
+    # Returns the matched column of every row (-1 if none) and the matched DeltaR (inf if none)
+    delta_r = np.asarray(delta_r, dtype=np.float64)
+    n_rows, n_cols = delta_r.shape
+    indices = np.full(n_rows, -1, dtype=np.int64)
+    inside = delta_r < cone
+    if n_rows == 0 or n_cols == 0:
+        return indices, np.full(n_rows, np.inf)
+
+    if method == 'first':
+        has_match = inside.any(axis=1)
+        indices[has_match] = np.argmax(inside[has_match], axis=1)
+    elif method in ('greedy', 'closest'):
+        rows, cols = np.nonzero(inside)
+        order = priority_order(delta_r[rows, cols], method)
+        accepted = resolve_pairs(rows[order], cols[order], n_rows, n_cols)
+        indices[rows[order][accepted]] = cols[order][accepted]
+    elif method == 'hungarian':
+        from scipy.optimize import linear_sum_assignment
+        # pairs outside the cone get a cost larger than any sum of allowed pairs
+        cost = np.where(inside, delta_r, cone * (min(n_rows, n_cols) + 1))
+        rows, cols = linear_sum_assignment(cost)
+        accepted = inside[rows, cols]
+        indices[rows[accepted]] = cols[accepted]
+    else:
+        raise ValueError('Unknown matching method: {}'.format(method))
+
+    distances = np.full(n_rows, np.inf)
+    matched = indices >= 0
+    distances[matched] = delta_r[np.flatnonzero(matched), indices[matched]]
+    return indices, distances
+
+
+def priority_order(delta_r, method, priority=None):
+    # Order in which the pairs inside the cone are accepted, from pairs ordered by row, then by column:
+    # as they come for greedy, from the smallest DeltaR up for closest
+    # priority: for greedy, a value of the row of each pair, rows with higher values take their columns first
+    if method == 'greedy':
+        if priority is None:
+            return np.arange(len(delta_r))
+        return np.argsort(-priority, kind='stable')
+    return np.argsort(delta_r, kind='stable')
+
+
+def resolve_pairs(rows, cols, n_rows, n_cols):
+    # One-to-one matching of pairs given in their order of acceptance: each pair is accepted unless an earlier
+    # accepted pair has its row or column. Returns the mask of the accepted pairs.
+    # A pair that comes first among the remaining pairs of its row and of its column is accepted, whatever is
+    # accepted before it, so all such pairs are accepted at once and the pairs sharing their rows or columns
+    # dropped, until no pairs remain. Rows and columns of different events never share pairs, so the pairs
+    # of a whole chunk are resolved together, in a few rounds.
+    n_pairs = len(rows)
+    accepted = np.zeros(n_pairs, dtype=bool)
+    used_rows = np.zeros(n_rows, dtype=bool)
+    used_cols = np.zeros(n_cols, dtype=bool)
+    remaining = np.arange(n_pairs)
+    while len(remaining):
+        remaining_rows = rows[remaining]
+        remaining_cols = cols[remaining]
+        first_in_row = np.full(n_rows, n_pairs)
+        first_in_col = np.full(n_cols, n_pairs)
+        np.minimum.at(first_in_row, remaining_rows, remaining)
+        np.minimum.at(first_in_col, remaining_cols, remaining)
+        dominant = (first_in_row[remaining_rows] == remaining) & (first_in_col[remaining_cols] == remaining)
+        accepted[remaining[dominant]] = True
+        used_rows[remaining_rows[dominant]] = True
+        used_cols[remaining_cols[dominant]] = True
+        remaining = remaining[~used_rows[remaining_rows] & ~used_cols[remaining_cols]]
+    return accepted
+
+
+def match_vectors(vectors1, vectors2, cone=CONE_SIZE, method='greedy'):
+    # Match two LorentzArrays of a single event
+    return match(delta_r_matrix(vectors1, vectors2), cone, method)
+
+
+def pair_indices(offsets1, offsets2):
+    # Flat indices of all pairs of objects from two jagged collections within the same event
+    counts1 = np.diff(offsets1)
+    counts2 = np.diff(offsets2)
+    n_pairs = counts1 * counts2
+    event = np.repeat(np.arange(len(counts1)), n_pairs)
+    pair_offsets = np.zeros(len(n_pairs) + 1, dtype=np.int64)
+    np.cumsum(n_pairs, out=pair_offsets[1:])
+    local = np.arange(pair_offsets[-1]) - pair_offsets[event]
+    n2 = counts2[event]
+    index1 = offsets1[event] + local // np.maximum(n2, 1)
+    index2 = offsets2[event] + local % np.maximum(n2, 1)
+    return index1, index2, pair_offsets
+
+
+def pair_delta_r(vectors1, offsets1, vectors2, offsets2):
+    # DeltaR of all pairs within each event of a chunk, ordered by event, then by object 1, then object 2
+    index1, index2, pair_offsets = pair_indices(offsets1, offsets2)
+    delta_r = vectors1[index1].delta_r(vectors2[index2])
+    return delta_r, index1, index2, pair_offsets
+
+
+def match_chunk(vectors1, offsets1, vectors2, offsets2, cone=CONE_SIZE, method='greedy', priority=None):
+    # Match jagged collections of a whole chunk, with the same results as match event by event
+    # first, greedy and closest resolve the pairs of all events at once, hungarian solves each event separately
+    # priority: for greedy, a value of every object of vectors1, higher values are matched first (e.g. a tag)
+    # Returns the flat index into vectors2 matched to every object of vectors1 (-1 if none) and the DeltaR
+    delta_r, index1, index2, pair_offsets = pair_delta_r(vectors1, offsets1, vectors2, offsets2)
+    indices = np.full(len(vectors1), -1, dtype=np.int64)
+    distances = np.full(len(vectors1), np.inf)
+
+    if method == 'first':
+        # pairs are ordered by column within each row, so the first pair inside the cone wins
+        inside = np.flatnonzero(delta_r < cone)
+        rows, first = np.unique(index1[inside], return_index=True)
+        indices[rows] = index2[inside[first]]
+        distances[rows] = delta_r[inside[first]]
+        return indices, distances
+
+    if method in ('greedy', 'closest'):
+        # pairs are ordered by event, then by object 1 and object 2, flat indices are unique across events
+        inside = np.flatnonzero(delta_r < cone)
+        pair_priority = None if priority is None else np.asarray(priority)[index1[inside]]
+        order = inside[priority_order(delta_r[inside], method, pair_priority)]
+        accepted = order[resolve_pairs(index1[order], index2[order], len(vectors1), len(vectors2))]
+        indices[index1[accepted]] = index2[accepted]
+        distances[index1[accepted]] = delta_r[accepted]
+        return indices, distances
+
+    # hungarian minimises a sum over each event, solved event by event
+    for event in range(len(offsets1) - 1):
+        start1, stop1 = offsets1[event], offsets1[event + 1]
+        n_cols = offsets2[event + 1] - offsets2[event]
+        if start1 == stop1 or n_cols == 0:
+            continue
+        matrix = delta_r[pair_offsets[event]:pair_offsets[event + 1]].reshape(stop1 - start1, n_cols)
+        local, local_distances = match(matrix, cone, method)
+        matched = local >= 0
+        indices[start1:stop1][matched] = offsets2[event] + local[matched]
+        distances[start1:stop1] = local_distances
+    return indices, distances
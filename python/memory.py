@@ -0,0 +1,51 @@
+# Resident memory of the analysis processes
+import os
+import resource
+import sys
+
+
+def status_mb(key):
+    # Value of a memory field of /proc/self/status (e.g. VmRSS, VmHWM) in MB, None if not available
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def rss_mb():
+    # Current resident memory of the process in MB
+    return status_mb('VmRSS')
+
+
+def peak_rss_mb():
+    # Peak resident memory of the process in MB, since the last reset_peak where supported
+    peak = status_mb('VmHWM')
+    if peak is None:
+        # kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return peak
+
+
+def reset_peak():
+    # Start measuring the peak resident memory from the current one (Linux), returns whether it worked
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def report_chunks(chunks, stream=sys.stderr):
+    # Iterate over chunks, printing the peak resident memory while each one was read and processed
+    for chunk in chunks:
+        reset = reset_peak()
+        yield chunk
+        print('{} entries {}-{}: peak RSS {:.1f} MB{}'.format(
+            os.path.basename(chunk.path or ''), chunk.entry_start, chunk.entry_stop, peak_rss_mb(),
+            '' if reset else ' (since the start of the process)'
+        ), file=stream)
@@ -0,0 +1,170 @@
+# Running an analysis over entry ranges of the events tree in a pool of worker processes
+import copy
+import multiprocessing
+import math
+import os
+from dataset import Dataset
+from reader import EventReader
+import histograms
+import profiling
+
+# Settings and open readers of the current worker process, every worker opens each input file once
+worker_settings = None
+worker_readers = {}
+
+
+class FillRecorder:
+    def __init__(self):
+        # Stand-in for a histogram or efficiency in a worker, keeps the arguments of every Fill call
+        # and of every array fill of a buffered or NumPy histogram (histograms.py)
+        self.fills = []
+
+    def Fill(self, *args):
+        self.fills.append(('Fill', args))
+
+    def fill(self, *args):
+        self.fills.append(('fill', args))
+
+
+def is_counter(obj):
+    # Counters are dictionaries of numbers, e.g. particle counts per pdgId
+    return isinstance(obj, dict) and all(isinstance(value, (int, float)) for value in obj.values())
+
+
+def record(outputs):
+    # Copy an output structure with histograms replaced by fill recorders and the NumPy accumulators of
+    # integer counts (histograms.BinnedEfficiency) by empty ones, which are added up
+    # The floating point statistics of histograms depend on the order of the fills, so NumPy histograms
+    # are replayed like ROOT ones rather than added up
+    if hasattr(outputs, 'Fill'):
+        return FillRecorder()
+    if hasattr(outputs, 'empty'):
+        return outputs.empty()
+    if isinstance(outputs, list):
+        return [record(obj) for obj in outputs]
+    if isinstance(outputs, dict) and not is_counter(outputs):
+        return {name: record(obj) for name, obj in outputs.items()}
+    return copy.deepcopy(outputs)
+
+
+def merge(outputs, partial):
+    # Add partial outputs of a worker to the outputs, returns the merged structure
+    # Recorded fills are replayed and integer counts added, so merging the ranges in order gives the same
+    # result as a serial run, bit for bit
+    if isinstance(partial, FillRecorder):
+        for method, args in partial.fills:
+            getattr(outputs, method)(*args)
+        return outputs
+    if isinstance(partial, list):
+        return [merge(obj, partial_obj) for obj, partial_obj in zip(outputs, partial)]
+    if is_counter(partial):
+        for key, value in partial.items():
+            outputs[key] = outputs.get(key, 0) + value
+        return outputs
+    if isinstance(partial, dict):
+        for name in outputs:
+            outputs[name] = merge(outputs[name], partial[name])
+        return outputs
+    return outputs + partial
+
+
+def init_worker(collections, tree_name, chunk_size, memory_mb=None):
+    # Save the reader settings in a worker process
+    global worker_settings
+    worker_settings = (collections, tree_name, chunk_size, memory_mb)
+
+
+def get_reader(path):
+    # Return the reader of an input file in a worker process, opening it on first use
+    if path not in worker_readers:
+        collections, tree_name, chunk_size, memory_mb = worker_settings
+        worker_readers[path] = EventReader(path, collections, tree_name, chunk_size, memory_mb)
+    return worker_readers[path]
+
+
+def process_chunks(process, chunks, outputs):
+    # Run the analysis on chunks of events, counting the events for the profiling report
+    for chunk in chunks:
+        with profiling.timer('process chunk'):
+            process(chunk, outputs)
+        profiling.count('events', chunk.n_events)
+
+
+def split_units(units, max_entries, unit_size=None):
+    # Split (path, entry_start, entry_stop) units into units of at most max_entries entries
+    # unit_size: cut the units only at multiples of unit_size entries, with max_entries rounded up to one
+    if unit_size:
+        max_entries = math.ceil(max_entries / unit_size) * unit_size
+    split = []
+    for path, entry_start, entry_stop in units:
+        if entry_start >= entry_stop:
+            continue
+        first_cut = (entry_start // max_entries + 1) * max_entries if unit_size else entry_start + max_entries
+        bounds = [entry_start] + list(range(first_cut, entry_stop, max_entries)) + [entry_stop]
+        split.extend((path, start, stop) for start, stop in zip(bounds[:-1], bounds[1:]))
+    return split
+
+
+def process_range(task):
+    # Run the analysis on one entry range of a file in a worker process
+    # Returns the outputs and the profiling measurements of the range
+    process, template, path, entry_start, entry_stop = task
+    outputs = copy.deepcopy(template)
+    profiling.profiled(process_chunks, process, get_reader(path).chunks(entry_start, entry_stop), outputs)
+    return outputs, profiling.take()
+
+
+def run(inputs, collections, create_outputs, process, n_workers=None, chunk_size=10000, ranges_per_worker=4,
+        memory_mb=None, units=None, on_unit=None, unit_size=None):
+    # Run process(chunk, outputs) over all events and return the outputs made by create_outputs()
+    # inputs can be a Dataset or anything a Dataset is made from (path, glob pattern, manifest)
+    # memory_mb: size the chunks by memory instead of chunk_size events, see reader.EventReader
+    # units: (path, entry_start, entry_stop) ranges to process instead of all events, then on_unit(unit, outputs)
+    # is called after the outputs of each of them are merged (see incremental.py)
+    # unit_size: the ranges of the workers start and end at multiples of unit_size entries of a file, e.g. the
+    # blocks of a match_cache.MatchCache, so no two workers compute the same block
+    # Histograms, efficiencies (anything with Fill), NumPy accumulators, numbers and counters of numbers are merged
+    # Counters and numbers of the outputs have to start from zero, and process must not depend
+    # on where the chunk boundaries are
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    dataset = inputs if isinstance(inputs, Dataset) else Dataset(inputs)
+    outputs = create_outputs()
+
+    if n_workers <= 1 and units is None:
+        profiling.profiled(process_chunks, process, dataset.chunks(collections, chunk_size, memory_mb), outputs)
+        histograms.flush(outputs)
+        return outputs
+
+    if n_workers <= 1:
+        readers = {}
+        for unit in units:
+            path, entry_start, entry_stop = unit
+            if path not in readers:
+                readers[path] = EventReader(path, collections, dataset.tree_name, chunk_size, memory_mb)
+            profiling.profiled(process_chunks, process, readers[path].chunks(entry_start, entry_stop), outputs)
+            if on_unit is not None:
+                on_unit(unit, outputs)
+        for reader in readers.values():
+            reader.close()
+        histograms.flush(outputs)
+        return outputs
+
+    template = record(outputs)
+    if units is None:
+        units = dataset.work_units()
+    n_entries = sum(entry_stop - entry_start for path, entry_start, entry_stop in units)
+    units = split_units(units, max(math.ceil(n_entries / (n_workers * ranges_per_worker)), 1), unit_size)
+    tasks = [(process, template, path, entry_start, entry_stop) for path, entry_start, entry_stop in units]
+
+    # fork keeps the analysis functions of the main script available in the workers
+    context = multiprocessing.get_context('fork')
+    initargs = (collections, dataset.tree_name, chunk_size, memory_mb)
+    with context.Pool(n_workers, initializer=init_worker, initargs=initargs) as pool:
+        for unit, (partial, measurements) in zip(units, pool.imap(process_range, tasks)):
+            outputs = merge(outputs, partial)
+            profiling.merge(measurements)
+            if on_unit is not None:
+                on_unit(unit, outputs)
+    histograms.flush(outputs)
+    return outputs
@@ -0,0 +1,124 @@
+# Index of the particles of a chunk by |pdgId| and status
+#
+# The particles are grouped by (|pdgId|, status) with one sort, selections such as the final state taus
+# or all neutrinos are then put together from the groups once per chunk and looked up per event by
+# their offsets. The index can be kept in a sidecar directory next to the input file.
+import os
+import numpy as np
+
+# Name of the sidecar directory keeping the indices of the files in a directory
+INDEX_DIRECTORY = '.particle_index'
+
+# Keep the indices in the sidecar directory by default
+PERSIST = False
+
+
+class ParticleIndex:
+    def __init__(self, keys, group_offsets, order, offsets):
+        # keys: (|pdgId|, status) of each group, the flat indices of group i are order[group_offsets[i]:group_offsets[i + 1]]
+        # offsets: start of each event in the flat arrays of the particles, followed by their number
+        self.keys = keys
+        self.group_offsets = group_offsets
+        self.order = order
+        self.offsets = offsets
+        self.groups = {}
+        for i, (pdg_id, status) in enumerate(keys):
+            self.groups[(int(pdg_id), int(status))] = order[group_offsets[i]:group_offsets[i + 1]]
+        self.selections = {}
+
+    @classmethod
+    def build(cls, pdg_ids, statuses, offsets):
+        # Group the particles of a chunk, keeping the order of the particles within each group
+        abs_ids = np.abs(pdg_ids).astype(np.int64)
+        statuses = np.asarray(statuses, dtype=np.int64)
+        order = np.lexsort((statuses, abs_ids))
+        sorted_ids = abs_ids[order]
+        sorted_statuses = statuses[order]
+        new_group = (sorted_ids[1:] != sorted_ids[:-1]) | (sorted_statuses[1:] != sorted_statuses[:-1])
+        starts = np.flatnonzero(np.r_[len(order) > 0, new_group])
+        keys = np.stack([sorted_ids[starts], sorted_statuses[starts]], axis=1)
+        return cls(keys, np.r_[starts, len(order)], order, offsets)
+
+    @classmethod
+    def from_collection(cls, collection):
+        # Index of a reader.Collection of particles
+        return cls.build(collection['pdgId'], collection['status'], collection.offsets)
+
+    def select(self, pdg_ids=None, statuses=None):
+        # Flat indices of the particles with one of the |pdgId| values and one of the statuses (all if None),
+        # in the order of the collection, and their offsets per event
+        key = (normalize(pdg_ids), normalize(statuses))
+        if key not in self.selections:
+            pdg_ids, statuses = key
+            groups = [
+                indices for (pdg_id, status), indices in self.groups.items()
+                if (pdg_ids is None or pdg_id in pdg_ids) and (statuses is None or status in statuses)
+            ]
+            indices = np.sort(np.concatenate(groups)) if groups else np.empty(0, dtype=np.int64)
+            self.selections[key] = (indices, np.searchsorted(indices, self.offsets))
+        return self.selections[key]
+
+    def event(self, event, pdg_ids=None, statuses=None):
+        # Flat indices of the selected particles of one event of the chunk
+        indices, event_offsets = self.select(pdg_ids, statuses)
+        return indices[event_offsets[event]:event_offsets[event + 1]]
+
+    def save(self, path, signature):
+        # Write the index with the signature of the input file it was made from
+        np.savez(path, keys=self.keys, group_offsets=self.group_offsets, order=self.order, offsets=self.offsets,
+                 signature=signature)
+
+    @classmethod
+    def load(cls, path, signature):
+        # Read an index, returns None if it is missing or was made from another version of the input file
+        try:
+            with np.load(path) as data:
+                if not np.array_equal(data['signature'], signature):
+                    return None
+                return cls(data['keys'], data['group_offsets'], data['order'], data['offsets'])
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+def normalize(values):
+    # Hashable set of query values, a single value or a sequence of them
+    if values is None:
+        return None
+    return frozenset(int(value) for value in np.atleast_1d(values))
+
+
+def index_path(chunk, name):
+    # Sidecar file of the index of a collection in a chunk
+    directory = os.path.join(os.path.dirname(os.path.abspath(chunk.path)), INDEX_DIRECTORY)
+    file_name = '{}.{}.{}-{}.npz'.format(os.path.basename(chunk.path), name, chunk.entry_start, chunk.entry_stop)
+    return os.path.join(directory, file_name)
+
+
+def get_index(collection, persist=None):
+    # Index of a reader.Collection of particles, built once per chunk
+    # persist: read and write the index in the sidecar directory next to the input file (PERSIST if None)
+    if collection.particle_index is not None:
+        return collection.particle_index
+    if persist is None:
+        persist = PERSIST
+    chunk = collection.chunk
+    if not persist or chunk.path is None:
+        collection.particle_index = ParticleIndex.from_collection(collection)
+        return collection.particle_index
+
+    stat = os.stat(chunk.path)
+    signature = np.array([stat.st_size, stat.st_mtime_ns])
+    path = index_path(chunk, collection.name)
+    index = ParticleIndex.load(path, signature)
+    if index is None:
+        index = ParticleIndex.from_collection(collection)
+        # read-only input directories are left without an index, as for the entries index of dataset.py
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = '{}.{}.tmp.npz'.format(path[:-len('.npz')], os.getpid())
+            index.save(temporary, signature)
+            os.replace(temporary, path)
+        except OSError:
+            pass
+    collection.particle_index = index
+    return index
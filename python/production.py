@@ -0,0 +1,193 @@
+# Producing event samples in parallel jobs, as scripts/pythia_run.sh and scripts/fast_sim.sh do for one job
+#
+# The events are split into jobs, each running fccrun with its own copy of the Pythia card with a
+# distinct Random:seed, so a sample is reproducible from the base seed. The jobs run in a pool of local
+# processes, failed jobs (exit code, errors in the log or too few events in the output) are retried,
+# and the outputs of the finished jobs are listed in a manifest read by dataset.Dataset:
+#   python python/production.py -n 100000 -j 16 -o data/p8_ee_ZH_Htautau
+#   python python/scheduler.py data/p8_ee_ZH_Htautau/manifest.txt -a tau_cone
+import argparse
+import json
+import math
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import uproot
+
+# fccrun options of the steps, as in the shell scripts
+OPTIONS = {
+    'pythia': 'options/Pythia_config.py',
+    'delphes': '$FCCSW/Sim/SimDelphesInterface/options/PythiaDelphes_config_IDEAtrkCov.py',
+}
+CARD = 'cards/Pythia_ee_ZH_Htautau.cmd'
+
+# Lines of a log showing that a job failed even if fccrun exited normally
+FAILURE_PATTERNS = [' FATAL ', 'Segmentation fault', 'Traceback (most recent call last)',
+                    'Terminated with error']
+
+# Largest seed accepted by Pythia, 0 would take the seed from the time
+MAX_SEED = 900000000
+
+
+def split_events(n_events, events_per_job):
+    # Number of events of each job
+    n_jobs = math.ceil(n_events / events_per_job)
+    return [min(events_per_job, n_events - i * events_per_job) for i in range(n_jobs)]
+
+
+def write_card(card, path, seed):
+    # Copy a Pythia card, setting the random seed
+    lines = []
+    with open(card) as card_file:
+        for line in card_file:
+            if not line.replace(' ', '').startswith(('Random:seed', 'Random:setSeed')):
+                lines.append(line.rstrip('\n'))
+    lines += ['Random:setSeed = on', 'Random:seed = {}'.format(seed)]
+    with open(path, 'w') as card_file:
+        card_file.write('\n'.join(lines) + '\n')
+
+
+def count_events(path):
+    # Number of events in an output file, None if it cannot be read
+    try:
+        with uproot.open(path) as root_file:
+            return root_file['events'].num_entries
+    except Exception:
+        return None
+
+
+def check_job(job, returncode):
+    # Reason why a job failed, None if it succeeded
+    if returncode != 0:
+        return 'exit code {}'.format(returncode)
+    with open(job['log'], errors='replace') as log:
+        for line in log:
+            for pattern in FAILURE_PATTERNS:
+                if pattern in line:
+                    return 'log: {}'.format(line.strip())
+    n_events = count_events(job['output'])
+    if n_events is None:
+        return 'no readable output'
+    if n_events < job['events']:
+        return '{} of {} events in the output'.format(n_events, job['events'])
+    return None
+
+
+def run_job(job, options, retries):
+    # Run fccrun for a job until it succeeds or the retries are used up, the log of each attempt is kept
+    while job['attempts'] <= retries:
+        job['attempts'] += 1
+        job['log'] = '{}.{}.log'.format(os.path.splitext(job['output'])[0], job['attempts'])
+        command = ['fccrun', os.path.expandvars(options), '--Filename', job['card'],
+                   '--filename', job['output'], '-n', str(job['events'])]
+        with open(job['log'], 'w') as log:
+            try:
+                returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+            except OSError as error:
+                returncode = error.errno or -1
+                log.write('{}\n'.format(error))
+        job['error'] = check_job(job, returncode)
+        if job['error'] is None:
+            job['status'] = 'done'
+            return job
+        print('Job {} failed ({}), attempt {}'.format(job['name'], job['error'], job['attempts']))
+    job['status'] = 'failed'
+    return job
+
+
+def load_jobs(path):
+    # Jobs of a previous run of the same production, by name
+    try:
+        with open(path) as jobs_file:
+            return {job['name']: job for job in json.load(jobs_file)}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_jobs(path, jobs):
+    temporary = '{}.tmp'.format(path)
+    with open(temporary, 'w') as jobs_file:
+        json.dump(jobs, jobs_file, indent=1)
+    os.replace(temporary, path)
+
+
+def write_manifest(path, jobs):
+    # List the outputs of the finished jobs, relative to the manifest
+    with open(path, 'w') as manifest:
+        manifest.write('# {} events\n'.format(sum(job['events'] for job in jobs if job['status'] == 'done')))
+        for job in jobs:
+            if job['status'] == 'done':
+                manifest.write(os.path.relpath(job['output'], os.path.dirname(path)) + '\n')
+
+
+def produce(directory, n_events, n_workers, events_per_job=None, seed=1, step='pythia', card=CARD, retries=2):
+    # Generate n_events events in jobs of events_per_job (by default split evenly over the workers)
+    # Jobs finished by an earlier run with the same settings are not run again
+    # Returns the jobs, with their status, and writes jobs.json and manifest.txt to directory
+    if events_per_job is None:
+        events_per_job = math.ceil(n_events / n_workers)
+    for name in ('cards', 'outputs'):
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+    jobs_path = os.path.join(directory, 'jobs.json')
+    previous = load_jobs(jobs_path)
+
+    jobs = []
+    pending = []
+    for i, events in enumerate(split_events(n_events, events_per_job)):
+        name = 'job_{:04d}'.format(i)
+        job = {
+            'name': name,
+            'events': events,
+            'seed': 1 + (seed - 1 + i) % MAX_SEED,
+            'card': os.path.join(directory, 'cards', name + '.cmd'),
+            'output': os.path.join(directory, 'outputs', name + '.root'),
+            'step': step,
+            'attempts': 0,
+            'status': 'pending',
+            'log': None,
+            'error': None,
+        }
+        old = previous.get(name)
+        if old and old['status'] == 'done' and all(old[key] == job[key] for key in ('events', 'seed', 'step')) \
+                and os.path.exists(old['output']):
+            jobs.append(old)
+            continue
+        write_card(card, job['card'], job['seed'])
+        jobs.append(job)
+        pending.append(job)
+
+    # every job is an fccrun process, the threads of the pool only wait for them
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for job in executor.map(lambda job: run_job(job, OPTIONS[step], retries), pending):
+            print('Job {}: {} ({} events, seed {})'.format(job['name'], job['status'], job['events'], job['seed']))
+            save_jobs(jobs_path, jobs)
+
+    save_jobs(jobs_path, jobs)
+    write_manifest(os.path.join(directory, 'manifest.txt'), jobs)
+    return jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate events in parallel fccrun jobs')
+    parser.add_argument('-n', '--events', type=int, required=True, help='total number of events')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='number of jobs running at once')
+    parser.add_argument('-e', '--events-per-job', type=int, help='events per job (split evenly over the workers)')
+    parser.add_argument('-o', '--output', required=True, help='directory of the cards, outputs, logs and manifest')
+    parser.add_argument('-s', '--seed', type=int, default=1, help='seed of the first job, the others follow it')
+    parser.add_argument('--step', choices=OPTIONS, default='pythia',
+                        help='Pythia only (pythia_run.sh) or with the Delphes fast simulation (fast_sim.sh)')
+    parser.add_argument('--card', default=CARD, help='Pythia card')
+    parser.add_argument('--retries', type=int, default=2, help='retries of a failed job')
+    args = parser.parse_args(argv)
+
+    jobs = produce(args.output, args.events, args.workers, args.events_per_job, args.seed, args.step, args.card,
+                   args.retries)
+    failed = [job['name'] for job in jobs if job['status'] != 'done']
+    if failed:
+        print('Failed jobs: {}'.format(' '.join(failed)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
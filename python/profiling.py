@@ -0,0 +1,176 @@
+# Timers and counters of the stages of the analyses
+#
+# Stages are timed with a context manager or a decorator:
+#   with profiling.timer('match jets'):
+#       ...
+#   @profiling.timed('fill histograms')
+#   def fill_histograms(...):
+# and counted with profiling.count(name). Nothing is measured unless ENABLED is set, a disabled timer
+# costs one check of the flag. Worker processes send their measurements with the outputs (see
+# parallel.py), report prints the totals at the end of a run. With PROFILE set to a path, the run is
+# also profiled with cProfile and the statistics written there, e.g. for snakeviz or flameprof.
+import cProfile
+import functools
+import pstats
+import sys
+import time
+
+# Measure the timers and counters
+ENABLED = False
+
+# File of the cProfile statistics, None to not profile
+PROFILE = None
+
+# Seconds and calls of every timer, value of every counter, cProfile statistics of the profiled runs
+timers = {}
+counters = {}
+profiles = []
+
+# Start of the measured run
+start_time = None
+
+
+class Timer:
+    def __init__(self, name):
+        # Context manager adding the time spent inside to a named timer
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_time(self.name, time.perf_counter() - self.start)
+
+
+class NullTimer:
+    # Context manager doing nothing, the timer of a disabled run
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def timer(name):
+    # Context manager timing a stage
+    if not ENABLED:
+        return NULL_TIMER
+    return Timer(name)
+
+
+def timed(name=None):
+    # Decorator timing every call of a function, under its name unless another one is given
+    def decorator(function):
+        timer_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add_time(timer_name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def add_time(name, seconds, calls=1):
+    entry = timers.setdefault(name, [0.0, 0])
+    entry[0] += seconds
+    entry[1] += calls
+
+
+def count(name, n=1):
+    # Add n to a named counter
+    if ENABLED:
+        counters[name] = counters.get(name, 0) + n
+
+
+def start():
+    # Start measuring a run
+    global start_time
+    start_time = time.perf_counter()
+
+
+def profiled(function, *args):
+    # Call a function, with cProfile if PROFILE is set
+    if PROFILE is None:
+        return function(*args)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return function(*args)
+    finally:
+        profiler.disable()
+        profiler.create_stats()
+        profiles.append(profiler.stats)
+
+
+def take():
+    # Measurements of this process since the last take, e.g. to send them from a worker process
+    global timers, counters, profiles
+    measurements = (timers, counters, profiles)
+    timers, counters, profiles = {}, {}, []
+    return measurements
+
+
+def merge(measurements):
+    # Add the measurements of another process
+    other_timers, other_counters, other_profiles = measurements
+    for name, (seconds, calls) in other_timers.items():
+        add_time(name, seconds, calls)
+    for name, value in other_counters.items():
+        counters[name] = counters.get(name, 0) + value
+    profiles.extend(other_profiles)
+
+
+class ProfileStats:
+    def __init__(self, stats):
+        # Statistics of a cProfile run in the form pstats.Stats reads from a profiler
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def dump_profile(path):
+    # Write the cProfile statistics of all profiled runs
+    if not profiles:
+        return
+    stats = pstats.Stats(ProfileStats(profiles[0]))
+    for other in profiles[1:]:
+        stats.add(ProfileStats(other))
+    stats.dump_stats(path)
+
+
+def report(stream=sys.stdout):
+    # Print the time, calls per event and time per call of every stage, and the rate of events
+    # With several worker processes the times of the stages are summed over the processes
+    events = counters.get('events', 0)
+    print('{:30} {:>10} {:>12} {:>12} {:>12}'.format('stage', 'seconds', 'calls', 'calls/event', 'us/call'),
+          file=stream)
+    for name, (seconds, calls) in sorted(timers.items(), key=lambda item: -item[1][0]):
+        print('{:30} {:10.3f} {:12d} {:12.2f} {:12.1f}'.format(
+            name, seconds, calls, calls / events if events else 0, 1e6 * seconds / calls if calls else 0
+        ), file=stream)
+    for name, value in sorted(counters.items()):
+        if name != 'events':
+            print('{:30} {:>10} {:12}'.format(name, '', value), file=stream)
+    if start_time is not None:
+        wall_time = time.perf_counter() - start_time
+        print('{} events in {:.3f} s, {:.1f} events/s'.format(events, wall_time, events / wall_time), file=stream)
+
+
+def finish():
+    # Print the report and write the cProfile statistics of a run
+    if ENABLED:
+        report()
+    if PROFILE is not None:
+        dump_profile(PROFILE)
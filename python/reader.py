@@ -0,0 +1,300 @@
+# Columnar reading of podio collections from the events tree
+from concurrent.futures import ThreadPoolExecutor
+import awkward as ak
+import numpy as np
+import uproot
+from particle_index import get_index
+import memory
+import profiling
+
+# Read the next chunk in a background thread while the current one is processed
+PREFETCH = False
+
+# Print the peak resident memory of every chunk
+MEMORY_REPORT = False
+
+# Memory taken by the events of a chunk relative to the uncompressed size of their branches,
+# the jagged arrays are copied once when they are flattened
+MEMORY_FACTOR = 2
+
+# Fields available for each collection and the podio leaves they are read from
+P4_FIELDS = {
+    'px': 'core.p4.px',
+    'py': 'core.p4.py',
+    'pz': 'core.p4.pz',
+    'mass': 'core.p4.mass',
+}
+# start_vertex and end_vertex are the indices of the vertices in genVertices, stored by podio as relations
+PARTICLE_FIELDS = dict(P4_FIELDS, pdgId='core.pdgId', status='core.status', charge='core.charge',
+                       start_vertex='#0.index', end_vertex='#1.index')
+COLLECTIONS = {
+    'jets': dict(P4_FIELDS, charge='core.charge', particles_begin='particles_begin', particles_end='particles_end'),
+    'tauTags': {'tag': 'tag'},
+    'skimmedGenParticles': PARTICLE_FIELDS,
+    'genParticles': PARTICLE_FIELDS,
+    'muons': dict(P4_FIELDS, charge='core.charge'),
+    'muonITags': {'tag': 'tag'},
+    'jetParts': dict(P4_FIELDS, pdgId='core.pdgId', charge='core.charge'),
+}
+
+
+def leaf_name(collection, field):
+    # Get the name of the branch storing a field of a collection
+    leaf = COLLECTIONS[collection][field]
+    if leaf.startswith('#'):
+        return collection + leaf
+    return '{}.{}'.format(collection, leaf)
+
+
+class EventReader:
+    def __init__(self, path, collections, tree_name='events', chunk_size=10000, memory_mb=None, prefetch=None,
+                 memory_report=None):
+        # Open the events tree and declare which collections will be read
+        # memory_mb: size the chunks to take about this much memory instead of chunk_size events
+        # prefetch, memory_report: see PREFETCH and MEMORY_REPORT, which are used if None
+        for name in collections:
+            if name not in COLLECTIONS:
+                raise KeyError('Unknown collection: {}'.format(name))
+        self.path = path
+        self.collections = list(collections)
+        self.file = uproot.open(path)
+        self.tree = self.file[tree_name]
+        self.prefetch = PREFETCH if prefetch is None else prefetch
+        self.memory_report = MEMORY_REPORT if memory_report is None else memory_report
+        self.chunk_size = chunk_size
+        if memory_mb:
+            # a prefetched chunk is in memory together with the current one
+            budget = memory_mb / 2 if self.prefetch else memory_mb
+            self.chunk_size = memory_chunk_size(self.tree, self.collections, budget)
+
+    def __len__(self):
+        # Return the number of events in the tree
+        return self.tree.num_entries
+
+    def chunks(self, entry_start=0, entry_stop=None):
+        # Iterate over the tree in chunks of at most chunk_size events
+        if entry_stop is None or entry_stop > len(self):
+            entry_stop = len(self)
+        chunks = (
+            Chunk(self.tree, self.collections, start, min(start + self.chunk_size, entry_stop), self.path)
+            for start in range(entry_start, entry_stop, self.chunk_size)
+        )
+        if self.prefetch:
+            chunks = prefetch(chunks)
+        if self.memory_report:
+            chunks = memory.report_chunks(chunks)
+        return chunks
+
+    def events(self, entry_start=0, entry_stop=None):
+        # Iterate over single events, reading the branches chunk by chunk
+        for chunk in self.chunks(entry_start, entry_stop):
+            yield from chunk.events()
+
+    def close(self):
+        self.file.close()
+
+
+class Chunk:
+    def __init__(self, tree, collections, entry_start, entry_stop, path=None):
+        # Range of events whose branches are read lazily on first access
+        self.tree = tree
+        self.path = path
+        self.collections = collections
+        self.entry_start = entry_start
+        self.entry_stop = entry_stop
+        self.n_events = entry_stop - entry_start
+        self._cache = {}
+        # (collection, field) pairs read so far on access, used to prefetch the next chunk
+        self.fields_read = set()
+        # True while prefetch reads fields in advance in its background thread
+        self.in_advance = False
+
+    def __getitem__(self, name):
+        # Return the jagged collection with the given name
+        if name not in self.collections:
+            raise KeyError('Collection not requested: {}'.format(name))
+        if name not in self._cache:
+            self._cache[name] = Collection(name, self)
+        return self._cache[name]
+
+    def read(self, collection, field):
+        # Read one field of a collection as (flat values, counts per event)
+        # reads in advance overlap the processing of the previous chunk, so they are timed apart from the
+        # stages of the wall time
+        if not self.in_advance:
+            self.fields_read.add((collection, field))
+        with profiling.timer('read (prefetch)' if self.in_advance else 'read'):
+            array = self.tree[leaf_name(collection, field)].array(
+                entry_start=self.entry_start,
+                entry_stop=self.entry_stop,
+                library='ak'
+            )
+            counts = ak.to_numpy(ak.num(array))
+            values = ak.to_numpy(ak.flatten(array))
+        return values, counts
+
+    def events(self):
+        # Iterate over single events of the chunk
+        for i in range(self.n_events):
+            yield Event(self, i)
+
+    def preload(self, fields):
+        # Read the given (collection, field) pairs in advance
+        self.in_advance = True
+        try:
+            for collection, field in fields:
+                if collection in self.collections:
+                    self[collection][field]
+        finally:
+            self.in_advance = False
+
+
+class Collection:
+    def __init__(self, name, chunk):
+        # Flat field arrays of one collection with CSR offsets per event
+        self.name = name
+        self.chunk = chunk
+        self._fields = {}
+        self._offsets = None
+        # particle_index.ParticleIndex and decay_tree.DecayTree (False without vertex links) of the
+        # collection, built on first use
+        self.particle_index = None
+        self.decay_tree = None
+
+    def __getitem__(self, field):
+        # Return the flat array of a field for the whole chunk
+        if field not in self._fields:
+            if field not in COLLECTIONS[self.name]:
+                raise KeyError('Unknown field {} in {}'.format(field, self.name))
+            values, counts = self.chunk.read(self.name, field)
+            if self._offsets is None:
+                self._offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+                np.cumsum(counts, out=self._offsets[1:])
+            self._fields[field] = values
+        return self._fields[field]
+
+    @property
+    def offsets(self):
+        # Start of each event in the flat arrays, followed by the total length
+        if self._offsets is None:
+            self[next(iter(COLLECTIONS[self.name]))]
+        return self._offsets
+
+    @property
+    def counts(self):
+        # Number of objects in each event
+        return np.diff(self.offsets)
+
+    def event_index(self):
+        # Chunk-local event index of every object
+        return np.repeat(np.arange(self.chunk.n_events), self.counts)
+
+    def event_slice(self, i):
+        # Slice of the flat arrays belonging to the i-th event of the chunk
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+
+class Event:
+    def __init__(self, chunk, index):
+        # Single event view with the same attribute access as the podio tree
+        self.chunk = chunk
+        self.index = index
+        self.entry = chunk.entry_start + index
+
+    def __getattr__(self, name):
+        if name in self.chunk.collections:
+            return EventCollection(self.chunk[name], self.index)
+        raise AttributeError(name)
+
+
+class EventCollection:
+    def __init__(self, collection, event):
+        # Objects of one collection in a single event
+        self.collection = collection
+        self.event = event
+        self.start = collection.offsets[event]
+        self.stop = collection.offsets[event + 1]
+
+    def __len__(self):
+        return int(self.stop - self.start)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return Element(self.collection, self.start + i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield Element(self.collection, self.start + i)
+
+    def select(self, pdg_ids=None, statuses=None):
+        # Particles with one of the |pdgId| values and statuses (all if None), looked up in the particle index
+        indices = get_index(self.collection).event(self.event, pdg_ids, statuses)
+        return [Element(self.collection, index) for index in indices]
+
+
+class Element:
+    def __init__(self, collection, index):
+        # Single object supporting podio style access such as particle.core.p4.px
+        self.collection = collection
+        self.index = index
+
+    def __getattr__(self, name):
+        if name in ('core', 'p4'):
+            return self
+        if name in COLLECTIONS[self.collection.name]:
+            return self.collection[name][self.index].item()
+        raise AttributeError(name)
+
+    def __deepcopy__(self, memo):
+        # Elements are read-only views, so copies can share the underlying arrays
+        return self
+
+
+def memory_chunk_size(tree, collections, memory_mb):
+    # Number of events whose collections take about memory_mb MB in memory, from the uncompressed
+    # size of their branches
+    n_bytes = sum(tree[leaf_name(name, field)].uncompressed_bytes for name, field in stored_fields(tree, collections))
+    bytes_per_event = MEMORY_FACTOR * n_bytes / max(tree.num_entries, 1)
+    if not bytes_per_event:
+        return max(tree.num_entries, 1)
+    return max(int(memory_mb * 1024 * 1024 / bytes_per_event), 1)
+
+
+def stored_fields(tree, collections):
+    # (collection, field) pairs of the collections whose branches are in the tree
+    return [
+        (name, field) for name in collections for field in COLLECTIONS[name] if leaf_name(name, field) in tree
+    ]
+
+
+def prefetch(chunks):
+    # Iterate over chunks while a background thread reads the next one
+    # The fields read from the previous chunks are read in advance, the others when they are accessed.
+    # Nothing is read yet when the second chunk is submitted, so it gets all fields of the collections.
+    fields = set()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        chunks = iter(chunks)
+        current = next(chunks, None)
+        while current is not None:
+            following = next(chunks, None)
+            future = None
+            if following is not None:
+                preloaded = sorted(fields) if fields else stored_fields(current.tree, current.collections)
+                future = executor.submit(following.preload, preloaded)
+            yield current
+            fields |= current.fields_read
+            if future is not None:
+                future.result()
+            current = following
+
+
+def masked_offsets(offsets, mask):
+    # Offsets per event of the objects passing a mask over the flat arrays
+    passed = np.zeros(len(mask) + 1, dtype=np.int64)
+    np.cumsum(mask, out=passed[1:])
+    return passed[offsets]
@@ -1,241 +1,249 @@
 # Plotting the efficiency and fake rate of tau reconstruction
-
-from ROOT import TFile, TEfficiency, TH1D
-import utils
-
-
-class EventTauFinder:
-    def __init__(self, tree):
-        # Initialize
-        self.tree = tree
-        self.count = 0
-        # Count generator level taus
-        for particle in tree.skimmedGenParticles:
-            if abs(particle.core.pdgId) == 15 and particle.core.status == 2:
-                self.count += 1
-        self.taus = []  # List of taus
-        # Create data objects for storing information about tau jets
-        for i in range(self.count):
-            self.taus.append(TauJet())
-        # Find taus
-        self.__get_gen_taus()
-        self.__get_rec_taus()
-
-    def __get_gen_taus(self):
-        # Sort through generator level tau and calculate tau jets
-        particles = tree.skimmedGenParticles
-        neutrinos = []
-        for particle in particles:
-            id = particle.core.pdgId
-            # Find neutrinos
-            if abs(id) == 16:
-                neutrinos.append(particle)
-                continue
-            elif abs(id) != 15:
-                continue
-            # Save final state taus
-            if particle.core.status == 2:
-                self.__add_tau(particle)
-        # Add neutrinos to corresponding taus
-        for neutrino in neutrinos:
-            self.__add_neutrino(neutrino)
-
-    def __get_rec_taus(self):
-        # Sort through reconstructed tau jets
-        jets = self.tree.jets
-        tags = self.tree.tauTags
-        for i in range(len(jets)):
-            if tags[i].tag < 0.5:
-                continue
-            self.__add_reconstruction(jets[i])
-
-    def __add_tau(self, tau):
-        # Save generator level tau particle
-        for obj in self.taus:
-            if not obj.gen_tau and not obj.rec_taujet:
-                obj.create_gen_tau(tau)
-                break
-
-    def __add_neutrino(self, neutrino):
-        # Add corresponding neutrinos to generator level tau particles
-        for obj in self.taus:
-            if not obj.gen_neutrino:
-                if obj.match_neutrino(neutrino):
-                    break
-
-    def __add_reconstruction(self, jet):
-        # Match a reconstruction to a generator level tau
-        for obj in self.taus:
-            if not obj.rec_taujet and obj.gen_tau:
-                if obj.match_reconstruction(jet):
-                    return
-        fake = TauJet()
-        fake.create_rec_tau(jet)
-        self.taus.append(fake)
-
-    def get_gen_taus(self):
-        # Return a list of all generated taus
-        gen_taus = []
-        for obj in self.taus:
-            if obj.gen_tau:
-                gen_taus.append(obj)
-        return gen_taus
-
-    def get_rec_taus(self):
-        # Return a list of all reconstructed tau jets
-        rec_taus = []
-        for obj in self.taus:
-            if obj.rec_taujet:
-                rec_taus.append(obj)
-        return rec_taus
-
-    def count_gens(self):
-        # Return number of generated taus
-        count = 0
-        for tau in self.taus:
-            if tau.gen_tau:
-                count += 1
-        return count
-
-    def count_recs(self):
-        # Return number of reconstructed tau jets
-        count = 0
-        for tau in self.taus:
-            if tau.rec_taujet:
-                count += 1
-        return count
-
-    def count_correct_tag(self):
-        # Return number of correctly tagged tau jets
-        count = 0
-        for tau in self.taus:
-            if tau.check_reconstructed():
-                count += 1
-        return count
-
-
-class TauJet:
-    def __init__(self):
-        # Generator level information
-        self.gen_tau = None
-        self.gen_neutrino = None
-        self.gen_vector = None
-        # self.previous_states = []
-        # Reconstruction information
-        self.rec_taujet = None
-        self.rec_vector = None
-
-    def create_gen_tau(self, tau):
-        # Create a generator level tau
-        self.gen_tau = tau
-        self.gen_vector = utils.get_lorentz_vector(tau)
-
-    def match_neutrino(self, neutrino):
-        # Match a tau neutrino to a generator level tau particle
-        if self.gen_tau.core.pdgId * neutrino.core.pdgId > 0:
-            self.gen_neutrino = neutrino
-            self.gen_vector = utils.get_lorentz_vector(self.gen_tau) - utils.get_lorentz_vector(neutrino)
-            return True
-        return False
-
-    def create_rec_tau(self, taujet):
-        # Create a reconstructed tau jet
-        self.rec_taujet = taujet
-        self.rec_vector = utils.get_lorentz_vector(taujet)
-
-    def match_reconstruction(self, jet):
-        # Match a reconstructed tau jet to a generator level tau
-        if self.rec_taujet:
-            return False
-        vector = utils.get_lorentz_vector(jet)
-        deltaR = self.gen_vector.DeltaR(vector)
-        if deltaR < 0.05:
-            self.rec_taujet = jet
-            self.rec_vector = vector
-            return True
-        return False
-
-    def check_reconstructed(self):
-        # Check whether a tau has been correctly reconstructed
-        if self.rec_taujet and self.gen_tau:
-            return True
-        return False
-
-    def check_fake(self):
-        # Check whether a tau is fake
-        if self.rec_taujet and not self.gen_tau:
-            return True
-        return False
-
-    def pt(self):
-        # Return the pT of the tau
-        if self.rec_taujet:
-            return utils.get_pt(self.rec_vector)
-        return utils.get_pt(self.gen_vector)
-
-    def visible_pt(self):
-        # Return the visible pT of a generator tau
-        if not self.gen_tau:
-            return None
-        vector = utils.get_lorentz_vector(self.gen_tau)
-        return utils.get_pt(vector)
-
-    def eta(self):
-        # Return the eta of the tau
-        if self.gen_vector:
-            return self.gen_vector.Eta()
-        return self.rec_vector.Eta()
-
-
-def fill_histograms(taus, efficiency_pt, fakerate_pt):
-    # Fill efficiency histogram
-    gen_taus = taus.get_gen_taus()
-    for tau in gen_taus:
-        value = tau.check_reconstructed()
-        efficiency_pt.Fill(value, tau.visible_pt())
-
-    # Fill fake rate histogram
-    rec_taus = taus.get_rec_taus()
-    for tau in rec_taus:
-        fakerate_pt.Fill(tau.check_fake(), tau.pt())
-
-
-# Files
-inf = TFile('data/delphes_output.root')
-outf = TFile('data/rec_efficiency.root', 'RECREATE')
-
-# Create histograms
-efficiency_pt = TEfficiency('efficiency', 'efficiency (pT)', 13, 0, 130)
-fakerate_pt = TEfficiency('fake rate', 'fake rate (pT)', 13, 0, 130)
-
-n_tag = 0  # Count of correctly tagged true taus
-n_gen = 0  # Count of true taus
-n_rec = 0  # Count of reconstructed tau jets
-n_fake = 0  # Count of fake tau jets
-
-# Read events
-tree = inf.Get('events')
-n_tot = tree.GetEntries()
-for event in range(n_tot):
-    tree.GetEntry(event)
-    taus = EventTauFinder(tree)
+#
+# The tau candidates of a chunk are a table with a row per generator tau and per fake tau-tagged jet
+# (skim.TauCandidates), the counters and histograms are filled from masks of its rows. The efficiency and
+# fake rate are also binned in the variables of EFFICIENCY_VARIABLES and FAKE_RATE_VARIABLES, all filled
+# from the same rows (see efficiencies.py). With --scan the tau tag threshold is also scanned: all jets are
+# matched to the generator taus, the tau-tagged ones as in the nominal matching and the others from the highest
+# tag down, and recorded with their tag (see threshold_scan.py).
+from decay_tree import UNKNOWN_MODE
+from histograms import new_efficiency
+from match_cache import MatchCache
+from vectors import LorentzArray
+import efficiencies
+import entry
+import histograms
+import numpy as np
+import profiling
+import skim
+import sys
+import threshold_scan
+
+COLLECTIONS = ['jets', 'tauTags', 'skimmedGenParticles']
+INPUT = 'data/delphes_output.root'
+OUTPUT = 'data/rec_efficiency.root'
+
+# Binned variables of the efficiency (generator taus) and of the fake rate (tau-tagged jets): pT of the
+# generator tau as in efficiency_pt, eta and phi of the visible tau, and pT, eta and phi of the jets
+PT_EDGES = [0, 10, 20, 30, 40, 50, 70, 100, 130]
+ETA_EDGES = [-3, -2, -1.5, -1, -0.5, 0, 0.5, 1, 1.5, 2, 3]
+EFFICIENCY_VARIABLES = {
+    'pt': [('pt', PT_EDGES)],
+    'eta': [('eta', efficiencies.uniform(20, -3, 3))],
+    'phi': [('phi', efficiencies.uniform(16, -np.pi, np.pi))],
+    'decay_mode': [('decay_mode', efficiencies.integers(-3, 14))],
+    'pt_eta': [('pt', PT_EDGES), ('eta', ETA_EDGES)],
+}
+FAKE_RATE_VARIABLES = {
+    'pt': [('pt', PT_EDGES)],
+    'eta': [('eta', efficiencies.uniform(20, -3, 3))],
+    'phi': [('phi', efficiencies.uniform(16, -np.pi, np.pi))],
+    'n_constituents': [('n_constituents', efficiencies.integers(0, 40))],
+    'pt_eta': [('pt', PT_EDGES), ('eta', ETA_EDGES)],
+}
+
+# Thresholds of the tau tag scan
+TAG_THRESHOLDS = np.linspace(0, 1, 201)
+
+
+@profiling.timed('tau candidates')
+def get_candidates(chunk, match_cache=None):
+    # Table of the generator taus and fake tau-tagged jets of a chunk, see skim.TauCandidates
+    # match_cache: MatchCache reused between runs
+    matches = skim.get_matches(chunk, match_cache) if match_cache else None
+    return skim.TauCandidates(chunk, matches)
+
+
+@profiling.timed('tag scan')
+def fill_tag_scan(chunk, counts):
+    # Record every generator tau with the tag of its jet among all jets (not only the tau-tagged ones), and
+    # every jet without a generator tau with its tag
+    # The tau-tagged jets keep their nominal matches, so the row of skim.TAG_THRESHOLD has the nominal counts,
+    # and the other jets are matched from the highest tag down to the generator taus left (see check_tag_scan)
+    candidates = skim.TauCandidates(chunk, skim.find_matches(chunk, tag_threshold=-np.inf, by_tag=True))
+    tags = skim.column(chunk['tauTags']['tag'], candidates.jet, candidates.rec, np.float64,
+                       threshold_scan.NEVER['above'])
+    threshold_scan.fill(counts, tags, candidates.gen)
+
+
+@profiling.timed()
+def fill_histograms(gen, rec, gen_columns, rec_columns, outputs):
+    # Fill counters and histograms from the masks of the candidates with a generator tau and with a
+    # tau-tagged jet, and the columns of the variables of their generator tau and of their jet
+    matched = gen & rec
 
     # Count taus
-    curr_recs = taus.count_recs()
-    curr_correct = taus.count_correct_tag()
-    n_gen += taus.count_gens()
-    n_rec += curr_recs
-    n_tag += curr_correct
-    n_fake += curr_recs - curr_correct
-
-    fill_histograms(taus, efficiency_pt, fakerate_pt)
-
-# Print out results
-print("Generated taus: ", n_gen)
-print("Reconstructed tau jets: ", n_rec)
-print("Correctly tagged taus: ", n_tag)
-print("Efficiency over entire dataset: ", n_tag / n_gen)
-print("Fake rate over entire dataset: ", n_fake / n_rec)
-
-# Write histograms to file
-outf.Write()
+    outputs['n_gen'] += int(gen.sum())
+    outputs['n_rec'] += int(rec.sum())
+    outputs['n_tag'] += int(matched.sum())
+    outputs['n_fake'] += int((rec & ~gen).sum())
+
+    # Fill efficiency and fake rate histograms
+    outputs['efficiency_pt'].fill(matched[gen], gen_columns['pt'][gen])
+    outputs['fakerate_pt'].fill(~gen[rec], rec_columns['pt'][rec])
+    efficiencies.fill(outputs['efficiencies'], matched[gen], {key: values[gen] for key, values in gen_columns.items()})
+    efficiencies.fill(outputs['fake_rates'], ~gen[rec], {key: values[rec] for key, values in rec_columns.items()})
+
+
+def create_outputs():
+    # Create histograms and counters
+    outputs = {
+        'efficiency_pt': new_efficiency('efficiency', 'efficiency (pT)', 13, 0, 130),
+        'fakerate_pt': new_efficiency('fake rate', 'fake rate (pT)', 13, 0, 130),
+        'efficiencies': efficiencies.create('efficiency', 'efficiency', EFFICIENCY_VARIABLES),
+        'fake_rates': efficiencies.create('fake_rate', 'fake rate', FAKE_RATE_VARIABLES),
+        'n_tag': 0,  # Count of correctly tagged true taus
+        'n_gen': 0,  # Count of true taus
+        'n_rec': 0,  # Count of reconstructed tau jets
+        'n_fake': 0  # Count of fake tau jets
+    }
+    return outputs
+
+
+def get_columns(gen_vectors, visible_vectors, rec_vectors, decay_modes, constituent_counts):
+    # Columns of the variables of the generator taus and of the jets of the candidates, see EFFICIENCY_VARIABLES
+    gen_columns = {
+        'pt': gen_vectors.pt(),
+        'eta': visible_vectors.eta(),
+        'phi': visible_vectors.phi(),
+        'decay_mode': decay_modes,
+    }
+    rec_columns = {
+        'pt': rec_vectors.pt(),
+        'eta': rec_vectors.eta(),
+        'phi': rec_vectors.phi(),
+        'n_constituents': constituent_counts,
+    }
+    return gen_columns, rec_columns
+
+
+def process(chunk, outputs, match_cache=None):
+    candidates = get_candidates(chunk, match_cache)
+    gen_columns, rec_columns = get_columns(candidates.gen_vectors, candidates.visible_vectors, candidates.rec_vectors,
+                                           candidates.decay_modes(), candidates.constituent_counts())
+    fill_histograms(candidates.gen, candidates.rec, gen_columns, rec_columns, outputs)
+
+
+def process_candidates(candidates, outputs):
+    # Fill histograms and counters from the tau candidates of a skim made by skim.py
+    def vectors(prefix):
+        return LorentzArray(*(candidates[prefix + component] for component in ('_px', '_py', '_pz', '_e')))
+
+    # skims made before the decay modes were added have none
+    decay_modes = candidates.get('decay_mode', np.full(len(candidates['gen']), UNKNOWN_MODE))
+    gen_columns, rec_columns = get_columns(vectors('gen'), vectors('vis'), vectors('rec'), decay_modes,
+                                           candidates['parts_n'])
+    fill_histograms(candidates['gen'], candidates['rec'], gen_columns, rec_columns, outputs)
+
+
+def finish(outputs, intervals=False):
+    # Print out results, with the binned efficiencies and fake rates and their intervals if intervals is set
+    print("Generated taus: ", outputs['n_gen'])
+    print("Reconstructed tau jets: ", outputs['n_rec'])
+    print("Correctly tagged taus: ", outputs['n_tag'])
+    print("Efficiency over entire dataset: ", outputs['n_tag'] / outputs['n_gen'])
+    print("Fake rate over entire dataset: ", outputs['n_fake'] / outputs['n_rec'])
+    if intervals:
+        efficiencies.print_tables(outputs['efficiencies'])
+        efficiencies.print_tables(outputs['fake_rates'])
+
+
+def check_tag_scan(result, outputs):
+    # The row of the nominal threshold of a scan has the counts and fake rate of the nominal matching
+    nominal = int(np.flatnonzero(result['threshold'] == skim.TAG_THRESHOLD)[0])
+    assert (result['signal'][nominal], result['background'][nominal]) == (outputs['n_tag'], outputs['n_fake']), \
+        'tag scan at {}: {} correctly tagged taus and {} fake tau jets instead of {} and {}'.format(
+            skim.TAG_THRESHOLD, result['signal'][nominal], result['background'][nominal], outputs['n_tag'],
+            outputs['n_fake'])
+    assert result['fake_rate'][nominal] == outputs['n_fake'] / max(outputs['n_rec'], 1)
+
+
+class Analysis:
+    def __init__(self, match_cache=None, intervals=False, scan_table=None):
+        # This analysis with the options of main, passed to the workers with its process method
+        # match_cache: MatchCache reused between runs
+        # intervals: print the binned efficiencies and fake rates with their intervals
+        # scan_table: file of the scan of the tau tag threshold, no scan if None
+        self.__name__ = __name__
+        self.COLLECTIONS = COLLECTIONS
+        self.INPUT = INPUT
+        self.OUTPUT = OUTPUT
+        self.match_cache = match_cache
+        self.intervals = intervals
+        self.scan_table = scan_table
+
+    def create_outputs(self):
+        outputs = create_outputs()
+        if self.scan_table:
+            outputs['tag_scan'] = threshold_scan.create('tag_scan', 'tau tag', TAG_THRESHOLDS)
+        return outputs
+
+    def process(self, chunk, outputs):
+        process(chunk, outputs, self.match_cache)
+        if self.scan_table:
+            fill_tag_scan(chunk, outputs['tag_scan'])
+
+    def finish(self, outputs):
+        finish(outputs, self.intervals)
+        if self.scan_table:
+            result = threshold_scan.scan(outputs['tag_scan'], 'above')
+            threshold_scan.print_scan('tau tag', result, 'above')
+            threshold_scan.write_table(self.scan_table, result)
+            check_tag_scan(result, outputs)
+
+
+def main(argv=None):
+    module = sys.modules[__name__]
+    parser = entry.parser(module, 'Tau reconstruction efficiency and fake rate')
+    parser.add_argument('--skim', help='read the tau candidates of a skim made by skim.py instead of the events, '
+                                       'at once in this process')
+    parser.add_argument('--match-cache', help='directory caching the jet matching between runs')
+    parser.add_argument('--match-cache-size', type=float, default=1000, help='size limit of the match cache in MB')
+    parser.add_argument('--intervals', action='store_true',
+                        help='print the binned efficiencies and fake rates with Clopper-Pearson intervals')
+    parser.add_argument('--scan', metavar='FILE',
+                        help='scan the tau tag threshold and write the efficiency, fake rate and yields of every '
+                             'threshold to FILE as CSV')
+    args = parser.parse_args(argv)
+    if args.scan and args.skim:
+        parser.error('--scan needs the events, the skim only has the tau-tagged jets')
+    if args.skim:
+        # the skim is read at once in this process, without the event loop these options apply to
+        event_options = {'inputs': 'input files', 'workers': '-j', 'memory': '--memory', 'prefetch': '--prefetch',
+                         'memory_report': '--memory-report', 'profile': '--profile', 'profile_dump': '--profile-dump',
+                         'incremental': '--incremental', 'checkpoint_interval': '--checkpoint-interval',
+                         'startup_time': '--startup-time', 'match_cache': '--match-cache'}
+        used = [option for name, option in event_options.items() if getattr(args, name) != parser.get_default(name)]
+        if used:
+            parser.error('{} cannot be used with --skim, which is read without the event loop'.format(', '.join(used)))
+    if not args.skim:
+        match_cache = MatchCache(args.match_cache, args.match_cache_size) if args.match_cache else None
+        # the workers take whole blocks of the match cache
+        entry.run(Analysis(match_cache, args.intervals, args.scan), args,
+                  unit_size=match_cache.block_size if match_cache else None)
+        return
+
+    # files
+    histograms.NUMPY = args.numpy
+    if not args.numpy:
+        from ROOT import TFile
+        outf = TFile(args.output, 'RECREATE')
+
+    # read the tau candidates
+    outputs = create_outputs()
+    process_candidates(skim.read(args.skim), outputs)
+    histograms.flush(outputs)
+    finish(outputs, args.intervals)
+
+    # write to file
+    if args.numpy:
+        histograms.save(outputs, histograms.numpy_path(args.output))
+    else:
+        outf.Write()
+        outf.cd()
+        for obj in histograms.accumulators(outputs):
+            obj.to_root().Write()
+
+
+if __name__ == '__main__':
+    main()
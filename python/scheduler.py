@@ -0,0 +1,135 @@
+# Running several analyses on one read of the events tree
+#
+# An analysis module defines COLLECTIONS (the collections it reads), OUTPUT (its output file),
+# create_outputs() returning its histograms and counters, process(chunk, outputs) and optionally
+# finish(outputs) for printing results, as the scripts in this directory do.
+import argparse
+import histograms
+import importlib
+import incremental
+import parallel
+import particle_index
+import profiling
+import reader
+
+
+class Scheduler:
+    def __init__(self):
+        # Registered analysis modules by name, with the output file of each
+        self.analyses = {}
+
+    def register(self, module, output=None):
+        # Add an analysis module (or module name), writing to its OUTPUT file unless another one is given
+        if isinstance(module, str):
+            module = importlib.import_module(module)
+        name = module.__name__
+        if name in self.analyses:
+            raise ValueError('Analysis registered twice: {}'.format(name))
+        self.analyses[name] = (module, output or module.OUTPUT)
+
+    def collections(self):
+        # Union of the collections read by the registered analyses
+        collections = []
+        for module, output in self.analyses.values():
+            for collection in module.COLLECTIONS:
+                if collection not in collections:
+                    collections.append(collection)
+        return collections
+
+    def run(self, inputs, n_workers=None, chunk_size=10000, memory_mb=None, incremental_run=False,
+            checkpoint_interval=None, unit_size=None):
+        # Read each event once, let every analysis process it and write each analysis to its own file
+        # incremental_run: only process the inputs not yet in the outputs and add to them, see incremental.py
+        # unit_size: see parallel.run
+        process = MultiProcess([(name, module.process) for name, (module, output) in self.analyses.items()])
+        if incremental_run:
+            outputs = incremental.run(self.analyses, inputs, self.collections(), process, n_workers, chunk_size,
+                                      memory_mb, checkpoint_interval, unit_size)
+            for name, (module, output) in self.analyses.items():
+                if hasattr(module, 'finish'):
+                    module.finish(outputs[name])
+            return outputs
+
+        if not histograms.NUMPY:
+            from ROOT import TFile
+        files = {}
+
+        def create_outputs():
+            # histograms are created in the output file of their analysis, NumPy histograms need no file
+            outputs = {}
+            for name, (module, output) in self.analyses.items():
+                if not histograms.NUMPY:
+                    files[name] = TFile(output, 'RECREATE')
+                outputs[name] = module.create_outputs()
+            return outputs
+
+        outputs = parallel.run(inputs, self.collections(), create_outputs, process, n_workers, chunk_size,
+                               memory_mb=memory_mb, unit_size=unit_size)
+
+        for name, (module, output) in self.analyses.items():
+            if hasattr(module, 'finish'):
+                module.finish(outputs[name])
+            if histograms.NUMPY:
+                histograms.save(outputs[name], histograms.numpy_path(output))
+            else:
+                files[name].Write()
+                # NumPy accumulators of a ROOT output (histograms.BinnedEfficiency) are written as ROOT objects
+                files[name].cd()
+                for obj in histograms.accumulators(outputs[name]):
+                    obj.to_root().Write()
+                files[name].Close()
+        return outputs
+
+
+class MultiProcess:
+    def __init__(self, processes):
+        # Process function dispatching each chunk to the process function of every analysis
+        self.processes = processes
+
+    def __call__(self, chunk, outputs):
+        for name, process in self.processes:
+            process(chunk, outputs[name])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run several analyses with a single read of the input')
+    parser.add_argument('inputs', nargs='+', help='input files, glob patterns or manifests')
+    parser.add_argument('-a', '--analyses', nargs='+', required=True, help='analysis modules, e.g. tau_deltaR')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='number of worker processes (1 by default)')
+    parser.add_argument('--persist-index', action='store_true',
+                        help='keep the particle index of every chunk next to the input files for the next runs')
+    parser.add_argument('--numpy', action='store_true',
+                        help='fill NumPy histograms and save them next to the outputs as .npz, see histograms.py')
+    parser.add_argument('--memory', type=float,
+                        help='size the chunks of events to take about this many MB in memory')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='read the next chunk while the current one is processed')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='print the peak resident memory of every chunk')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time spent in the stages of the analysis at the end')
+    parser.add_argument('--profile-dump', metavar='FILE',
+                        help='profile the run with cProfile and write the statistics to FILE')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only process the inputs not yet in the outputs and add them, see incremental.py')
+    parser.add_argument('--checkpoint-interval', type=float,
+                        help='seconds between the checkpoints of an incremental run')
+    args = parser.parse_args(argv)
+    particle_index.PERSIST = args.persist_index
+    histograms.NUMPY = args.numpy
+    reader.PREFETCH = args.prefetch
+    reader.MEMORY_REPORT = args.memory_report
+    profiling.ENABLED = args.profile
+    profiling.PROFILE = args.profile_dump
+
+    scheduler = Scheduler()
+    for analysis in args.analyses:
+        scheduler.register(analysis)
+    profiling.start()
+    scheduler.run(args.inputs, args.workers, memory_mb=args.memory, incremental_run=args.incremental,
+                  checkpoint_interval=args.checkpoint_interval)
+    profiling.finish()
+
+
+if __name__ == '__main__':
+    main()
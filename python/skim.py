@@ -0,0 +1,378 @@
+# Skimming tau candidates into a flat ntuple with one row per candidate
+#
+# Candidates are the final state generator taus (status 2) and the tau-tagged jets that do not match
+# any of them, the rows of TauCandidates, from which rec_efficiency fills its histograms too. The tau
+# neutrinos are assigned to the taus from the decay tree if the input has vertex links.
+import argparse
+import multiprocessing
+import numpy as np
+import uproot
+from dataset import Dataset
+from decay_tree import UNKNOWN_MODE, get_tree
+from jet_constituents import constituent_sums
+from match_cache import MatchCache
+from reader import masked_offsets
+from vectors import LorentzArray
+import matching
+import parallel
+
+COLLECTIONS = ['jets', 'tauTags', 'skimmedGenParticles', 'jetParts']
+TREE_NAME = 'taus'
+
+# Tau tag threshold of the tau-tagged jets
+TAG_THRESHOLD = 0.5
+
+BRANCHES = {
+    'event': np.int64,  # entry of the event in its input file
+    'file': np.int32,  # index of the input file in the dataset
+    'gen': np.bool_,  # candidate has a generator tau
+    'rec': np.bool_,  # candidate has a tau-tagged jet
+    'matched': np.bool_,  # generator tau with a matching tau-tagged jet
+    'has_neutrino': np.bool_,  # generator tau with an assigned tau neutrino
+    'gen_pdgId': np.int32,
+    'decay_mode': np.int32,  # decay mode of the generator tau, see decay_tree.ELECTRON_MODE
+    'gen_px': np.float64,
+    'gen_py': np.float64,
+    'gen_pz': np.float64,
+    'gen_e': np.float64,
+    'vis_px': np.float64,  # generator tau minus its neutrinos
+    'vis_py': np.float64,
+    'vis_pz': np.float64,
+    'vis_e': np.float64,
+    'rec_px': np.float64,
+    'rec_py': np.float64,
+    'rec_pz': np.float64,
+    'rec_e': np.float64,
+    'rec_tag': np.float32,
+    'delta_r': np.float64,  # delta R between the visible generator tau and the matched jet
+    'parts_e': np.float64,  # energy sum of the jet constituents
+    'parts_n': np.int32,  # number of jet constituents
+}
+
+
+def group_rank(keys):
+    # Position of every element among the elements with the same key, in their original order
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    group_starts = np.repeat(starts, np.diff(np.r_[starts, len(keys)]))
+    ranks = np.empty(len(keys), dtype=np.int64)
+    ranks[order] = np.arange(len(keys)) - group_starts
+    return ranks
+
+
+def assign_neutrinos(tau_events, tau_pdg_ids, neutrino_events, neutrino_pdg_ids):
+    # Give the n-th tau neutrino of an event to the n-th tau of the same sign, returns -1 for taus without one
+    tau_keys = tau_events * 2 + (tau_pdg_ids > 0)
+    neutrino_keys = neutrino_events * 2 + (neutrino_pdg_ids > 0)
+    tau_ranks = group_rank(tau_keys)
+    neutrino_ranks = group_rank(neutrino_keys)
+    n_ranks = max(tau_ranks.max(initial=0), neutrino_ranks.max(initial=0)) + 1
+    tau_keys = tau_keys * n_ranks + tau_ranks
+    neutrino_keys = neutrino_keys * n_ranks + neutrino_ranks
+
+    order = np.argsort(neutrino_keys)
+    position = np.searchsorted(neutrino_keys[order], tau_keys)
+    position = np.minimum(position, max(len(order) - 1, 0))
+    found = np.zeros(len(tau_keys), dtype=bool)
+    if len(order):
+        found = neutrino_keys[order][position] == tau_keys
+    return np.where(found, order[position] if len(order) else -1, -1)
+
+
+def tau_neutrinos(particles, taus):
+    # Tau neutrino of each generator tau (flat indices), -1 if none, from the decay tree, or by the order
+    # of the same-sign neutrinos if the input has no vertex links
+    tree = get_tree(particles)
+    if tree is not None:
+        return tree.tau_neutrinos(taus)
+    pdg_ids = particles['pdgId']
+    events = particles.event_index()
+    is_neutrino = np.abs(pdg_ids) == 16
+    neutrinos = assign_neutrinos(events[taus], pdg_ids[taus], events[is_neutrino], pdg_ids[is_neutrino])
+    neutrinos[neutrinos >= 0] = np.flatnonzero(is_neutrino)[neutrinos[neutrinos >= 0]]
+    return neutrinos
+
+
+def visible_taus(particles, taus, neutrinos, vectors):
+    # Visible vectors of the generator taus: the sum over their decay products without the neutrinos
+    # from the decay tree, or the tau minus its neutrino if the input has no vertex links
+    tree = get_tree(particles)
+    if tree is not None:
+        return tree.visible_taus(taus, vectors)
+    has_neutrino = neutrinos >= 0
+    visible = vectors[taus]
+    visible[has_neutrino] = visible[has_neutrino] - vectors[neutrinos[has_neutrino]]
+    return visible
+
+
+def local_indices(mask, offsets):
+    # Jagged field of the event-local indices of the objects passing a mask
+    flat = np.flatnonzero(mask)
+    events = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    return flat - offsets[events[flat]], masked_offsets(offsets, mask)
+
+
+def find_matches(chunk, tag_threshold=TAG_THRESHOLD, cone=matching.CONE_SIZE, by_tag=False):
+    # Match the tau-tagged jets of a chunk to the visible generator taus
+    # by_tag: match the jets passing TAG_THRESHOLD first, in their order, then the others from the highest tag
+    # down, so the jets passing TAG_THRESHOLD have their nominal matches (see rec_efficiency.fill_tag_scan)
+    # Returns jagged fields (flat values, offsets per event) with event-local indices:
+    # tau:       generator taus (status 2) in skimmedGenParticles
+    # neutrino:  tau neutrino assigned to each generator tau in skimmedGenParticles, -1 if none
+    # jet:       tau-tagged jets in jets
+    # jet_match: generator tau (position in tau) matched to each tau-tagged jet, -1 if none
+    # delta_r:   delta R of each tau-tagged jet to its generator tau, inf if none
+    particles = chunk['skimmedGenParticles']
+    pdg_ids = particles['pdgId']
+    particle_events = particles.event_index()
+    particle_vectors = LorentzArray.from_collection(particles)
+
+    # generator taus and their neutrinos
+    is_tau = (np.abs(pdg_ids) == 15) & (particles['status'] == 2)
+    taus, tau_offsets = local_indices(is_tau, particles.offsets)
+    tau_indices = np.flatnonzero(is_tau)
+    neutrinos = tau_neutrinos(particles, tau_indices)
+    visible_vectors = visible_taus(particles, tau_indices, neutrinos, particle_vectors)
+    has_neutrino = neutrinos >= 0
+    neutrino_indices = np.full(len(neutrinos), -1, dtype=np.int64)
+    neutrino_indices[has_neutrino] = neutrinos[has_neutrino] - particles.offsets[particle_events[is_tau][has_neutrino]]
+
+    # tau-tagged jets matched to the visible generator taus
+    jets = chunk['jets']
+    tags = chunk['tauTags']['tag']
+    tagged = ~(tags < tag_threshold)
+    tagged_jets, jet_offsets = local_indices(tagged, jets.offsets)
+    priority = np.where(tags < TAG_THRESHOLD, tags, np.inf)[tagged] if by_tag else None
+    jet_matches, jet_delta_r = matching.match_chunk(
+        LorentzArray.from_collection(jets)[tagged], jet_offsets, visible_vectors, tau_offsets, cone, 'greedy',
+        priority
+    )
+    matched = jet_matches >= 0
+    jet_matches[matched] -= tau_offsets[jets.event_index()[tagged][matched]]
+
+    return {
+        'tau': (taus, tau_offsets),
+        'neutrino': (neutrino_indices, tau_offsets),
+        'jet': (tagged_jets, jet_offsets),
+        'jet_match': (jet_matches, jet_offsets),
+        'delta_r': (jet_delta_r, jet_offsets),
+    }
+
+
+def get_matches(chunk, cache=None):
+    # Matches of a chunk with the default tag threshold and cone, read from a MatchCache if one is given
+    if cache is None:
+        return find_matches(chunk)
+    parameters = {'tag_threshold': TAG_THRESHOLD, 'cone': matching.CONE_SIZE, 'neutrinos': 'decay_tree'}
+    return cache.get(chunk, 'tau_matches', parameters, find_matches)
+
+
+class TauCandidates:
+    def __init__(self, chunk, matches=None):
+        # Table of the tau candidates of a chunk with a column (array) per property, from the matches of
+        # find_matches if given. One row per generator tau, followed by the fake jets of each event:
+        # event:    chunk-local index of the event
+        # tau:      flat index of the generator tau in skimmedGenParticles, -1 for fake jets
+        # neutrino: flat index of the neutrino assigned to the generator tau, -1 if none
+        # jet:      flat index of the tau-tagged jet in jets, -1 for generator taus without one
+        # delta_r:  delta R between the visible generator tau and the jet, 0 without both
+        # gen_vectors, visible_vectors, rec_vectors: LorentzArray of the generator tau, generator tau without
+        #           its neutrinos and jet of each row, zero where there is none
+        if matches is None:
+            matches = find_matches(chunk)
+        self.chunk = chunk
+        particles = chunk['skimmedGenParticles']
+        particle_vectors = LorentzArray.from_collection(particles)
+
+        # generator taus and their neutrinos
+        taus, tau_offsets = matches['tau']
+        tau_events = np.repeat(np.arange(chunk.n_events), np.diff(tau_offsets))
+        tau_indices = particles.offsets[tau_events] + taus
+        neutrinos = matches['neutrino'][0]
+        has_neutrino = neutrinos >= 0
+        neutrino_indices = np.full(len(neutrinos), -1, dtype=np.int64)
+        neutrino_indices[has_neutrino] = particles.offsets[tau_events[has_neutrino]] + neutrinos[has_neutrino]
+        visible_vectors = visible_taus(particles, tau_indices, neutrino_indices, particle_vectors)
+
+        # tau-tagged jets and their generator taus
+        jets = chunk['jets']
+        tagged_jets, jet_offsets = matches['jet']
+        jet_events = np.repeat(np.arange(chunk.n_events), np.diff(jet_offsets))
+        jet_indices = jets.offsets[jet_events] + tagged_jets
+        jet_matches = matches['jet_match'][0].copy()
+        jet_matches[jet_matches >= 0] += tau_offsets[jet_events[jet_matches >= 0]]
+
+        # rows of generator taus, followed by the fake jets of each event
+        n_taus = len(tau_indices)
+        fakes = np.flatnonzero(jet_matches < 0)
+        tau_jets = np.full(n_taus, -1, dtype=np.int64)
+        tau_jets[jet_matches[jet_matches >= 0]] = np.flatnonzero(jet_matches >= 0)
+        rows_tau = np.r_[np.arange(n_taus), np.full(len(fakes), -1)]
+        rows_jet = np.r_[tau_jets, fakes]
+        rows_event = np.r_[tau_events, jet_events[fakes]]
+        order = np.argsort(rows_event * 2 + (rows_tau < 0), kind='stable')
+        rows_tau = rows_tau[order]
+        rows_jet = rows_jet[order]
+        gen = rows_tau >= 0
+        rec = rows_jet >= 0
+
+        self.event = rows_event[order]
+        self.tau = column(tau_indices, rows_tau, gen, np.int64, -1)
+        self.neutrino = column(neutrino_indices, rows_tau, gen, np.int64, -1)
+        self.jet = column(jet_indices, rows_jet, rec, np.int64, -1)
+        self.delta_r = column(matches['delta_r'][0], rows_jet, gen & rec, np.float64)
+        self.gen_vectors = vector_column(particle_vectors[tau_indices], rows_tau, gen)
+        self.visible_vectors = vector_column(visible_vectors, rows_tau, gen)
+        self.rec_vectors = vector_column(LorentzArray.from_collection(jets)[jet_indices], rows_jet, rec)
+
+    def __len__(self):
+        return len(self.event)
+
+    @property
+    def gen(self):
+        # Rows with a generator tau
+        return self.tau >= 0
+
+    @property
+    def rec(self):
+        # Rows with a tau-tagged jet
+        return self.jet >= 0
+
+    @property
+    def matched(self):
+        # Generator taus with a matching tau-tagged jet
+        return (self.tau >= 0) & (self.jet >= 0)
+
+    @property
+    def fake(self):
+        # Tau-tagged jets without a generator tau
+        return (self.tau < 0) & (self.jet >= 0)
+
+    def decay_modes(self):
+        # Decay mode of the generator tau of each row, UNKNOWN_MODE without a generator tau or vertex links
+        modes = np.full(len(self), UNKNOWN_MODE, dtype=np.int64)
+        tree = get_tree(self.chunk['skimmedGenParticles'])
+        if tree is not None:
+            gen = self.gen
+            modes[gen] = tree.decay_modes(self.tau[gen])
+        return modes
+
+    def constituent_counts(self):
+        # Number of constituents of the jet of each row, 0 without a jet
+        jets = self.chunk['jets']
+        counts = jets['particles_end'].astype(np.int64) - jets['particles_begin']
+        return column(counts, self.jet, self.rec, np.int64)
+
+    def columns(self):
+        # Columns of the skim, see BRANCHES (without file)
+        gen = self.gen
+        rec = self.rec
+        pdg_ids = self.chunk['skimmedGenParticles']['pdgId']
+        tags = self.chunk['tauTags']['tag']
+        constituents = constituent_sums(self.chunk, self.jet[rec])
+        # position of each row among the rows with a jet
+        rec_rows = np.cumsum(rec) - 1
+        return {
+            'event': self.event + self.chunk.entry_start,
+            'gen': gen,
+            'rec': rec,
+            'matched': self.matched,
+            'has_neutrino': self.neutrino >= 0,
+            'gen_pdgId': column(pdg_ids, self.tau, gen, np.int32),
+            'decay_mode': self.decay_modes(),
+            'gen_px': self.gen_vectors.px,
+            'gen_py': self.gen_vectors.py,
+            'gen_pz': self.gen_vectors.pz,
+            'gen_e': self.gen_vectors.e,
+            'vis_px': self.visible_vectors.px,
+            'vis_py': self.visible_vectors.py,
+            'vis_pz': self.visible_vectors.pz,
+            'vis_e': self.visible_vectors.e,
+            'rec_px': self.rec_vectors.px,
+            'rec_py': self.rec_vectors.py,
+            'rec_pz': self.rec_vectors.pz,
+            'rec_e': self.rec_vectors.e,
+            'rec_tag': column(tags, self.jet, rec, np.float32),
+            'delta_r': self.delta_r,
+            'parts_e': column(constituents['energy'], rec_rows, rec, np.float64),
+            'parts_n': column(constituents['n'], rec_rows, rec, np.int32),
+        }
+
+
+def column(values, rows, present, dtype, missing=0):
+    # Values of the rows with an object, missing for the others
+    result = np.full(len(rows), missing, dtype=dtype)
+    result[present] = values[rows[present]]
+    return result
+
+
+def vector_column(vectors, rows, present):
+    # Vectors of the rows with an object, zero for the others
+    return LorentzArray(*(column(values, rows, present, np.float64) for values in (
+        vectors.px, vectors.py, vectors.pz, vectors.e
+    )))
+
+
+def tau_candidates(chunk, matches=None):
+    # Build the columns of all tau candidates of a chunk, from the matches of find_matches if given
+    return TauCandidates(chunk, matches).columns()
+
+
+def skim_range(task):
+    # Skim one entry range of a file in a worker process
+    file_index, path, entry_start, entry_stop, cache = task
+    columns = {name: [] for name in BRANCHES}
+    for chunk in parallel.get_reader(path).chunks(entry_start, entry_stop):
+        candidates = tau_candidates(chunk, get_matches(chunk, cache))
+        candidates['file'] = np.full(len(candidates['event']), file_index, dtype=np.int32)
+        for name in BRANCHES:
+            columns[name].append(candidates[name])
+    return {name: np.concatenate(values).astype(BRANCHES[name]) for name, values in columns.items()}
+
+
+def write(inputs, output, n_workers=1, chunk_size=10000, cache=None):
+    # Skim all events of the inputs into the output file, keeping the order of the events
+    # cache: MatchCache to reuse the jet matching of earlier runs
+    dataset = inputs if isinstance(inputs, Dataset) else Dataset(inputs)
+    file_indices = {path: i for i, path in enumerate(dataset.files)}
+    tasks = [
+        (file_indices[path], path, entry_start, entry_stop, cache)
+        for path, entry_start, entry_stop in dataset.work_units(chunk_size)
+    ]
+    initargs = (COLLECTIONS, dataset.tree_name, chunk_size)
+
+    with uproot.recreate(output) as outf:
+        tree = outf.mktree(TREE_NAME, BRANCHES)
+        if n_workers <= 1:
+            parallel.init_worker(*initargs)
+            for task in tasks:
+                tree.extend(skim_range(task))
+            return
+        context = multiprocessing.get_context('fork')
+        with context.Pool(n_workers, initializer=parallel.init_worker, initargs=initargs) as pool:
+            for columns in pool.imap(skim_range, tasks):
+                tree.extend(columns)
+
+
+def read(path, branches=None, entry_start=None, entry_stop=None):
+    # Read the candidates of a skim as a dictionary of NumPy arrays
+    with uproot.open(path) as inf:
+        return inf[TREE_NAME].arrays(branches, entry_start=entry_start, entry_stop=entry_stop, library='np')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Skim tau candidates into a flat ntuple')
+    parser.add_argument('inputs', nargs='+', help='input files, glob patterns or manifests')
+    parser.add_argument('-o', '--output', default='data/tau_skim.root', help='output file')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--match-cache', help='directory caching the jet matching between runs')
+    parser.add_argument('--match-cache-size', type=float, default=1000, help='size limit of the match cache in MB')
+    args = parser.parse_args(argv)
+
+    cache = MatchCache(args.match_cache, args.match_cache_size) if args.match_cache else None
+    write(args.inputs, args.output, args.workers, cache=cache)
+
+
+if __name__ == '__main__':
+    main()
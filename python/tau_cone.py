@@ -1,83 +1,31 @@
 # Observing particles in different sized cones around a tau
-from ROOT import TFile, TH1D
-import utils
+from histograms import new_histogram
+from isolation import ConeProfile
+from particle_index import get_index
+from vectors import LorentzArray
+import entry
+import sys
 
+COLLECTIONS = ['genParticles']
+INPUT = 'data/p8_output.root'
+OUTPUT = 'data/tau_cone.root'
 
-def get_gen_taus(tree):
-    gen_particles = tree.genParticles
-    taus = []
+cone_sizes = [0.5, 0.3, 0.1]
 
-    # loop through generator particles
-    for particle in gen_particles:
-        pdg = particle.core.pdgId
-        status = particle.core.status
 
-        # find taus
-        if abs(pdg) == 15 and status == 2:
-            vector = utils.get_lorentz_vector(particle)
-            taus.append(vector)
-            # print('Found tau: ', pdg, ' with energy ', vector.E())
+def get_gen_taus(vectors, index, event):
+    # find final state taus
+    return vectors[index.event(event, 15, 2)]
 
-    return taus
 
+def get_stable_particles(vectors, pdg_ids, index, event):
+    # find stable generator particles
+    stable = index.event(event, statuses=1)
+    return vectors[stable], pdg_ids[stable]
 
-def get_particle_cone(tree, lorentz_vector, cone_size):
-    gen_particles = tree.genParticles
-    cone_particles = {}
 
-    # loop through all generator particles
-    for gen_particle in gen_particles:
-        gen_vector = utils.get_lorentz_vector(gen_particle)
-
-        # pdg = gen_particle.core.pdgId
-        status = gen_particle.core.status
-
-        # check if particle is stable
-        if status != 1:
-            continue
-
-        # find delta R w.r.t given lorentz vector
-        deltaR = lorentz_vector.DeltaR(gen_vector)
-
-        # if pdg in [11, 12, -11, -12]:
-        #     print('Found ', pdg, ' with delta R ', deltaR, ' and energy ', gen_vector.E())
-
-        # compare delta R to given cone size
-        if deltaR < cone_size:
-            cone_particles.update({gen_particle: gen_vector})
-
-    return cone_particles
-
-
-def calculate_energy_difference(particle, cone):
-    energy_diff = 0
-    cone_particles = list(cone.values())
-    for cone_particle in cone_particles:
-        energy_diff += cone_particle.E()
-    energy_diff -= particle.E()
-    return energy_diff
-
-
-def fill_histogram(particles, cones, histogram, statistics):
-    # energy_diffs = []
-    for i, particle in enumerate(particles):
-        energy_diff = calculate_energy_difference(particle, cones[i])
-        # energy_diffs.append(energy_diff)
-
-        histogram.Fill(energy_diff)
-        particle_statistics(cones[i], statistics)
-
-    # return energy_diffs
-
-
-def particle_statistics(cone, statistics):
-    particles = list(cone.keys())
-    for particle in particles:
-        pdg = particle.core.pdgId
-        if pdg in statistics:
-            statistics[pdg] += 1
-        else:
-            statistics.update({pdg: 1})
+def fill_histogram(energy_diffs, histogram):
+    histogram.fill(energy_diffs)
 
 
 def sort_statistics(statistics):
@@ -94,79 +42,53 @@ def print_statistcs(statistics):
     print('Total\t:\t', count)
 
 
-# files
-inf = TFile('data/p8_output.root')
-outf = TFile('data/tau_cone.root', 'RECREATE')
-
-hist1 = TH1D('delta R < 0.5', 'delta E', 150, -75, 75)
-hist2 = TH1D('delta R < 0.3', 'delta E', 150, -75, 75)
-hist3 = TH1D('delta R < 0.1', 'delta E', 150, -75, 75)
+def create_outputs():
+    histograms = []
+    for cone_size in cone_sizes:
+        histograms.append(new_histogram('delta R < {}'.format(cone_size), 'delta E', 150, -75, 75))
+    statistics = [{} for cone_size in cone_sizes]
+    return {'histograms': histograms, 'statistics': statistics}
 
-stat1 = {}
-stat2 = {}
-stat3 = {}
 
-# read events
-tree = inf.Get('events')
-n_tot = tree.GetEntries()
-for event in range(n_tot):
+def process(chunk, outputs):
+    # particle statistics for all cones are collected in one pass
+    profile = ConeProfile(cone_sizes, outputs['statistics'])
 
-    tree.GetEntry(event)
+    gen_particles = chunk['genParticles']
+    gen_vectors = LorentzArray.from_collection(gen_particles)
+    gen_pdg_ids = gen_particles['pdgId']
+    index = get_index(gen_particles)
 
-    # find all generator taus
-    taus = get_gen_taus(tree)
-
-    # find cones for each tau
-    cones1 = []
-    cones2 = []
-    cones3 = []
-
-    for i, tau in enumerate(taus):
-        # print('Tau ', i + 1)
-
-        # delta R < 0.5
-        cones1.append(get_particle_cone(tree, tau, 0.5))
-        # delta R < 0.3
-        cones2.append(get_particle_cone(tree, tau, 0.3))
-        # delta R < 0.1
-        cones3.append(get_particle_cone(tree, tau, 0.1))
-
-    # fill histograms
-    fill_histogram(taus, cones1, hist1, stat1)
-    fill_histogram(taus, cones2, hist2, stat2)
-    fill_histogram(taus, cones3, hist3, stat3)
+    for event in range(chunk.n_events):
+        # find all generator taus
+        taus = get_gen_taus(gen_vectors, index, event)
+        if not len(taus):
+            continue
 
-    # for i, energy in enumerate(energies):
-    #     # print(energy)
-    #     if energy < -0.5:
-    #         print('Event ', event + 1)
-    #         print(energy)
-    # print('Tau ', i + 1)
-    # cone = list(cones1[i].keys())
-    # for particle in cone:
-    #     print(particle.core.pdgId)
-    #     print(cones1[i][particle].E())
+        # find cones for each tau and fill histograms
+        stable_vectors, stable_pdg_ids = get_stable_particles(gen_vectors, gen_pdg_ids, index, event)
+        energy_diffs = profile.fill(taus, stable_vectors, stable_pdg_ids)
+        for i, histogram in enumerate(outputs['histograms']):
+            fill_histogram(energy_diffs[:, i], histogram)
 
-# write to file
-outf.Write()
 
-# print out statistics
-print('----------Statistics-----------')
+def finish(outputs):
+    # print out statistics
+    print('----------Statistics-----------')
 
-print("delta R < 0.5")
-stat1 = sort_statistics(stat1)
-print_statistcs(stat1)
+    for cone_size, statistics in zip(cone_sizes, outputs['statistics']):
+        print("delta R < {}".format(cone_size))
+        statistics = sort_statistics(statistics)
+        print_statistcs(statistics)
 
-print('-------------------------------')
+        print('-------------------------------')
 
-print("delta R < 0.3")
-stat2 = sort_statistics(stat2)
-print_statistcs(stat2)
 
-print('-------------------------------')
+def main(argv=None):
+    module = sys.modules[__name__]
+    args = entry.parser(module, 'Particles in cones around generator taus').parse_args(argv)
+    entry.run(module, args)
 
-print("delta R < 0.1")
-stat3 = sort_statistics(stat3)
-print_statistcs(stat3)
 
-print('-------------------------------')
+if __name__ == '__main__':
+    main()
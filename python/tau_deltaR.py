@@ -1,44 +1,46 @@
 # Finding delta R of tau tagged jets w.r.t MC taus
 
-from ROOT import TFile, TH1D
-import utils
+from histograms import new_histogram
+from reader import masked_offsets
+from vectors import LorentzArray
+import entry
+import matching
+import numpy as np
+import sys
 
-# files
-inf = TFile('data/p8_ee_ZH.root')
-outf = TFile('data/histo_deltaR.root', 'RECREATE')
+COLLECTIONS = ['jets', 'tauTags', 'skimmedGenParticles']
+INPUT = 'data/p8_ee_ZH.root'
+OUTPUT = 'data/histo_deltaR.root'
 
-# histogram settings
-histogram = TH1D('deltaR', 'deltaR', 100, 0, 1)
 
-# read events
-tree = inf.Get('events')
-n_tot = tree.GetEntries()
-for event in range(n_tot):
-    tree.GetEntry(event)
+def create_outputs():
+    # histogram settings
+    return {'deltaR': new_histogram('deltaR', 'deltaR', 100, 0, 1)}
 
+
+def process(chunk, outputs):
     # get tau tagged jets
-    tau_jets = []
-    jets = tree.jets
-    tags = tree.tauTags
-    n_jets = len(jets)
-    for i in range(n_jets):
-        if tags[i].tag > 0:
-            tau_jets.append(jets[i])
+    jets = chunk['jets']
+    tagged = chunk['tauTags']['tag'] > 0
+    jet_vectors = LorentzArray.from_collection(jets)[tagged]
+    jet_offsets = masked_offsets(jets.offsets, tagged)
 
     # get MC taus
-    mc_taus = []
-    mc_particles = tree.skimmedGenParticles
-    for particle in mc_particles:
-        pdg = particle.core.pdgId
-        if abs(pdg) == 15:
-            mc_taus.append(particle)
+    mc_particles = chunk['skimmedGenParticles']
+    is_tau = np.abs(mc_particles['pdgId']) == 15
+    mc_vectors = LorentzArray.from_collection(mc_particles)[is_tau]
+    mc_offsets = masked_offsets(mc_particles.offsets, is_tau)
 
     # compare tau tagged jets to MC taus
-    for tau_jet in tau_jets:
-        jet_vector = utils.get_lorentz_vector(tau_jet)
-        for mc_tau in mc_taus:
-            mc_vector = utils.get_lorentz_vector(mc_tau)
-            histogram.Fill(jet_vector.DeltaR(mc_vector))
-
-# write to file
-outf.Write()
+    delta_r = matching.pair_delta_r(jet_vectors, jet_offsets, mc_vectors, mc_offsets)[0]
+    outputs['deltaR'].fill(delta_r)
+
+
+def main(argv=None):
+    module = sys.modules[__name__]
+    args = entry.parser(module, 'Delta R of tau tagged jets to generator taus').parse_args(argv)
+    entry.run(module, args)
+
+
+if __name__ == '__main__':
+    main()
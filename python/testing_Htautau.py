@@ -1,103 +1,91 @@
 # Testing how to read from Delphes output file
 # H->tautau
 
-from ROOT import TFile, TH1D
-import copy
-import utils
-
-
-def find_jet_pair(tree):
-    # Find a pair of two tau jets
-    jets = tree.jets
-    tau_tags = tree.tauTags
-    pair = None
-    n_jets = len(jets)
-    for i in range(n_jets - 1):
-        if tau_tags[i].tag < 0.5:
-            continue
-        vector1 = utils.get_lorentz_vector(jets[i])
-        if not check_deltaR(vector1, tree):
-            continue
-        if not utils.check_pt(vector1, 15):
-            continue
-        for j in range(i + 1, n_jets):
-            if tau_tags[j].tag < 0.5:
-                continue
-            vector2 = utils.get_lorentz_vector(jets[j])
-            if not check_deltaR(vector2, tree):
-                continue
-            if not utils.check_pt(vector2, 15):
-                continue
-            pair = {
-                jets[i]: vector1,
-                jets[j]: vector2
-            }
-    return pair
-
-
-def check_deltaR(vector, tree):
-    # compares delta R w.r.t. MC taus
-    mc_particles = tree.skimmedGenParticles
-    for particle in mc_particles:
-        pdg = particle.core.pdgId
-        if abs(pdg) == 15:
-            deltaR = vector.DeltaR(utils.get_lorentz_vector(particle))
-            if deltaR < 0.05:
-                return True
-    return False
-
-
-def missing_energy(tree):
-    # finds neutrinos from MC particles
-    mc_particles = tree.skimmedGenParticles
-    neutrinos = {}
-    for particle in mc_particles:
-        pdg = particle.core.pdgId
-        if abs(pdg) in [12, 14, 16]:
-            # print(pdg, end=':')
-            # print(particle.core.status, end=' ')
-            neutrinos.update({particle: utils.get_lorentz_vector(particle)})
-    # print('\n', end='')
-    return neutrinos
-
-
-# files
-inf = TFile('data/p8_ee_ZH.root')
-outf = TFile('data/histo_Htautau.root', 'RECREATE')
-
-# histogram settings
-histograms = {}
-histogram_list = {
-    'no_missing_energy',
-    'with_missing_energy'
-}
-for name in histogram_list:
-    histograms.update(
-        {name: TH1D(name, 'mass (GeV)', 20, 75, 175)}
+from histograms import new_histogram
+from reader import masked_offsets
+from vectors import LorentzArray
+import dilepton
+import entry
+import matching
+import numpy as np
+import sys
+
+COLLECTIONS = ['jets', 'tauTags', 'skimmedGenParticles']
+INPUT = 'data/p8_ee_ZH.root'
+OUTPUT = 'data/histo_Htautau.root'
+
+# Neutrinos of the missing energy
+NEUTRINOS = [12, 14, 16]
+
+
+def find_jet_pairs(chunk, vectors):
+    # Find a pair of two tau jets in every event: tau-tagged jets matched to a generator tau with pT above
+    # 15 GeV, the last two of them as a double loop over the jets keeps the last pair it finds
+    # Returns the flat indices of both jets, -1 if there is no pair
+    jets = chunk['jets']
+    selected = ~(chunk['tauTags']['tag'] < 0.5) & matched_jets(chunk) & (vectors.pt() > 15)
+    candidates = np.flatnonzero(selected)
+    events = jets.event_index()[candidates]
+    index2 = dilepton.last_per_event(candidates, events, chunk.n_events)
+    others = ~np.isin(candidates, index2)
+    index1 = dilepton.last_per_event(candidates[others], events[others], chunk.n_events)
+    index2[index1 < 0] = -1
+    return index1, index2
+
+
+def matched_jets(chunk):
+    # compares delta R of every jet w.r.t. MC taus
+    jets = chunk['jets']
+    particles = chunk['skimmedGenParticles']
+    is_tau = np.abs(particles['pdgId']) == 15
+    indices, _ = matching.match_chunk(
+        LorentzArray.from_collection(jets), jets.offsets, LorentzArray.from_collection(particles)[is_tau],
+        masked_offsets(particles.offsets, is_tau), matching.CONE_SIZE, 'first'
     )
+    return indices >= 0
+
 
-# read events
-tree = inf.Get('events')
-n_tot = tree.GetEntries()
-for event in range(n_tot):
-    tree.GetEntry(event)
+def missing_energy(chunk):
+    # finds neutrinos from MC particles, sum of their vectors in every event
+    particles = chunk['skimmedGenParticles']
+    is_neutrino = np.isin(np.abs(particles['pdgId']), NEUTRINOS)
+    vectors = LorentzArray.from_collection(particles)[is_neutrino]
+    return vectors.sum_segments(masked_offsets(particles.offsets, is_neutrino))
 
-    # find tau jet pairs 
-    jet_pair = None
-    if len(tree.jets) >= 2:
-        jet_pair = find_jet_pair(tree)
-    if not jet_pair:
-        continue
+
+def create_outputs():
+    # histogram settings
+    histograms = {}
+    histogram_list = {
+        'no_missing_energy',
+        'with_missing_energy'
+    }
+    for name in histogram_list:
+        histograms.update(
+            {name: new_histogram(name, 'mass (GeV)', 20, 75, 175)}
+        )
+    return histograms
+
+
+def process(chunk, histograms):
+    # find tau jet pairs
+    vectors = LorentzArray.from_collection(chunk['jets'])
+    index1, index2 = find_jet_pairs(chunk, vectors)
+    has_pair = index1 >= 0
+    jet_pairs = vectors[index1[has_pair]] + vectors[index2[has_pair]]
 
     # calculate mass without considering missing energy
-    jet_pair_missing_energy = copy.deepcopy(jet_pair)
-    mass_no_missing_energy = utils.calculate_mass(jet_pair)
-    histograms['no_missing_energy'].Fill(mass_no_missing_energy)
+    histograms['no_missing_energy'].fill(jet_pairs.m())
 
     # calculate mass including missing energy calculated from MC neutrinos
-    jet_pair_missing_energy.update(missing_energy(tree))
-    mass_missing_energy = utils.calculate_mass(jet_pair_missing_energy)
-    histograms['with_missing_energy'].Fill(mass_missing_energy)
+    histograms['with_missing_energy'].fill((jet_pairs + missing_energy(chunk)[has_pair]).m())
+
+
+def main(argv=None):
+    module = sys.modules[__name__]
+    args = entry.parser(module, 'H -> tautau invariant mass of tau jet pairs').parse_args(argv)
+    entry.run(module, args)
+
 
-# write to file
-outf.Write()
+if __name__ == '__main__':
+    main()
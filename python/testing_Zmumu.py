@@ -1,67 +1,104 @@
 # Testing how to read from Delphes output file
 # Z->mumu
+#
+# With --scan the isolation cut is also scanned: the muons passing the pT cut are recorded with
+# their isolation and whether they match a generator muon (see threshold_scan.py).
 
-from ROOT import TFile, TH1D
-import utils
-
-
-def find_muon_pair(tree):
-    # Find a pair of two oppositely charged muons
-    muons = tree.muons
-    pair = None
-    n_mu = len(muons)
-    for i in range(n_mu - 1):
-        vector1 = utils.get_lorentz_vector(muons[i])
-        if not utils.check_pt(vector1, 15):
-            continue
-        if not check_isolation(tree, i):
-            continue
-        ch1 = muons[i].core.charge
-        for j in range(i + 1, n_mu):
-            vector2 = utils.get_lorentz_vector(muons[j])
-            if not utils.check_pt(vector2, 15):
-                continue
-            if not check_isolation(tree, j):
-                continue
-            ch2 = muons[j].core.charge
-            if ch1 * ch2 < 0:
-                pair = {
-                    muons[i]: vector1,
-                    muons[j]: vector2
-                }
-    return pair
-
-
-def check_isolation(tree, i):
-    # Check whether muon isolation tag is below 0.4
-    iso = tree.muonITags[i].tag
-    if iso < 0.4:
-        return True
-    return False
-
-
-# files
-inf = TFile('data/p8_ee_ZH.root')
-outf = TFile('data/histo_Zmumu.root', 'RECREATE')
-
-# histogram settings
-title = 'mass (GeV)'
-bins = 15
-low = 50
-high = 150
-histogram = TH1D('data', title, bins, low, high)
-
-# read events
-tree = inf.Get('events')
-n_tot = tree.GetEntries()
-for event in range(n_tot):
-    tree.GetEntry(event)
-    muon_pair = None
-    if len(tree.muons) >= 2:
-        muon_pair = find_muon_pair(tree)
-    if not muon_pair:
-        continue
-    mass = utils.calculate_mass(muon_pair)
-    histogram.Fill(mass)
-
-outf.Write()
+from histograms import new_histogram
+from reader import masked_offsets
+from vectors import LorentzArray
+import dilepton
+import entry
+import matching
+import numpy as np
+import sys
+import threshold_scan
+
+COLLECTIONS = ['muons', 'muonITags']
+INPUT = 'data/p8_ee_ZH.root'
+OUTPUT = 'data/histo_Zmumu.root'
+
+# Default choice of the muon pair in events with several, see dilepton.POLICIES
+PAIR_POLICY = 'last'
+
+# Thresholds of the isolation scan
+ISOLATION_THRESHOLDS = np.linspace(0, 2, 201)
+
+
+def create_outputs():
+    # histogram settings
+    title = 'mass (GeV)'
+    bins = 15
+    low = 50
+    high = 150
+    return {'data': new_histogram('data', title, bins, low, high)}
+
+
+def fill_isolation_scan(chunk, counts):
+    # Record the muons passing the pT cut with their isolation, signal if they match a generator muon
+    muons = chunk['muons']
+    vectors = LorentzArray.from_collection(muons)
+    isolation = chunk['muonITags']['tag']
+    selected = dilepton.select_muons(vectors, isolation, isolation_max=np.inf)
+    particles = chunk['skimmedGenParticles']
+    is_muon = (np.abs(particles['pdgId']) == 13) & (particles['status'] == 1)
+    matches, _ = matching.match_chunk(
+        vectors, muons.offsets, LorentzArray.from_collection(particles)[is_muon],
+        masked_offsets(particles.offsets, is_muon), matching.CONE_SIZE, 'first'
+    )
+    threshold_scan.fill(counts, isolation[selected], matches[selected] >= 0)
+
+
+def process(chunk, outputs, policy=PAIR_POLICY):
+    # Find a pair of two oppositely charged muons passing the pT and isolation cuts in every event, chosen
+    # with one of dilepton.POLICIES
+    index1, index2, masses = dilepton.muon_pairs(chunk, policy)
+    outputs['data'].fill(masses[index1 >= 0])
+
+
+class Analysis:
+    def __init__(self, policy=PAIR_POLICY, scan_table=None):
+        # This analysis with the options of main, passed to the workers with its process method
+        # policy: choice of the muon pair, see PAIR_POLICY
+        # scan_table: file of the scan of the isolation threshold, no scan if None
+        self.__name__ = __name__
+        # the generator muons of the scan tell the prompt muons from the others
+        self.COLLECTIONS = COLLECTIONS + ['skimmedGenParticles'] if scan_table else COLLECTIONS
+        self.INPUT = INPUT
+        self.OUTPUT = OUTPUT
+        self.policy = policy
+        self.scan_table = scan_table
+
+    def create_outputs(self):
+        outputs = create_outputs()
+        if self.scan_table:
+            outputs['isolation_scan'] = threshold_scan.create('isolation_scan', 'muon isolation',
+                                                              ISOLATION_THRESHOLDS)
+        return outputs
+
+    def process(self, chunk, outputs):
+        process(chunk, outputs, self.policy)
+        if self.scan_table:
+            fill_isolation_scan(chunk, outputs['isolation_scan'])
+
+    def finish(self, outputs):
+        if self.scan_table:
+            result = threshold_scan.scan(outputs['isolation_scan'], 'below')
+            threshold_scan.print_scan('muon isolation', result, 'below')
+            threshold_scan.write_table(self.scan_table, result)
+
+
+def main(argv=None):
+    module = sys.modules[__name__]
+    parser = entry.parser(module, 'Z -> mumu invariant mass')
+    parser.add_argument('--policy', choices=dilepton.POLICIES, default=PAIR_POLICY,
+                        help='choice of the muon pair in events with several')
+    parser.add_argument('--scan', metavar='FILE',
+                        help='scan the isolation threshold and write the efficiency, fake rate and yields of every '
+                             'threshold to FILE as CSV')
+    args = parser.parse_args(argv)
+    entry.run(Analysis(args.policy, args.scan), args)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,19 @@
 
 import utils
 from math import sqrt
-from ROOT import Math, TFile, TH1D
+from histograms import new_histogram
+import dilepton
+import entry
+import sys
+
+COLLECTIONS = ['muons', 'muonITags']
+INPUT = 'data/p8_ee_ZH.root'
+OUTPUT = 'data/lorentz.root'
 
 
 def get_lorentz_vector_new(particle):
     # Get the Lorentz Vector of a given particle
+    from ROOT import Math
     vector = Math.PxPyPzMVector()
     vector.SetPx(particle.core.p4.px)
     vector.SetPy(particle.core.p4.py)
@@ -15,14 +23,6 @@ def get_lorentz_vector_new(particle):
     return vector
 
 
-def check_pt(vector, limit):
-    # Check whether the transverse momentum corresponding to a given Lorentz vector is over the given limit (GeV)
-    pT = get_pt(vector)
-    if pT > limit:
-        return True
-    return False
-
-
 def get_pt(vector):
     # Get pT from a given Lorentz vector
     pT = None
@@ -33,193 +33,124 @@ def get_pt(vector):
     return pT
 
 
-def find_muon_pair_new(tree):
-    # Find a pair of two oppositely charged muons with additional filtering (new LorentzVector)
-    muons = tree.muons
-    pair = None
-    n_mu = len(muons)
-    for i in range(n_mu - 1):
-        vector1 = get_lorentz_vector_new(muons[i])
-        if not check_pt(vector1, 15):
-            continue
-        if not check_isolation(tree, i):
-            continue
-        ch1 = muons[i].core.charge
-        for j in range(i + 1, n_mu):
-            vector2 = get_lorentz_vector_new(muons[j])
-            if not check_pt(vector2, 15):
-                continue
-            if not check_isolation(tree, j):
-                continue
-            ch2 = muons[j].core.charge
-            if ch1 * ch2 < 0:
-                pair = {
-                    muons[i]: vector1,
-                    muons[j]: vector2
-                }
-    return pair
-
-
-def find_muon_pair_new_nofilter(tree):
-    # Find a pair of two oppositely charged muons (new LorentzVector)
-    muons = tree.muons
-    pair = None
-    n_mu = len(muons)
-    for i in range(n_mu - 1):
-        vector1 = get_lorentz_vector_new(muons[i])
-        ch1 = muons[i].core.charge
-        for j in range(i + 1, n_mu):
-            vector2 = get_lorentz_vector_new(muons[j])
-            ch2 = muons[j].core.charge
-            if ch1 * ch2 < 0:
-                pair = {
-                    muons[i]: vector1,
-                    muons[j]: vector2
-                }
-    return pair
-
-
-def find_muon_pair(tree):
-    # Find a pair of two oppositely charged muons with additional filtering (legacy TLorentzVector)
-    muons = tree.muons
-    pair = None
-    n_mu = len(muons)
-    for i in range(n_mu - 1):
-        vector1 = utils.get_lorentz_vector(muons[i])
-        if not check_pt(vector1, 15):
-            continue
-        if not check_isolation(tree, i):
+def get_muon_pair(event, pairs, get_vector):
+    # Build the muon pair of an event chosen by dilepton.muon_pairs with the given vector function
+    index1, index2, masses = pairs
+    if index1[event.index] < 0:
+        return None
+    muons = event.muons
+    muon1 = muons[index1[event.index] - muons.start]
+    muon2 = muons[index2[event.index] - muons.start]
+    return {
+        muon1: get_vector(muon1),
+        muon2: get_vector(muon2)
+    }
+
+
+def create_outputs():
+    # histogram settings
+    title = 'mass (GeV)'
+    bins = 15
+    low = 50
+    high = 150
+    histograms = {}
+    histogram_list = [
+        'old_mass_nofilter',
+        'new_mass_nofilter',
+        'old_mass',
+        'new_mass',
+        'old_pt_nofilter',
+        'new_pt_nofilter',
+        'old_pt',
+        'new_pt'
+    ]
+    for name in histogram_list:
+        if name.find('pt') != -1:
+            histograms.update(
+                {name: new_histogram(name, 'pt', bins, 0, high)}
+            )
+        else:
+            histograms.update(
+                {name: new_histogram(name, 'mass (GeV)', bins, low, high)}
+            )
+
+    # initializing comparison count
+    return {'histograms': histograms, 'count_ok': 0, 'count_nok': 0}
+
+
+def process(chunk, outputs):
+    histograms = outputs['histograms']
+    # the last pair of oppositely charged muons found by a double loop, with and without pT and isolation cuts
+    pairs_nofilter = dilepton.muon_pairs(chunk, 'last', apply_cuts=False)
+    pairs = dilepton.muon_pairs(chunk, 'last')
+    for event in chunk.events():
+
+        muon_pair_old_nofilter = None
+        muon_pair_new_nofilter = None
+        muon_pair_old = None
+        muon_pair_new = None
+        pt_old = None
+        pt_new = None
+
+        # build muon pairs with both vector classes
+        muon_pair_old_nofilter = get_muon_pair(event, pairs_nofilter, utils.get_lorentz_vector)
+        muon_pair_new_nofilter = get_muon_pair(event, pairs_nofilter, get_lorentz_vector_new)
+        muon_pair_old = get_muon_pair(event, pairs, utils.get_lorentz_vector)
+        muon_pair_new = get_muon_pair(event, pairs, get_lorentz_vector_new)
+
+        # fill histograms
+        if muon_pair_old_nofilter:
+            for muon in muon_pair_old_nofilter.values():
+                pt_old = get_pt(muon)
+                histograms['old_pt_nofilter'].Fill(pt_old)
+            mass1 = utils.calculate_mass(muon_pair_old_nofilter)
+            histograms['old_mass_nofilter'].Fill(mass1)
+
+        if muon_pair_new_nofilter:
+            for muon in muon_pair_new_nofilter.values():
+                pt_new = get_pt(muon)
+                histograms['new_pt_nofilter'].Fill(pt_new)
+            mass2 = utils.calculate_mass(muon_pair_new_nofilter)
+            histograms['new_mass_nofilter'].Fill(mass2)
+
+        if muon_pair_old:
+            for muon in muon_pair_old.values():
+                histograms['old_pt'].Fill(get_pt(muon))
+            mass3 = utils.calculate_mass(muon_pair_old)
+            histograms['old_mass'].Fill(mass3)
+
+        if muon_pair_new:
+            for muon in muon_pair_new.values():
+                histograms['new_pt'].Fill(get_pt(muon))
+            mass4 = utils.calculate_mass(muon_pair_new)
+            histograms['new_mass'].Fill(mass4)
+
+        # count pT matches of events with muon pairs, from the last muon of the pair without cuts
+        # The original loop kept pt_old and pt_new from the last event with a pair and counted every event
+        # with them (failing before the first pair). Values carried between events would depend on where the
+        # chunks and the ranges of the worker processes start, so only events with a pair are counted.
+        if pt_old is None or pt_new is None:
             continue
-        ch1 = muons[i].core.charge
-        for j in range(i + 1, n_mu):
-            vector2 = utils.get_lorentz_vector(muons[j])
-            if not check_pt(vector2, 15):
-                continue
-            if not check_isolation(tree, j):
-                continue
-            ch2 = muons[j].core.charge
-            if ch1 * ch2 < 0:
-                pair = {
-                    muons[i]: vector1,
-                    muons[j]: vector2
-                }
-    return pair
-
-
-def find_muon_pair_nofilter(tree):
-    # Find a pair of two oppositely charged muons (legacy TLorentzVector)
-    muons = tree.muons
-    pair = None
-    n_mu = len(muons)
-    for i in range(n_mu - 1):
-        vector1 = utils.get_lorentz_vector(muons[i])
-        ch1 = muons[i].core.charge
-        for j in range(i + 1, n_mu):
-            vector2 = utils.get_lorentz_vector(muons[j])
-            ch2 = muons[j].core.charge
-            if ch1 * ch2 < 0:
-                pair = {
-                    muons[i]: vector1,
-                    muons[j]: vector2
-                }
-    return pair
-
-
-def check_isolation(tree, i):
-    # Check whether muon isolation tag is below 0.4
-    iso = tree.muonITags[i].tag
-    if iso < 0.4:
-        return True
-    return False
-
-
-# files
-inf = TFile('data/p8_ee_ZH.root')
-outf = TFile('data/lorentz.root', 'RECREATE')
-
-# histogram settings
-title = 'mass (GeV)'
-bins = 15
-low = 50
-high = 150
-histograms = {}
-histogram_list = [
-    'old_mass_nofilter',
-    'new_mass_nofilter',
-    'old_mass',
-    'new_mass',
-    'old_pt_nofilter',
-    'new_pt_nofilter',
-    'old_pt',
-    'new_pt'
-]
-for name in histogram_list:
-    if name.find('pt') != -1:
-        histograms.update(
-            {name: TH1D(name, 'pt', bins, 0, high)}
-        )
-    else:
-        histograms.update(
-            {name: TH1D(name, 'mass (GeV)', bins, low, high)}
-        )
-
-# initializing comparison count
-count_ok = 0
-count_nok = 0
-
-# read events
-tree = inf.Get('events')
-n_tot = tree.GetEntries()
-for event in range(n_tot):
-    tree.GetEntry(event)
-
-    muon_pair_old_nofilter = None
-    muon_pair_new_nofilter = None
-    muon_pair_old = None
-    muon_pair_new = None
-
-    # find muon pairs
-    if len(tree.muons) >= 2:
-        muon_pair_old_nofilter = find_muon_pair_nofilter(tree)
-        muon_pair_new_nofilter = find_muon_pair_new_nofilter(tree)
-        muon_pair_old = find_muon_pair(tree)
-        muon_pair_new = find_muon_pair_new(tree)
-
-    # fill histograms
-    if muon_pair_old_nofilter:
-        for muon in muon_pair_old_nofilter.values():
-            pt_old = get_pt(muon)
-            histograms['old_pt_nofilter'].Fill(pt_old)
-        mass1 = utils.calculate_mass(muon_pair_old_nofilter)
-        histograms['old_mass_nofilter'].Fill(mass1)
-
-    if muon_pair_new_nofilter:
-        for muon in muon_pair_new_nofilter.values():
-            pt_new = get_pt(muon)
-            histograms['new_pt_nofilter'].Fill(pt_new)
-        mass2 = utils.calculate_mass(muon_pair_new_nofilter)
-        histograms['new_mass_nofilter'].Fill(mass2)
-
-    if muon_pair_old:
-        for muon in muon_pair_old.values():
-            histograms['old_pt'].Fill(get_pt(muon))
-        mass3 = utils.calculate_mass(muon_pair_old)
-        histograms['old_mass'].Fill(mass3)
-
-    if muon_pair_new:
-        for muon in muon_pair_new.values():
-            histograms['new_pt'].Fill(get_pt(muon))
-        mass4 = utils.calculate_mass(muon_pair_new)
-        histograms['new_mass'].Fill(mass4)
-
-    # count pT matches
-    if abs(pt_old - pt_new) < 5:
-        count_ok += 1
-    else:
-        count_nok += 1
-
-# Print out comparison
-print("Equal pT: " + str(count_ok))
-print("Not equal pT " + str(count_nok))
-
-outf.Write()
+        if abs(pt_old - pt_new) < 5:
+            outputs['count_ok'] += 1
+        else:
+            outputs['count_nok'] += 1
+
+
+def finish(outputs):
+    # Print out comparison
+    print("Equal pT: " + str(outputs['count_ok']))
+    print("Not equal pT " + str(outputs['count_nok']))
+
+
+def main(argv=None):
+    module = sys.modules[__name__]
+    parser = entry.parser(module, 'Compare TLorentzVector and Math::LorentzVector on Z -> mumu')
+    args = parser.parse_args(argv)
+    if args.numpy:
+        parser.error('--numpy is not available, this script compares the ROOT vector classes')
+    entry.run(module, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# Testing the NumPy Lorentz vector arrays against TLorentzVector and Math::PxPyPzMVector
+
+from reader import EventReader
+from vectors import LorentzArray, delta_r_matrix
+import utils
+
+# relative tolerance of the comparison
+tolerance = 1e-9
+
+
+def is_close(value, reference):
+    # Compare a value to the reference with a relative tolerance
+    return abs(value - reference) <= tolerance * max(1, abs(reference))
+
+
+def compare_single(vectors, particles, counts):
+    # Compare pt, eta, phi, E and M of every particle
+    for i, particle in enumerate(particles):
+        legacy = utils.get_lorentz_vector(particle)
+        new = utils.get_lorentz_vector_new(particle)
+        values = {
+            'pt': (vectors.pt()[i], legacy.Perp(), utils.get_pt(new)),
+            'eta': (vectors.eta()[i], legacy.Eta(), new.Eta()),
+            'phi': (vectors.phi()[i], legacy.Phi(), new.Phi()),
+            'E': (vectors.energy()[i], legacy.E(), new.E()),
+            'M': (vectors.m()[i], legacy.M(), new.M())
+        }
+        for name, (value, legacy_value, new_value) in values.items():
+            count(counts, name + ' (TLorentzVector)', is_close(value, legacy_value))
+            # pseudorapidity along the beam axis is not defined the same way in Math::LorentzVector
+            if name == 'eta' and vectors.pt()[i] == 0:
+                continue
+            count(counts, name + ' (PxPyPzMVector)', is_close(value, new_value))
+
+
+def compare_pairs(vectors, particles, counts):
+    # Compare DeltaR, sums and differences of every pair of particles
+    delta_r = delta_r_matrix(vectors, vectors)
+    for i, particle1 in enumerate(particles):
+        legacy1 = utils.get_lorentz_vector(particle1)
+        for j, particle2 in enumerate(particles):
+            legacy2 = utils.get_lorentz_vector(particle2)
+            count(counts, 'DeltaR', is_close(delta_r[i, j], legacy1.DeltaR(legacy2)))
+            count(counts, 'sum M', is_close((vectors[i] + vectors[j]).m(), (legacy1 + legacy2).M()))
+            count(counts, 'difference E', is_close((vectors[i] - vectors[j]).energy(), (legacy1 - legacy2).E()))
+    if particles:
+        total = utils.calculate_mass({particle: utils.get_lorentz_vector(particle) for particle in particles})
+        count(counts, 'total M', is_close(vectors.sum().m(), total))
+
+
+def count(counts, name, ok):
+    # Count passed and failed comparisons
+    if name not in counts:
+        counts.update({name: [0, 0]})
+    if ok:
+        counts[name][0] += 1
+    else:
+        counts[name][1] += 1
+
+
+# files
+reader = EventReader('data/p8_ee_ZH.root', ['jets', 'muons', 'skimmedGenParticles'])
+
+# initializing comparison counts
+counts = {}
+
+# read events
+for chunk in reader.chunks():
+    for collection in ['jets', 'muons', 'skimmedGenParticles']:
+        chunk_vectors = LorentzArray.from_collection(chunk[collection])
+        for event in chunk.events():
+            particles = list(getattr(event, collection))
+            vectors = chunk_vectors[chunk[collection].event_slice(event.index)]
+            compare_single(vectors, particles, counts)
+            compare_pairs(vectors, particles, counts)
+
+# Print out comparison
+for name, (count_ok, count_nok) in counts.items():
+    print(name + ":\tequal " + str(count_ok) + "\tnot equal " + str(count_nok))
@@ -0,0 +1,107 @@
+# Scans of the threshold of a tag or isolation cut in a single read of the data
+#
+# Every candidate is recorded once with its value (tau tag, muon isolation) and whether it is signal
+# (matched to a generator particle), in a histograms.BinnedEfficiency binned in the thresholds to scan:
+# the total counts are the candidates between two thresholds, the passed counts the signal ones. Cumulative
+# sums over the bins then give the signal and background passing every threshold at once, and from them
+# the efficiency, fake rate, ROC curve and best working points. As in rec_efficiency, the fake rate is the
+# background among the passing candidates (n_fake / n_rec), the background efficiency the background passing
+# over all background, which the ROC curve is drawn against:
+#   outputs['tag_scan'] = threshold_scan.create('tag_scan', 'tau tag', np.linspace(0, 1, 201))
+#   threshold_scan.fill(outputs['tag_scan'], tags, matched)
+#   result = threshold_scan.scan(outputs['tag_scan'], 'above')
+# Cuts 'above' pass values >= threshold (as not tag < 0.5), cuts 'below' values < threshold (as isolation
+# < 0.4). Signal candidates without a value, e.g. generator taus without a jet, are filled with
+# NEVER[direction] so they pass no threshold.
+import numpy as np
+from histograms import BinnedEfficiency
+
+# Value of candidates that pass no threshold of a cut in each direction
+NEVER = {'above': -np.inf, 'below': np.inf}
+
+# Figures of merit of the working points, from the columns of scan
+FIGURES = {
+    'youden': lambda result: result['efficiency'] - result['background_efficiency'],
+    'significance': lambda result: result['signal'] / np.sqrt(np.maximum(result['signal'] + result['background'], 1)),
+}
+
+# Efficiencies of the fixed working points printed by print_scan
+TARGET_EFFICIENCIES = [0.5, 0.7, 0.9]
+
+COLUMNS = ['threshold', 'signal', 'background', 'efficiency', 'fake_rate', 'background_efficiency']
+
+
+def create(name, title, thresholds):
+    # Counts of the candidates of a scan over the thresholds, an increasing array
+    return BinnedEfficiency(name, '{} scan'.format(title), ['value'], [thresholds])
+
+
+def fill(counts, values, signal):
+    # Record candidates with their values and whether they are signal
+    counts.fill(signal, {'value': values})
+
+
+def scan(counts, direction='above'):
+    # Signal and background passing each threshold with the efficiency, fake rate (background among the passing
+    # candidates) and background efficiency (background passing over all background), see COLUMNS
+    if direction not in NEVER:
+        raise ValueError('Unknown cut direction: {}'.format(direction))
+    signal = counts.passed
+    background = counts.total - counts.passed
+    if direction == 'above':
+        # bin i + 1 starts at threshold i, the candidates above it are in the bins from there to the overflow
+        signal_passed = np.cumsum(signal[::-1])[::-1][1:]
+        background_passed = np.cumsum(background[::-1])[::-1][1:]
+    else:
+        # the candidates below threshold i are in the bins up to i
+        signal_passed = np.cumsum(signal)[:-1]
+        background_passed = np.cumsum(background)[:-1]
+    passed = signal_passed + background_passed
+    return {
+        'threshold': counts.edges[0],
+        'signal': signal_passed,
+        'background': background_passed,
+        'efficiency': signal_passed / max(signal.sum(), 1),
+        'fake_rate': np.where(passed > 0, background_passed / np.maximum(passed, 1), 0),
+        'background_efficiency': background_passed / max(background.sum(), 1),
+    }
+
+
+def roc_curve(result):
+    # Background efficiency and efficiency of every threshold, from the loosest to the tightest cut
+    order = np.lexsort((result['efficiency'], result['background_efficiency']))[::-1]
+    return result['background_efficiency'][order], result['efficiency'][order]
+
+
+def best(result, figure='youden'):
+    # Index of the threshold with the highest figure of merit, see FIGURES
+    return int(np.argmax(FIGURES[figure](result)))
+
+
+def at_efficiency(result, efficiency):
+    # Index of the threshold with the lowest fake rate keeping at least the given efficiency, None if none
+    keeping = np.flatnonzero(result['efficiency'] >= efficiency)
+    if not len(keeping):
+        return None
+    return int(keeping[np.argmin(result['fake_rate'][keeping])])
+
+
+def print_scan(title, result, direction='above'):
+    # Print the best working points and those at the target efficiencies
+    cut = '>=' if direction == 'above' else '<'
+    print('{} scan over {} thresholds:'.format(title, len(result['threshold'])))
+    points = [(figure, best(result, figure)) for figure in FIGURES]
+    points += [('efficiency {:g}'.format(target), at_efficiency(result, target)) for target in TARGET_EFFICIENCIES]
+    for label, i in points:
+        if i is None:
+            continue
+        print('  {}: {} {} {:g}: efficiency {:.4f}, fake rate {:.4f}, background efficiency {:.4f}, signal {}, '
+              'background {}'.format(label, title, cut, result['threshold'][i], result['efficiency'][i],
+                                     result['fake_rate'][i], result['background_efficiency'][i], result['signal'][i],
+                                     result['background'][i]))
+
+
+def write_table(path, result):
+    # Write the columns of a scan to a CSV file, one row per threshold
+    np.savetxt(path, np.column_stack([result[column] for column in COLUMNS]), delimiter=',',
+               header=','.join(COLUMNS), comments='', fmt='%.10g')
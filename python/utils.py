@@ -1,9 +1,12 @@
 # Useful functions
-from ROOT import Math, TLorentzVector
+# ROOT is imported by the functions using it, importing this module does not start ROOT
+import profiling
 
 
+@profiling.timed('TLorentzVector')
 def get_lorentz_vector(particle):
     # Get the Lorentz Vector of a given particle (Legacy TLorentzVector class)
+    from ROOT import TLorentzVector
     vector = TLorentzVector()
     vector.SetXYZM(
         particle.core.p4.px,
@@ -16,6 +19,7 @@ def get_lorentz_vector(particle):
 
 def get_lorentz_vector_new(particle):
     # Get the Lorentz Vector of a given particle (Math::LorentzVector class)
+    from ROOT import Math
     vector = Math.PxPyPzMVector()
     vector.SetPx(particle.core.p4.px)
     vector.SetPy(particle.core.p4.py)
@@ -50,5 +54,6 @@ def get_pt(vector):
     try:
         pT = vector.Perp()
     except AttributeError:
+        from ROOT import Math
         pT = Math.sqrt(vector.Perp2())
     return pT
@@ -0,0 +1,184 @@
+# Lorentz vectors stored as NumPy arrays, following the TLorentzVector conventions
+import numpy as np
+
+# Pseudorapidity returned by TLorentzVector for particles along the beam axis
+ETA_MAX = 10e10
+
+
+class LorentzArray:
+    def __init__(self, px, py, pz, e):
+        # Array of Lorentz vectors in (px, py, pz, E) components of any matching shape
+        self.px = np.asarray(px, dtype=np.float64)
+        self.py = np.asarray(py, dtype=np.float64)
+        self.pz = np.asarray(pz, dtype=np.float64)
+        self.e = np.asarray(e, dtype=np.float64)
+
+    @classmethod
+    def from_xyzm(cls, px, py, pz, mass):
+        # Build vectors from momentum and mass (same as TLorentzVector.SetXYZM)
+        px = np.asarray(px, dtype=np.float64)
+        py = np.asarray(py, dtype=np.float64)
+        pz = np.asarray(pz, dtype=np.float64)
+        mass = np.asarray(mass, dtype=np.float64)
+        p2 = px ** 2 + py ** 2 + pz ** 2
+        m2 = mass ** 2
+        e = np.where(mass >= 0, np.sqrt(p2 + m2), np.sqrt(np.maximum(p2 - m2, 0)))
+        return cls(px, py, pz, e)
+
+    @classmethod
+    def from_collection(cls, collection):
+        # Build vectors of all objects of a reader.Collection
+        return cls.from_xyzm(collection['px'], collection['py'], collection['pz'], collection['mass'])
+
+    @classmethod
+    def from_particles(cls, particles):
+        # Build vectors from a sequence of podio particles
+        p4s = [particle.core.p4 for particle in particles]
+        return cls.from_xyzm(
+            [p4.px for p4 in p4s],
+            [p4.py for p4 in p4s],
+            [p4.pz for p4 in p4s],
+            [p4.mass for p4 in p4s]
+        )
+
+    @classmethod
+    def from_vectors(cls, vectors):
+        # Build vectors from a sequence of TLorentzVector objects
+        return cls(
+            [vector.Px() for vector in vectors],
+            [vector.Py() for vector in vectors],
+            [vector.Pz() for vector in vectors],
+            [vector.E() for vector in vectors]
+        )
+
+    def __len__(self):
+        return len(self.px)
+
+    def __getitem__(self, index):
+        # Select vectors with an index, slice or mask
+        return LorentzArray(self.px[index], self.py[index], self.pz[index], self.e[index])
+
+    def __setitem__(self, index, other):
+        # Replace the selected vectors with other vectors
+        self.px[index] = other.px
+        self.py[index] = other.py
+        self.pz[index] = other.pz
+        self.e[index] = other.e
+
+    def __add__(self, other):
+        return LorentzArray(self.px + other.px, self.py + other.py, self.pz + other.pz, self.e + other.e)
+
+    def __sub__(self, other):
+        return LorentzArray(self.px - other.px, self.py - other.py, self.pz - other.pz, self.e - other.e)
+
+    @property
+    def shape(self):
+        return self.px.shape
+
+    def pt(self):
+        # Transverse momentum (TLorentzVector.Perp)
+        return np.sqrt(self.px ** 2 + self.py ** 2)
+
+    def p(self):
+        # Magnitude of the momentum
+        return np.sqrt(self.px ** 2 + self.py ** 2 + self.pz ** 2)
+
+    def energy(self):
+        return self.e
+
+    def m2(self):
+        # Squared invariant mass
+        return self.e ** 2 - (self.px ** 2 + self.py ** 2 + self.pz ** 2)
+
+    def m(self):
+        # Invariant mass, negative for space-like vectors (TLorentzVector.M)
+        m2 = self.m2()
+        return np.where(m2 < 0, -np.sqrt(np.abs(m2)), np.sqrt(np.abs(m2)))
+
+    def eta(self):
+        # Pseudorapidity, computed in the same way as TLorentzVector.Eta
+        p = self.p()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cos_theta = np.where(p > 0, self.pz / p, 1)
+            eta = -0.5 * np.log((1 - cos_theta) / (1 + cos_theta))
+        return np.where(cos_theta ** 2 < 1, eta, np.sign(self.pz) * ETA_MAX)
+
+    def phi(self):
+        # Azimuthal angle in [-pi, pi] (TLorentzVector.Phi)
+        return np.arctan2(self.py, self.px)
+
+    def delta_r(self, other):
+        # Distance in (eta, phi) to other vectors, broadcasting over the array shapes
+        return delta_r_eta_phi(self.eta(), self.phi(), other.eta(), other.phi())
+
+    def sum(self):
+        # Sum of all vectors
+        return LorentzArray(self.px.sum(), self.py.sum(), self.pz.sum(), self.e.sum())
+
+    def sum_segments(self, offsets):
+        # Sum the vectors of each segment given by CSR offsets (e.g. per event or per jet)
+        return LorentzArray(
+            segment_sum(self.px, offsets),
+            segment_sum(self.py, offsets),
+            segment_sum(self.pz, offsets),
+            segment_sum(self.e, offsets)
+        )
+
+    def sum_ranges(self, begin, end):
+        # Sum the vectors of each range [begin[i], end[i]), e.g. the constituents of each jet
+        return LorentzArray(
+            range_sum(self.px, begin, end),
+            range_sum(self.py, begin, end),
+            range_sum(self.pz, begin, end),
+            range_sum(self.e, begin, end)
+        )
+
+
+def delta_phi_mpi_pi(delta_phi):
+    # Wrap a difference of two angles in [-pi, pi] into [-pi, pi) (TVector2.Phi_mpi_pi)
+    delta_phi = np.where(delta_phi >= np.pi, delta_phi - 2 * np.pi, delta_phi)
+    return np.where(delta_phi < -np.pi, delta_phi + 2 * np.pi, delta_phi)
+
+
+def delta_r_eta_phi(eta1, phi1, eta2, phi2):
+    # DeltaR from pseudorapidities and azimuthal angles (TLorentzVector.DeltaR)
+    delta_eta = eta1 - eta2
+    delta_phi = delta_phi_mpi_pi(phi1 - phi2)
+    return np.sqrt(delta_eta ** 2 + delta_phi ** 2)
+
+
+def delta_r_matrix(vectors1, vectors2):
+    # DeltaR between every pair of vectors from two one-dimensional arrays
+    eta1, phi1 = vectors1.eta(), vectors1.phi()
+    eta2, phi2 = vectors2.eta(), vectors2.phi()
+    return delta_r_eta_phi(eta1[:, np.newaxis], phi1[:, np.newaxis], eta2[np.newaxis, :], phi2[np.newaxis, :])
+
+
+def segment_sum(values, offsets):
+    # Sum values over the segments [offsets[i], offsets[i + 1]), empty segments give 0
+    offsets = np.asarray(offsets, dtype=np.int64)
+    return range_sum(values, offsets[:-1], offsets[1:])
+
+
+def range_sum(values, begin, end):
+    # Sum values over the ranges [begin[i], end[i]), which may overlap or come in any order
+    return range_reduce(np.add, values, begin, end, 0)
+
+
+def range_max(values, begin, end, empty=0):
+    # Largest value in each of the ranges [begin[i], end[i]), empty for empty ranges
+    return range_reduce(np.maximum, values, begin, end, empty)
+
+
+def range_reduce(ufunc, values, begin, end, empty):
+    # Reduce values with a NumPy ufunc over the ranges [begin[i], end[i]), empty ranges give empty
+    begin = np.asarray(begin, dtype=np.int64)
+    end = np.asarray(end, dtype=np.int64)
+    results = np.full(len(begin), empty, dtype=np.float64)
+    filled = end > begin
+    if filled.any():
+        # reduceat reduces from each begin to the following end, the padding keeps every end a valid index
+        values = np.append(np.asarray(values, dtype=np.float64), 0)
+        bounds = np.column_stack([begin[filled], end[filled]]).ravel()
+        results[filled] = ufunc.reduceat(values, bounds)[::2]
+    return results